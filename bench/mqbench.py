@@ -0,0 +1,583 @@
+#!/usr/bin/python3
+#
+# Benchmark harness for mq.
+#
+# Builds a synthetic Mercurial repository (many files, deep history), fills a throw away
+# PATCH_DIR with a large patch pool and starts local stub RhodeCode and Mantis servers.
+# It then times the everyday mq commands against them, recording for every run:
+#
+#   seconds          Wall time of the mq command
+#   hg_processes     Number of hg (and chg) processes started
+#   requests         HTTP requests served by the stub servers
+#   bytes_sent       Bytes sent to the stub servers
+#   bytes_received   Bytes received from the stub servers
+#
+# A run where mq exits with an error is marked as failed. A scenario with any failed run
+# has no statistics, and the benchmark exits with 1.
+#
+# Everything runs under a temporary HOME, so your own ~/.hgrc and ~/.mq are never used.
+# Results are written as JSON so that runs can be compared:
+#
+#   bench/mqbench.py --output before.json
+#   (make changes)
+#   bench/mqbench.py --output after.json --compare before.json
+#
+# Requires Mercurial (with the mq and rebase extensions) and the python requirements of
+# the extensions.
+#
+
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import os
+import platform
+import random
+import shutil
+import socketserver
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+MQ_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'mq')
+PROJECT = 'bench'
+REBASE_DEPTH = 5
+SQUASH_COMMITS = 5
+FILE_LINES = 40
+SCENARIOS = ['status', 'list', 'apply', 'rebase', 'pop', 'squash', 'rhodecode', 'mantis']
+
+
+# -------------------------------------------------------------------------------------
+# Synthetic data
+# -------------------------------------------------------------------------------------
+
+def file_content(name, version=0):
+    return ''.join('{} line {} version {}\n'.format(name, line, version) for line in range(FILE_LINES))
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def run_hg(repo, *args):
+    return subprocess.run(['hg', '--cwd', repo] + list(args), check=True, universal_newlines=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+
+
+def generate_repo(repo, files, commits, seed):
+    """Create a repository with files spread over directories and a linear history of commits.
+
+    Files under stable/ are never changed by the history, so the benchmark patches that
+    touch them always apply and rebase cleanly.
+    """
+    rng = random.Random(seed)
+    run_hg(os.path.dirname(repo), 'init', repo)
+    with open(os.path.join(repo, '.hg', 'hgrc'), 'w') as f:
+        f.write('[paths]\ndefault = https://bench.invalid/{}\n'.format(PROJECT))
+    churn = []
+    for index in range(files):
+        name = 'src/d{:03d}/f{:05d}.txt'.format(index // 100, index)
+        churn.append(name)
+        write_file(os.path.join(repo, name), file_content(name))
+    for index in range(10):
+        name = 'stable/f{:02d}.txt'.format(index)
+        write_file(os.path.join(repo, name), file_content(name))
+    run_hg(repo, 'add', '-q')
+    run_hg(repo, 'commit', '-q', '-m', 'Initial import')
+    versions = {}
+    for commit in range(commits):
+        for name in rng.sample(churn, min(3, len(churn))):
+            versions[name] = versions.get(name, 0) + 1
+            write_file(os.path.join(repo, name), file_content(name, versions[name]))
+        run_hg(repo, 'commit', '-q', '-m', 'Change {}'.format(commit))
+    run_hg(repo, 'phase', '-q', '--public', '-r', 'tip')
+    return churn
+
+
+def file_diff(name, old_version, new_version, lines=None):
+    """A git style diff of file_content(name) between two versions, limited to some lines."""
+    lines = lines or range(FILE_LINES)
+    hunks = []
+    for line in lines:
+        hunks.append('@@ -{0},1 +{0},1 @@\n-{1} line {2} version {3}\n+{1} line {2} version {4}\n'.format(
+            line + 1, name, line, old_version, new_version))
+    return 'diff --git a/{0} b/{0}\n--- a/{0}\n+++ b/{0}\n{1}'.format(name, ''.join(hunks))
+
+
+def new_file_diff(name, lines):
+    body = ''.join('+{} new line {}\n'.format(name, line) for line in range(lines))
+    return 'diff --git a/{0} b/{0}\nnew file mode 100644\n--- /dev/null\n+++ b/{0}\n@@ -0,0 +1,{1} @@\n{2}'.format(
+        name, lines, body)
+
+
+def patch_header(parent, message):
+    return ('# HG changeset patch\n# User Bench <bench@example.com>\n# Date 1500000000 0\n'
+            '# Parent  {}\n{}\n\n'.format(parent, message))
+
+
+def generate_pool(patch_dir, churn, count, parent, seed):
+    """Fill patch_dir with count patches for the benchmark project plus a few for others."""
+    rng = random.Random(seed)
+    os.makedirs(patch_dir, exist_ok=True)
+    for index in range(count):
+        project = PROJECT if index % 4 else 'other{}'.format(index % 3)
+        diffs = ''.join(file_diff(name, 0, 1, rng.sample(range(FILE_LINES), 3))
+                        for name in rng.sample(churn, min(rng.randint(1, 5), len(churn))))
+        with open(os.path.join(patch_dir, 'pool{:05d}_{}'.format(index, project)), 'w') as f:
+            f.write(patch_header(parent, 'Pool patch {}'.format(index)) + diffs)
+    # The patch that is applied, rebased and popped
+    with open(os.path.join(patch_dir, 'benchapply_{}'.format(PROJECT)), 'w') as f:
+        f.write(patch_header(parent, 'Benchmark patch') + file_diff('stable/f00.txt', 0, 1, [5, 20]))
+
+
+# -------------------------------------------------------------------------------------
+# Stub servers
+# -------------------------------------------------------------------------------------
+
+class Counter():
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.bytes_received = 0
+
+    def add(self, field, amount):
+        with self.lock:
+            setattr(self, field, getattr(self, field) + amount)
+
+
+class CountingReader():
+
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.counter.add('bytes_sent', len(data))
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.counter.add('bytes_sent', len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class CountingWriter():
+
+    def __init__(self, stream, counter):
+        self.stream = stream
+        self.counter = counter
+
+    def write(self, data):
+        self.counter.add('bytes_received', len(data))
+        return self.stream.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class StubData():
+    """The pull request and issues served by the stub servers."""
+
+    def __init__(self, diffs, diff_lines, issues, attachment_lines):
+        self.commits = ['{:040x}'.format(index + 1) for index in range(diffs)]
+        self.diffs = dict((commit, new_file_diff('pr/f{:04d}.txt'.format(index), diff_lines))
+                          for index, commit in enumerate(self.commits))
+        self.issues = list(range(1, issues + 1))
+        self.attachments = {}
+        for issue in self.issues:
+            for version in (1, 2):
+                file_id = issue * 10 + version
+                self.attachments[file_id] = (
+                    'ISSUE_{}_v{}.patch'.format(issue, version),
+                    patch_header('0' * 40, 'Issue {}'.format(issue)) +
+                    new_file_diff('issue/{}.txt'.format(issue), attachment_lines * version))
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        self.rfile = CountingReader(self.rfile, self.server.counter)
+        self.wfile = CountingWriter(self.wfile, self.server.counter)
+
+    def log_message(self, *args):
+        pass
+
+    def respond(self, status, body=b'', content_type='text/html', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest()) if status == 200 else None
+        if etag and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def do_GET(self):
+        self.server.counter.add('requests', 1)
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        data = self.server.data
+        if url.path.startswith('/mantis/') and 'MANTIS_STRING_COOKIE' not in (self.headers.get('Cookie') or ''):
+            self.respond(302, headers={'Location': '/mantis/login_page.php'})
+        elif url.path == '/mantis/view.php':
+            issue = int(query.get('id', ['0'])[0])
+            links = ''.join('<div class="bugnote-note"><a href="file_download.php?file_id={}&amp;type=bug">{}</a></div>'
+                            .format(file_id, name) for file_id, (name, body) in sorted(data.attachments.items())
+                            if file_id // 10 == issue)
+            self.respond(200, '<html><body><table><tr><td class="bug-summary">{0:07d}: Benchmark issue {0}</td></tr>'
+                              '<tr><td class="bug-description"><p>Issue {0}</p></td></tr></table>{1}</body></html>'
+                              .format(issue, links))
+        elif url.path == '/mantis/file_download.php':
+            name, body = data.attachments.get(int(query.get('file_id', ['0'])[0]), (None, None))
+            if body is None:
+                self.respond(404)
+            else:
+                self.respond(200, body, 'application/octet-stream')
+        else:
+            self.respond(404)
+
+    def do_POST(self):
+        self.server.counter.add('requests', 1)
+        body = self.read_body()
+        data = self.server.data
+        if self.path == '/mantis/login.php':
+            self.respond(302, headers={'Location': '/mantis/my_view_page.php',
+                                       'Set-Cookie': 'MANTIS_STRING_COOKIE=bench; path=/'})
+        elif self.path == '/rhodecode/_admin/api':
+            request = json.loads(body.decode('utf-8'))
+            args = request.get('args') or {}
+            if request.get('method') == 'get_pull_request':
+                result = {
+                    'title': 'Benchmark pull request {}'.format(args.get('pullrequestid')),
+                    'description': 'Synthetic pull request',
+                    'source': {'repository': PROJECT},
+                    'author': {'firstname': 'Bench', 'lastname': 'Mark', 'email': 'bench@example.com'},
+                    'commit_ids': list(reversed(data.commits)),
+                }
+            elif request.get('method') == 'get_repo_changeset':
+                result = {'raw_diff': data.diffs.get(args.get('revision'))}
+            else:
+                result = None
+            response = {'id': request.get('id'), 'result': result,
+                        'error': None if result else 'unknown method {}'.format(request.get('method'))}
+            self.respond(200, json.dumps(response), 'application/json')
+        else:
+            self.respond(404)
+
+
+class StubServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, data):
+        self.data = data
+        self.counter = Counter()
+        http.server.HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+
+# -------------------------------------------------------------------------------------
+# Benchmark
+# -------------------------------------------------------------------------------------
+
+HG_SHIM = """#!/bin/sh
+echo "$0 $*" >> "${MQ_BENCH_HG_LOG}"
+exec "%s" "$@"
+"""
+
+
+class Bench():
+
+    def __init__(self, args):
+        self.args = args
+        self.work = tempfile.mkdtemp(prefix='mqbench-')
+        self.home = os.path.join(self.work, 'home')
+        self.repo = os.path.join(self.work, 'repo')
+        self.patch_dir = os.path.join(self.work, 'patches')
+        self.bin_dir = os.path.join(self.work, 'bin')
+        self.hg_log = os.path.join(self.work, 'hg.log')
+        self.data = StubData(args.pr_commits, args.diff_lines, args.issues, args.attachment_lines)
+        self.server = StubServer(self.data)
+        self.setup = {}
+
+    def environment(self):
+        env = dict(os.environ)
+        env['HOME'] = self.home
+        env['PATH'] = self.bin_dir + os.pathsep + env.get('PATH', '')
+        env['MQ_BENCH_HG_LOG'] = self.hg_log
+        env['HGPLAIN'] = '1'
+        env.pop('HGRCPATH', None)
+        return env
+
+    def install_shims(self):
+        """Put counting hg/chg wrappers and mq itself first on PATH."""
+        os.makedirs(self.bin_dir)
+        for tool in ('hg', 'chg'):
+            real = shutil.which(tool)
+            if not real:
+                continue
+            path = os.path.join(self.bin_dir, tool)
+            with open(path, 'w') as f:
+                f.write(HG_SHIM % real)
+            os.chmod(path, 0o755)
+        os.symlink(os.path.realpath(self.args.mq), os.path.join(self.bin_dir, 'mq'))
+
+    def write_hgrc(self):
+        os.makedirs(self.home)
+        with open(os.path.join(self.home, '.hgrc'), 'w') as f:
+            f.write('[ui]\nusername = Bench <bench@example.com>\n\n'
+                    '[extensions]\nmq =\nrebase =\nstrip =\n\n'
+                    '[mq]\n'
+                    'patch_dir = {patch_dir}\n'
+                    'rhodecode_url = {url}/rhodecode\n'
+                    'rhodecode_api_token = bench\n'
+                    'mantis_url = {url}/mantis\n'
+                    'mantis_login_url = {url}/mantis/login.php\n'
+                    'mantis_username = bench\n'
+                    'mantis_password = bench\n'.format(patch_dir=self.patch_dir, url=self.server.url))
+
+    def prepare(self):
+        self.write_hgrc()
+        self.install_shims()
+        os.environ.update(HOME=self.home)
+        start = time.time()
+        churn = generate_repo(self.repo, self.args.files, self.args.commits, self.args.seed)
+        self.setup['repo_seconds'] = round(time.time() - start, 3)
+        self.base = run_hg(self.repo, 'log', '-r', 'tip~{}'.format(REBASE_DEPTH), '--template', '{node}').strip()
+        start = time.time()
+        generate_pool(self.patch_dir, churn, self.args.patches, self.base, self.args.seed)
+        self.setup['pool_seconds'] = round(time.time() - start, 3)
+        # Warm up: builds the command manifest and compiles the extensions
+        self.mq('version')
+
+    def mq(self, *args, stdin=''):
+        return subprocess.run(['mq'] + list(args), cwd=self.repo, env=self.environment(), input=stdin,
+                              universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def hg(self, *args):
+        return subprocess.run(['hg'] + list(args), cwd=self.repo, env=self.environment(),
+                              universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+
+    # Each scenario returns (mq arguments, stdin) after doing any untimed setup
+
+    def scenario_status(self):
+        return ['status'], ''
+
+    def scenario_list(self):
+        return ['list'], ''
+
+    def scenario_apply(self):
+        self.hg('update', '-q', '-C', '-r', self.base)
+        return ['apply', 'benchapply'], ''
+
+    def scenario_rebase(self):
+        # Answer 'no' to the offer to pull first
+        return ['rebase'], 'n\n'
+
+    def scenario_pop(self):
+        return ['pop'], ''
+
+    def scenario_squash(self):
+        self.hg('update', '-q', '-C', '-r', 'tip')
+        for index in range(SQUASH_COMMITS):
+            name = os.path.join(self.repo, 'stable', 'f{:02d}.txt'.format(index + 1))
+            with open(name, 'a') as f:
+                f.write('squash line {}\n'.format(index))
+            self.hg('commit', '-q', '-m', 'Squash me {}'.format(index))
+        return ['squash', 'benchsquash', '--revs=draft()', '--yes'], ''
+
+    def cleanup_squash(self):
+        self.hg('qpop', '-a', '-q')
+        self.hg('qdelete', 'benchsquash_{}'.format(PROJECT))
+        self.hg('update', '-q', '-C', '-r', 'tip')
+
+    def scenario_rhodecode(self):
+        # Patch name, then 'yes' to overwrite on later iterations
+        return ['rhodecode', 'primport', '1'], 'pr1\ny\n'
+
+    def scenario_mantis(self):
+        return ['mantis', 'import', '--batch'] + [str(issue) for issue in self.data.issues], ''
+
+    def measure(self, name):
+        args, stdin = getattr(self, 'scenario_' + name)()
+        open(self.hg_log, 'w').close()
+        self.server.counter.reset()
+        start = time.perf_counter()
+        proc = self.mq(*args, stdin=stdin)
+        seconds = time.perf_counter() - start
+        with open(self.hg_log) as f:
+            hg_processes = sum(1 for line in f)
+        counter = self.server.counter
+        run = {
+            'seconds': round(seconds, 4),
+            'hg_processes': hg_processes,
+            'requests': counter.requests,
+            'bytes_sent': counter.bytes_sent,
+            'bytes_received': counter.bytes_received,
+            'returncode': proc.returncode,
+            'failed': proc.returncode != 0,
+        }
+        if proc.returncode:
+            # The timing of a broken run means nothing. It is kept but left out of the statistics
+            sys.stderr.write('{}: mq {} failed with exit status {}\n'.format(name, ' '.join(args), proc.returncode))
+            if self.args.verbose:
+                sys.stderr.write(proc.stdout)
+        cleanup = getattr(self, 'cleanup_' + name, None)
+        if cleanup:
+            cleanup()
+        return run
+
+    def run(self, scenarios):
+        results = dict((name, {'runs': []}) for name in scenarios)
+        for iteration in range(self.args.repeat):
+            for name in scenarios:
+                run = self.measure(name)
+                results[name]['runs'].append(run)
+                if self.args.verbose:
+                    sys.stderr.write('{:<10} {:>3}  {:8.3f}s  hg={:<4} requests={}\n'.format(
+                        name, iteration + 1, run['seconds'], run['hg_processes'], run['requests']))
+        for name, result in results.items():
+            runs = [run for run in result['runs'] if not run['failed']]
+            result['failed_runs'] = len(result['runs']) - len(runs)
+            result['failed'] = bool(result['failed_runs'])
+            if result['failed']:
+                for key in ('min_seconds', 'median_seconds', 'max_seconds', 'median_hg_processes', 'median_bytes'):
+                    result[key] = None
+                continue
+            seconds = [run['seconds'] for run in runs]
+            result['min_seconds'] = min(seconds)
+            result['median_seconds'] = round(statistics.median(seconds), 4)
+            result['max_seconds'] = max(seconds)
+            result['median_hg_processes'] = statistics.median(run['hg_processes'] for run in runs)
+            result['median_bytes'] = statistics.median(run['bytes_sent'] + run['bytes_received'] for run in runs)
+        return results
+
+    def close(self):
+        # Stop the hg command server daemon mq may have started for the synthetic repository
+        env = self.environment()
+        env['PYTHONPATH'] = os.path.join(os.path.dirname(os.path.realpath(self.args.mq)), 'extensions')
+        subprocess.run([sys.executable, '-m', 'mqlib.hgserver', 'stop'], cwd=self.repo, env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.server.shutdown()
+        if not self.args.keep:
+            shutil.rmtree(self.work, ignore_errors=True)
+
+
+def describe(args):
+    mq_dir = os.path.dirname(os.path.realpath(args.mq))
+    revision = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=mq_dir, universal_newlines=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip()
+    hg_version = subprocess.run(['hg', '--version', '-q'], universal_newlines=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.strip()
+    return {
+        'mq': os.path.realpath(args.mq),
+        'revision': revision or None,
+        'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'hg': hg_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline):
+    print('{:<10} {:>10} {:>10} {:>8} {:>8} {:>8}'.format('SCENARIO', 'BEFORE', 'AFTER', 'CHANGE', 'HG', 'BYTES'))
+    for name, result in results['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        if result.get('failed') or before.get('failed'):
+            print('{:<10} {:>10}'.format(name, 'FAILED'))
+            continue
+        change = (result['median_seconds'] - before['median_seconds']) / (before['median_seconds'] or 1) * 100
+        print('{:<10} {:>9.3f}s {:>9.3f}s {:>7.1f}% {:>8} {:>8}'.format(
+            name, before['median_seconds'], result['median_seconds'], change,
+            '{:+g}'.format(result['median_hg_processes'] - before['median_hg_processes']),
+            '{:+g}'.format(result['median_bytes'] - before['median_bytes'])))
+
+
+def get_params():
+    parser = argparse.ArgumentParser(description='Benchmark mq against synthetic repositories and stub servers')
+    parser.add_argument('--mq', default=MQ_SCRIPT, help='mq script to benchmark (default: this checkout)')
+    parser.add_argument('--files', type=int, default=2000, help='Files in the synthetic repository')
+    parser.add_argument('--commits', type=int, default=200, help='Commits of history in the synthetic repository')
+    parser.add_argument('--patches', type=int, default=2000, help='Patches in the synthetic patch pool')
+    parser.add_argument('--pr-commits', dest='pr_commits', type=int, default=50, help='Commits in the stub pull request')
+    parser.add_argument('--diff-lines', dest='diff_lines', type=int, default=200, help='Lines in each pull request diff')
+    parser.add_argument('--issues', type=int, default=20, help='Issues imported from the stub Mantis')
+    parser.add_argument('--attachment-lines', dest='attachment_lines', type=int, default=500,
+                        help='Lines in each Mantis attachment')
+    parser.add_argument('--repeat', type=int, default=3, help='Times each scenario is run')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenario', dest='scenarios', action='append', choices=SCENARIOS,
+                        help='Only run this scenario (may be given more than once)')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='A previous JSON result to compare against')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep the synthetic repository and pool')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False, help='Print progress to stderr')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    if not shutil.which('hg'):
+        print('Mercurial (hg) is required to run the benchmark.')
+        sys.exit(1)
+    args.mq = os.path.abspath(args.mq)
+    bench = Bench(args)
+    try:
+        bench.prepare()
+        results = {
+            'environment': describe(args),
+            'parameters': dict((key, value) for key, value in vars(args).items()
+                               if key not in ('output', 'compare', 'verbose', 'keep')),
+            'setup': bench.setup,
+            'results': bench.run(args.scenarios or SCENARIOS),
+        }
+    finally:
+        bench.close()
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    if args.keep:
+        sys.stderr.write('Synthetic data kept in {}\n'.format(bench.work))
+    sys.exit(1 if any(result['failed'] for result in results['results'].values()) else 0)
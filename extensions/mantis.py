@@ -1,6 +1,24 @@
 #!/usr/bin/python3
 #
 
+# Extension metadata. Read by mq (without importing this file) for help and completion
+MQ_HELP = ""
+MQ_HELP += "        mantis           Expand mq-cli tool to integrate with Mantis.\n"
+MQ_HELP += "                         Sub-Commands:\n"
+MQ_HELP += "                                 import [ISSUE NUMBER]           Import a patch from mantis to your mq patch cache pool\n"
+MQ_HELP += "                                 import --batch [ISSUE NUMBER...] Import patches from many issues without prompting\n"
+MQ_HELP += "                                        [--select latest|all] [--match REGEX] [--force]\n"
+MQ_HELP += "                                 info [ISSUE NUMBER]             Show details of your mantis issue\n"
+MQ_HELP += "                                 open [ISSUE NUMBER]             Open the mantis issue in your default web browser\n"
+MQ_HELP += "                                 sync [ISSUE|FROM-TO...]         Update the local search index (default: every issue already in it)\n"
+MQ_HELP += "                                 search [WORDS...] [--file PATH] Search the local index, including the files touched by attached patches\n"
+MQ_HELP += "                                 export [ISSUE NUMBER] [PATCH...] Attach patches (default: the applied patch) to a mantis issue\n"
+MQ_HELP += "                                 export --batch [ISSUE[:PATCH]...] Attach pool patches to many issues at once\n"
+MQ_HELP += "                         Usage:\n"
+MQ_HELP += "                                 mq mantis import [ISSUE NUMBER]\n"
+MQ_HELP += "                                 mq mantis info [ISSUE NUMBER]\n"
+MQ_COMMANDS = ["import", "info", "open", "export", "sync", "search"]
+
 
 import requests
 import os
@@ -11,84 +29,25 @@ import getpass
 import json
 import subprocess
 import argparse
+import re
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from lxml import html
-from pprint import pprint
-
-try:
-    import ConfigParser as configparser
-except:
-    import configparser as configparser
-
 
+from mqlib import trace
+from mqlib.config import Config
+from mqlib.remote import REMOTE
+from mqlib.session import SessionStore
+from mqlib.pool import PatchPool, hg
+from mqlib.hgserver import find_repo_root
+from mqlib.download import DownloadIndex
+from mqlib.mantisindex import MantisIndex, parse_issue_range
+from mqlib import patch
 
-class Config():
-    def __init__(self):
-        self.config = configparser.RawConfigParser()
 
-    def read_config(self):
-        self.config.read(os.path.join(os.path.expanduser("~"), ".hgrc"))
-        for each_section in self.config.sections():
-            if each_section == 'mq':
-                for (each_key, each_val) in self.config.items(each_section):
-                    setattr(self, each_key, each_val)
+BATCH_CONCURRENCY = 8
 
-    def getAll(self):
-        return [attr for attr in dir(self) if (not attr.startswith('__') and not attr.startswith('getAll'))]
-
-
-class REMOTE():
-    def __init__(self, timeout=20, debug=False):
-        self.timeout = timeout
-        self.debug = debug
-        # Configure session and cookies
-        self.http_session = requests.Session()
-
-    def log(self, string):
-        if self.debug:
-            try:
-                print('[REMOTE]: %s' % string)
-            except UnicodeEncodeError:
-                # we can't anticipate everything in unicode they might throw at
-                # us, but we can handle a simple BOM
-                bom = unicode(codecs.BOM_UTF8, 'utf8')
-                print('[REMOTE]: %s' % string.replace(bom, ''))
-            except Exception:
-                pass
-
-    def make_request(self, url, method, payload=None, headers=None, allow_redirects=True, files=None):
-        """Make an http request. Return the response."""
-        self.log('Request URL: %s' % url)
-        self.log('Headers: %s' % headers)
-        self.log('Payload: %s' % payload)
-        try:
-            if method == 'get':
-                req = self.http_session.get(
-                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            elif method == 'files':
-                req = self.http_session.post(
-                    url, data=payload, files=files, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            elif method == 'getfile':
-                req = self.http_session.get(
-                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout, stream=True)
-            else:  # post
-                req = self.http_session.post(
-                    url, data=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            req.raise_for_status()
-            self.log('Response code: %s' % req.status_code)
-            #self.log('Response: %s' % req.content)
-            return req
-        except requests.exceptions.HTTPError as error:
-            self.log('An HTTP error occurred: %s' % error)
-            raise
-        except requests.exceptions.ProxyError:
-            self.log('Error connecting to proxy server')
-            raise
-        except requests.exceptions.ConnectionError as error:
-            self.log('Connection Error: - %s' % error.message)
-            raise
-        except requests.exceptions.RequestException as error:
-            self.log('Error: - %s' % error.value)
-            raise
 
 
 class Mantis(object):
@@ -103,7 +62,13 @@ class Mantis(object):
         self.LOGIN_URL  = self.getConfig("mantis_login_url");
         self.COOKIE     = self.getConfig("mantis_cookie");
         self.BASE_URL   = self.getConfig("mantis_url");
-        self.req        = REMOTE(debug=self.debug);
+        self.req        = REMOTE(debug=self.debug, identity="{} {}".format(self.LOGIN_URL, self.USERNAME));
+        self.session    = SessionStore("mantis", self.LOGIN_URL, self.USERNAME);
+        self.downloads  = DownloadIndex();
+        # Batch commands fetch from several threads. Only one of them may log in at a time
+        self.login_lock = threading.Lock();
+        if not self.COOKIE:
+            self.COOKIE = self.session.load();
         self.headers    = {"Cookie": self.COOKIE};
 
     def getConfig(self, config_id):
@@ -126,7 +91,7 @@ class Mantis(object):
     def login(self, redirect_issue=""):
         _url = self.LOGIN_URL;
         if not self.PASSWORD:
-            self.PASSWORD = getpass.getpass("Enter the Password:");
+            self.PASSWORD = trace.prompt("Enter the Password:", getpass.getpass);
         data = {
             "username": self.USERNAME,
             "password": self.PASSWORD,
@@ -139,17 +104,43 @@ class Mantis(object):
         if ret.status_code == 302:
             self.COOKIE = ret.headers['Set-Cookie'];
             self.headers['Cookie'] = self.COOKIE;
+            self.session.save(self.COOKIE);
             self.log("successfully logged in");
             return True;
         return False;
 
-    def list_patches_on_mantis_bug(self, issue):
+    def is_login_page(self, ret):
+        urls = [ret.url] + [r.headers.get('Location', '') for r in ret.history];
+        return any('login_page.php' in url for url in urls);
+
+    def renew_session(self, expired_cookie, issue=""):
+        """Log in again unless another thread has already replaced expired_cookie. Return True if we have a new session."""
+        with self.login_lock:
+            if self.COOKIE and self.COOKIE != expired_cookie:
+                return True;
+            if expired_cookie:
+                self.log("session expired, logging in again");
+                self.session.clear();
+            return self.login(issue);
+
+    def fetch_issue_page(self, issue, cache=True):
         _url = self.BASE_URL + "/view.php?id={}".format(issue);
         if not self.COOKIE:
-            self.login();
-        ret = self.req.make_request(_url, 'get', headers=self.headers);
+            self.renew_session(None, issue);
+        cookie = self.COOKIE;
+        ret = self.req.make_request(_url, 'get', headers={"Cookie": cookie}, cache=cache);
+        if self.is_login_page(ret):
+            # Our stored session has expired. Log in again and retry once.
+            if self.renew_session(cookie, issue):
+                ret = self.req.make_request(_url, 'get', headers={"Cookie": self.COOKIE}, cache=cache);
+        return ret;
+
+    def list_patches_on_mantis_bug(self, issue):
+        ret = self.fetch_issue_page(issue);
         self.log(ret.content)
-        tree = html.fromstring(ret.text)
+        return self.patches_on_page(html.fromstring(ret.text));
+
+    def patches_on_page(self, tree):
         notes = tree.xpath('//*[contains(@class, "bugnote-note")]//a[text()]');
         issue_patches = {};
         for note in notes:
@@ -165,11 +156,8 @@ class Mantis(object):
 
     def fetch_on_mantis_bug(self, issue=""):
         while not issue:
-            issue = input('Enter an issue number: ');
-        _url = self.BASE_URL + "/view.php?id={}".format(issue);
-        if not self.COOKIE:
-            self.login();
-        ret = self.req.make_request(_url, 'get', headers=self.headers);
+            issue = trace.prompt('Enter an issue number: ');
+        ret = self.fetch_issue_page(issue);
         self.log(ret.content);
         tree = html.fromstring(ret.text);
         try:
@@ -188,28 +176,53 @@ class Mantis(object):
     def open_mantis_bug_in_browser(self, issue=""):
         import webbrowser
         while not issue:
-            issue = input('Enter an issue number: ');
+            issue = trace.prompt('Enter an issue number: ');
         _url = self.BASE_URL + "/view.php?id={}".format(issue);
         webbrowser.open(_url, new=0, autoraise=True)
 
+    def attachment_url(self, url):
+        return self.BASE_URL + "/{}".format(url);
+
+    def store_from_pool(self, pool, name, digest, size=None):
+        """Use the copy of an attachment the pool already holds, under any name, instead of
+        importing it again. Return False if the pool has no such content, or name already
+        holds other content (so 'mq import' can ask before overwriting it)."""
+        if not pool.project:
+            return False;
+        existing = self.downloads.find_in_pool(digest, pool.patch_dir, size);
+        if not existing:
+            return False;
+        result = pool.link_patch(existing, name);
+        if result == "exists":
+            return False;
+        print("");
+        if result == "unchanged":
+            print("Patch {} is already in your patch pool and unchanged.".format(pool.patch_name(name)));
+        else:
+            self.downloads.record_pool_file(pool.patch_path(name), digest);
+            self.downloads.save();
+            print("Patch {} is identical to {}, linked it into your patch pool.".format(
+                pool.patch_name(name), os.path.basename(existing)));
+        return True;
+
     def download_file(self, url, filename):
         _file   = os.path.join('/', 'tmp', filename);
-        _url    = self.BASE_URL + "/{}".format(url);
-        ret     = self.req.make_request(_url, 'getfile', headers=self.headers);
-        if ret.status_code == 200:
-            with open(_file, 'wb') as f:
-                for chunk in ret.iter_content(chunk_size=1024): 
-                    if chunk:
-                        f.write(chunk);
-            return _file;
-        return False;
+        _url    = self.attachment_url(url);
+        try:
+            self.req.download(_url, _file, headers=self.headers);
+        except requests.exceptions.RequestException as error:
+            self.log("Failed to download {}: {}".format(_url, error));
+            return False;
+        self.downloads.record(_url, _file);
+        self.downloads.save();
+        return _file;
 
     def import_patch_from_mantis(self, issue=""):
         print("");
         print("Importing patch from mantis...");
         print("");
         while not issue:
-            issue = input('Enter an issue number: ');
+            issue = trace.prompt('Enter an issue number: ');
         patch_list = self.list_patches_on_mantis_bug(issue);
         count = 1;
         selection_list = {};
@@ -220,19 +233,28 @@ class Mantis(object):
             count += 1;
         print("");
         try:
-            selection = input("Select a patch from the list above: ");
+            selection = trace.prompt("Select a patch from the list above: ");
         except:
             selection = False;
         if selection and selection in selection_list:
             selected_url = selection_list[selection]
+            _url = self.attachment_url(selected_url);
+            pool = PatchPool();
+            if self.store_from_pool(pool, issue, self.downloads.digest(_url), self.downloads.size(_url)):
+                return True;
             res_file = self.download_file(selected_url, "ISSUE_{}.patch".format(issue));
             if res_file:
+                if self.store_from_pool(pool, issue, self.downloads.digest(_url), os.path.getsize(res_file)):
+                    return True;
                 print("");
                 print("");
                 cmd = ['mq', 'import', res_file, '--name={}'.format(issue)];
                 try:
                     p = subprocess.check_call(cmd);
                     if p == 0:
+                        if pool.project:
+                            self.downloads.record_pool_file(pool.patch_path(issue), self.downloads.digest(_url));
+                            self.downloads.save();
                         return True;
                 except:
                     pass;
@@ -242,45 +264,272 @@ class Mantis(object):
         print("No patch imported.");
         return False;
 
-    def upload(self, file, issue):
-        issue_url = self.BASE_URL + '/view.php?id={}'.format(issue)
-        ret = self.req.make_request(issue_url, 'get', allow_redirects=True, headers=self.headers)
-        self.log(ret.headers)
-        self.log(ret.cookies)
-        tree = html.fromstring(ret.content)
-        bugnote_add_token = tree.xpath('//input[@name="bugnote_add_token"]/@value')
-        bug_id = tree.xpath('//input[@name="bug_id"]/@value')
-        bugnote_text = tree.xpath('//input[@name="bugnote_text"]/@value')
-        max_file_size = tree.xpath('//input[@name="max_file_size"]/@value')
-        if os.path.exists(file):
-            self.log("uploading file " + file)
-            headers = {
-                "Accept": "application/json",
-                "Cookie": self.COOKIE,
-                "Referer": issue_url,
-                "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/62.0.3202.75 Safari/537.36",
-                "X-Requested-With": "XMLHttpRequest",
-            }
-            data = {
-                'bugnote_add_token': bugnote_add_token[0] if bugnote_add_token else "",
-                'bug_id': bug_id[0] if bug_id else "",
-                'bugnote_text': bugnote_text[0] if bugnote_text else "",
-                'max_file_size': max_file_size[0] if max_file_size else "",
-                'file-name': 'Filename',
-            }
-            files = {"file": ("ISSUE_12440_gocabinets", open(
-                file, "rb"), 'applicaiton-type')}
-            response = req.make_request(
-                issue_url, 'files', payload=data, files=files, headers=headers, allow_redirects=False)
-            self.log(response)
-            self.log(response.status_code)
-            self.log(response.cookies)
-            pprint(response.headers)
-            # response.raise_for_status()
-            # pprint(response.json())
-            # print response.content
-            # files = {'file': open('style.css')}
-            # response = requests.post(url, files=files)
+    def select_patches(self, patch_list, select="latest", match=""):
+        names = list(patch_list);
+        if match:
+            names = [name for name in names if re.search(match, name)];
+        if select == "latest":
+            names = names[-1:];
+        return names;
+
+    def fetch_batch_issue(self, issue, select, match, pool):
+        patch_list = self.list_patches_on_mantis_bug(issue);
+        selected = self.select_patches(patch_list, select, match);
+        downloads = [];
+        for count, key in enumerate(selected, 1):
+            name = issue if len(selected) == 1 else "{}-{}".format(issue, count);
+            _url = self.attachment_url(patch_list[key]);
+            # Content already in the pool, under this name or another one, is not downloaded again
+            existing = self.downloads.find_in_pool(self.downloads.digest(_url), pool.patch_dir, self.downloads.size(_url));
+            if existing:
+                downloads.append((key, name, None, existing));
+                continue;
+            res_file = self.download_file(patch_list[key], "ISSUE_{}.patch".format(name));
+            if res_file:
+                existing = self.downloads.find_in_pool(self.downloads.digest(_url), pool.patch_dir, os.path.getsize(res_file));
+            downloads.append((key, name, res_file, existing));
+        return downloads;
+
+    def batch_import_patches_from_mantis(self, issues, select="latest", match="", overwrite=False):
+        print("");
+        print("Importing patches from {} mantis issues...".format(len(issues)));
+        print("");
+        pool = PatchPool();
+        if not pool.project:
+            print("abort: no repository found in '{}' (.hg not found)!".format(os.getcwd()));
+            return False;
+        if not self.COOKIE:
+            self.login();
+        # Fetch issue pages and attachments concurrently, then import everything in one pass
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as executor:
+            futures = [(issue, executor.submit(self.fetch_batch_issue, issue, select, match, pool)) for issue in issues];
+        summary = [];
+        for issue, future in futures:
+            try:
+                downloads = future.result();
+            except Exception as error:
+                summary.append((issue, "failed", "", str(error)));
+                continue;
+            if not downloads:
+                summary.append((issue, "skipped", "", "no matching patches"));
+            for key, name, res_file, existing in downloads:
+                if existing:
+                    result = pool.link_patch(existing, name, overwrite=overwrite);
+                elif not res_file:
+                    summary.append((issue, "failed", key, "download failed"));
+                    continue;
+                else:
+                    result = pool.import_patch(res_file, name, overwrite=overwrite);
+                if result in ("imported", "linked"):
+                    self.downloads.record_pool_file(pool.patch_path(name));
+                if result == "imported":
+                    summary.append((issue, "imported", key, pool.patch_name(name)));
+                elif result == "linked":
+                    summary.append((issue, "linked", key, "{} (same content as {})".format(
+                        pool.patch_name(name), os.path.basename(existing))));
+                elif result == "unchanged":
+                    summary.append((issue, "skipped", key, "{} is already up to date".format(pool.patch_name(name))));
+                else:
+                    summary.append((issue, "skipped", key, "{} already exists (use --force to overwrite)".format(pool.patch_name(name))));
+        self.downloads.save();
+        for issue, result, key, message in summary:
+            print("      {:<10} {:<10} {} {}".format(issue, result, key, message).rstrip());
+        print("");
+        return not any(result == "failed" for issue, result, key, message in summary);
+
+    def fetch_issue_for_index(self, issue, known):
+        """Fetch an issue page for the search index. known holds what the index already has.
+        Attachments are only downloaded if they are not in the index yet."""
+        ret = self.fetch_issue_page(issue);
+        if ret.status_code != 200 or self.is_login_page(ret):
+            return {"issue": issue, "status": "failed"};
+        page_hash = hashlib.sha1(ret.content).hexdigest();
+        tree = html.fromstring(ret.text);
+        summary = tree.xpath('//td[@class="bug-summary"]/text()');
+        if not summary:
+            return {"issue": issue, "status": "missing"};
+        updated = tree.xpath('//td[@class="bug-last-modified"]/text()');
+        updated = updated[0].strip() if updated else "";
+        stored = known["issues"].get(issue);
+        if stored and (getattr(ret, "from_cache", False) or page_hash == stored["page_hash"] or
+                       (updated and updated == stored["updated"])):
+            return {"issue": issue, "status": "unchanged"};
+        attachments = [];
+        for name, link in self.patches_on_page(tree).items():
+            _url = self.attachment_url(link);
+            files = None;
+            if _url not in known["attachments"]:
+                try:
+                    # Only the list of files is kept, so do not keep a copy of the patch in the cache too
+                    text = self.req.make_request(_url, 'get', headers=self.headers, cache=False).text;
+                    files = [stat[0] for stat in patch.diffstat(text.splitlines(True))];
+                except (requests.exceptions.RequestException, ValueError) as error:
+                    self.log("Failed to read attachment {}: {}".format(_url, error));
+                    files = [];
+            attachments.append((_url, name, files));
+        return {
+            "issue": issue,
+            "status": "updated",
+            "summary": summary[0].strip(),
+            "description": " ".join(text.strip() for text in tree.xpath('//td[@class="bug-description"]//text()')).strip(),
+            "updated": updated,
+            "page_hash": page_hash,
+            "attachments": attachments,
+        };
+
+    def sync_index(self, issues):
+        index = MantisIndex(self.BASE_URL);
+        issues = issues or index.issue_ids();
+        if not issues:
+            print("Nothing to sync. Give the issues to index, eg. 'mq mantis sync 1000-1200'.");
+            return False;
+        print("");
+        print("Syncing {} mantis issues...".format(len(issues)));
+        start = time.time();
+        known = {"issues": {}, "attachments": index.attachment_urls()};
+        for issue in issues:
+            stored = index.issue(issue);
+            if stored:
+                known["issues"][issue] = stored;
+        if not self.COOKIE:
+            self.login();
+        counts = dict((status, 0) for status in ("updated", "unchanged", "missing", "failed"));
+        # Fetch concurrently. The index is only written from this thread
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as executor:
+            futures = [executor.submit(self.fetch_issue_for_index, issue, known) for issue in issues];
+            for future in futures:
+                try:
+                    result = future.result();
+                except Exception as error:
+                    self.log("Failed to sync issue: {}".format(error));
+                    counts["failed"] += 1;
+                    continue;
+                counts[result["status"]] += 1;
+                if result["status"] == "unchanged":
+                    index.touch(result["issue"]);
+                elif result["status"] == "updated":
+                    attachments = [(_url, name, files if files is not None else index.attachment_files(_url) or [])
+                                   for _url, name, files in result["attachments"]];
+                    index.store(result["issue"], result["summary"], result["description"], result["updated"],
+                                result["page_hash"], attachments);
+        print("");
+        print("      " + ", ".join("{} {}".format(count, status) for status, count in counts.items()));
+        print("      Finished in {:.1f}s".format(time.time() - start));
+        print("");
+        return not counts["failed"];
+
+    def search_index(self, query, touched="", as_json=False):
+        results = MantisIndex(self.BASE_URL).search(query, touched);
+        if as_json:
+            print(json.dumps(results, indent=2));
+            return True;
+        if not results:
+            print("No matching issues found. Run 'mq mantis sync' to update the index.");
+            return False;
+        print("");
+        for result in results:
+            print("      {:<8} {}".format(result["issue"], result["summary"]));
+            for attachment in result["attachments"]:
+                files = ", ".join(attachment["files"][:5]) + (" ..." if len(attachment["files"]) > 5 else "");
+                print("               {}{}".format(attachment["name"], "  ({})".format(files) if files else ""));
+        print("");
+        return True;
+
+    def bugnote_form(self, tree):
+        """Return (action url, hidden fields, file field) of the add note form on an issue page."""
+        forms = tree.xpath('//form[.//input[@name="bugnote_add_token"]]');
+        if not forms:
+            return None;
+        form = forms[0];
+        fields = [(field.get('name'), field.get('value') or "") for field in form.xpath('.//input[@type="hidden"][@name]')];
+        file_field = form.xpath('.//input[@type="file"]/@name');
+        action = form.get('action') or "bugnote_add.php";
+        if not action.startswith('http'):
+            action = self.BASE_URL + "/" + action.lstrip('/');
+        return action, fields, file_field[0] if file_field else "ufile[]";
+
+    def upload_name(self, path):
+        name = os.path.basename(path);
+        if not name.endswith('.patch') and not name.endswith('.diff'):
+            name += '.patch';
+        return name;
+
+    def upload(self, issue, files, message=""):
+        """Attach one or more patch files to an issue in a single note.
+
+        The issue page is fetched once (bypassing the response cache, as its form token
+        can only be used once) and every file is streamed from disk."""
+        ret = self.fetch_issue_page(issue, cache=False);
+        form = self.bugnote_form(html.fromstring(ret.text));
+        if not form:
+            raise ValueError("No note form found on issue {}. Do you have permission to add notes?".format(issue));
+        action, fields, file_field = form;
+        names = [self.upload_name(path) for path in files];
+        fields = [(name, value) for name, value in fields if name != 'bugnote_text'];
+        fields.append(('bugnote_text', message or "Patch: {}".format(", ".join(names))));
+        headers = dict(self.headers);
+        headers['Referer'] = self.BASE_URL + "/view.php?id={}".format(issue);
+        self.log("uploading {} to issue {}".format(", ".join(files), issue));
+        response = self.req.make_request(action, 'files', payload=fields, headers=headers, allow_redirects=False,
+                                         files=[(file_field, name, path, 'text/x-diff') for name, path in zip(names, files)]);
+        if response.status_code not in (200, 302, 303) or 'APPLICATION ERROR' in response.text:
+            raise ValueError("Mantis rejected the upload to issue {} ({})".format(issue, response.status_code));
+        return names;
+
+    def resolve_patch(self, value, pool):
+        """A patch to export may be a file path, a pool file name or a short patch name."""
+        for path in (value, os.path.join(pool.patch_dir, value), pool.patch_path(value)):
+            if os.path.isfile(path):
+                return path;
+        return None;
+
+    def applied_patch(self):
+        root = find_repo_root(os.getcwd());
+        name = (hg('qtop', cwd=root) or "").strip() if root else "";
+        path = os.path.join(root, '.hg', 'patches', name) if name else "";
+        return path if path and os.path.isfile(path) else None;
+
+    def export_patches(self, values, batch=False, message=""):
+        """Upload patches to mantis. Without batch: ISSUE [PATCH...] (default: the applied patch, or
+        the pool patch named after the issue). With batch: ISSUE[:PATCH] ... with one upload per issue."""
+        pool = PatchPool();
+        uploads = collections.OrderedDict();
+        if batch:
+            for value in values:
+                issue, sep, name = value.partition(':');
+                uploads.setdefault(issue, []).append(name or issue);
+        else:
+            uploads[values[0]] = values[1:];
+        jobs = [];
+        for issue, names in uploads.items():
+            if not issue.isdigit():
+                print("abort: '{}' is not an issue number".format(issue));
+                return False;
+            paths = [self.resolve_patch(name, pool) for name in names];
+            if not names:
+                paths = [self.applied_patch() or self.resolve_patch(issue, pool)];
+            missing = [name for name, path in zip(names or [issue], paths) if not path];
+            if missing:
+                print("abort: no patch found matching {}".format(", ".join(missing)));
+                return False;
+            jobs.append((issue, paths));
+        print("");
+        print("Exporting {} patches to {} mantis issues...".format(sum(len(paths) for issue, paths in jobs), len(jobs)));
+        print("");
+        if not self.COOKIE:
+            self.login();
+        with ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY) as executor:
+            futures = [(issue, executor.submit(self.upload, issue, paths, message)) for issue, paths in jobs];
+        failed = False;
+        for issue, future in futures:
+            try:
+                names = future.result();
+                print("      {:<10} {:<10} {}".format(issue, "uploaded", ", ".join(names)));
+            except (requests.exceptions.RequestException, ValueError, IOError) as error:
+                failed = True;
+                print("      {:<10} {:<10} {}".format(issue, "failed", error));
+        print("");
+        return not failed;
 
 
 
@@ -288,9 +537,18 @@ def get_params():
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', dest='debugging', action='store_true', help='Enable debugging', default=False)
     parser.add_argument('command', nargs='?', default='help', help='What command should be run. Import/Export')
+    parser.add_argument('--batch', dest='batch', action='store_true', help='Import from every listed issue without prompting', default=False)
+    parser.add_argument('--select', dest='select', choices=['latest', 'all'], help='Which attachments to import in batch mode', default='latest')
+    parser.add_argument('--match', dest='match', help='Only import attachments whose name matches this regex', default='')
+    parser.add_argument('--force', dest='force', action='store_true', help='Overwrite existing patches in the pool', default=False)
+    parser.add_argument('--file', dest='touched', help='Search for issues with patches touching this path', default='')
+    parser.add_argument('--message', dest='message', help='Note text for exported patches', default='')
+    parser.add_argument('--json', dest='json', action='store_true', help='Print search results as JSON', default=False)
     parser.add_argument('issue', nargs='?', default='help', help='Mantis Issue ID')
+    parser.add_argument('issues', nargs='*', help='Additional Mantis Issue IDs (batch mode)')
 
-    args = parser.parse_args()
+    # Options may come between the positionals (eg. 'import --batch 1 2 3')
+    args = parser.parse_intermixed_args()
     #print(args)
     return args
 
@@ -299,18 +557,15 @@ if __name__ == '__main__':
     args = get_params()
     mantis = Mantis(debug=args.debugging)
     if args.command == "help":
-        print("        mantis           Expand mq-cli tool to integrate with Mantis.");
-        print("                         Sub-Commands:");
-        print("                                 import [ISSUE NUMBER]           Import a patch from mantis to your mq patch cache pool");
-        print("                                 info [ISSUE NUMBER]             Show details of your mantis issue");
-        print("                                 open [ISSUE NUMBER]             Open the mantis issue in your default web browser");
-        print("                         Usage:");
-        print("                                 mq mantis import [ISSUE NUMBER]");
-        print("                                 mq mantis info [ISSUE NUMBER]");
+        print(MQ_HELP, end="");
     if args.command == "import":
         if not args.issue:
             sys.exit(1);
-        mantis.import_patch_from_mantis(args.issue)
+        if args.batch:
+            if not mantis.batch_import_patches_from_mantis([args.issue] + args.issues, args.select, args.match, args.force):
+                sys.exit(1);
+        else:
+            mantis.import_patch_from_mantis(args.issue)
     if args.command == "info":
         if not args.issue:
             sys.exit(1);
@@ -319,5 +574,26 @@ if __name__ == '__main__':
         if not args.issue:
             sys.exit(1);
         mantis.open_mantis_bug_in_browser(args.issue)
+    if args.command == "sync":
+        try:
+            issues = parse_issue_range([value for value in [args.issue] + args.issues if value != "help"]);
+        except ValueError as error:
+            print(error);
+            sys.exit(1);
+        if not mantis.sync_index(issues):
+            sys.exit(1);
+    if args.command == "search":
+        query = " ".join(value for value in [args.issue] + args.issues if value != "help");
+        if not query and not args.touched:
+            print("Usage: mq mantis search [WORDS...] [--file PATH]");
+            sys.exit(1);
+        if not mantis.search_index(query, args.touched, args.json):
+            sys.exit(1);
     if args.command == "export":
-        print("This feature does not yet exist")
+        values = [value for value in [args.issue] + args.issues if value != "help"];
+        if not values:
+            print("Usage: mq mantis export ISSUE [PATCH...]");
+            print("       mq mantis export --batch ISSUE[:PATCH]...");
+            sys.exit(1);
+        if not mantis.export_patches(values, args.batch, args.message):
+            sys.exit(1);
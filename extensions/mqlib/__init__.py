@@ -0,0 +1,4 @@
+#!/usr/bin/python3
+#
+# Shared runtime for mq-cli extensions.
+#
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#
+# Check which patches in the pool still apply, without touching the working copy.
+#
+# The files touched by every patch of the project are exported once from the target
+# revision with 'hg cat' into a temporary directory. Each patch is then dry-run against
+# that directory with 'patch --dry-run', spread across a process pool.
+#
+
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from mqlib import patch
+from mqlib.hgserver import find_repo_root
+from mqlib.patchindex import PatchIndex
+from mqlib.pool import hg
+
+
+HG_CAT_BATCH = 500
+FAILED_RE = re.compile(r'^Hunk #\d+ FAILED', re.M)
+FUZZ_RE = re.compile(r'^Hunk #\d+ succeeded at \d+ with fuzz', re.M)
+OFFSET_RE = re.compile(r'^Hunk #\d+ succeeded at \d+ \(offset', re.M)
+MISSING_RE = re.compile(r"^(can't find file to patch|No file to patch)", re.M)
+
+
+def export_files(root, revision, files, base_dir):
+    """Write the given files as they are at revision into base_dir."""
+    files = sorted(files)
+    for start in range(0, len(files), HG_CAT_BATCH):
+        patterns = ['path:' + f for f in files[start:start + HG_CAT_BATCH]]
+        # Files that do not exist at revision are reported by hg and simply left out
+        hg('cat', '-r', revision, '-o', os.path.join(base_dir, '%p'), *patterns, cwd=root)
+
+
+def count_hunks(path):
+    with open(path, errors='replace') as f:
+        try:
+            return sum(fp.hunk_count for fp in patch.iter_file_patches(f, keep_hunks=False))
+        except ValueError:
+            return 0
+
+
+def check_patch(path, base_dir):
+    """Dry-run a single patch against base_dir. Return a result dict."""
+    result = {'patch': os.path.basename(path), 'hunks': count_hunks(path), 'fuzz': 0, 'offset': 0, 'failed': 0}
+    proc = subprocess.run(
+        ['patch', '--dry-run', '--batch', '--force', '-p1', '-d', base_dir, '-i', path],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    output = proc.stdout
+    result['failed'] = len(FAILED_RE.findall(output)) + len(MISSING_RE.findall(output))
+    result['fuzz'] = len(FUZZ_RE.findall(output))
+    result['offset'] = len(OFFSET_RE.findall(output))
+    if result['failed'] or proc.returncode > 1:
+        result['status'] = 'conflict'
+    elif result['fuzz'] or result['offset']:
+        result['status'] = 'fuzz'
+    else:
+        result['status'] = 'clean'
+    return result
+
+
+def check_pool(root, patch_dir, project, revision='.', workers=None, entries=None):
+    """Check the patches of project. entries can be given if the index has already been queried."""
+    if entries is None:
+        index = PatchIndex(patch_dir)
+        index.sync()
+        entries = index.query(project)
+    touched = set()
+    for entry in entries:
+        touched.update(entry['files'])
+    base_dir = tempfile.mkdtemp(prefix='mq-check-')
+    try:
+        export_files(root, revision, touched, base_dir)
+        if workers == 1:
+            # No process pool. Safe to call from a thread that runs alongside others
+            return [check_patch(os.path.join(patch_dir, entry['name']), base_dir) for entry in entries]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(check_patch, os.path.join(patch_dir, entry['name']), base_dir)
+                       for entry in entries]
+            return [future.result() for future in futures]
+    finally:
+        shutil.rmtree(base_dir, ignore_errors=True)
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq check')
+    parser.add_argument('--patch-dir', dest='patch_dir', required=True)
+    parser.add_argument('--project', dest='project', required=True)
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--json', dest='json', action='store_true', default=False, help='Print machine readable output')
+    parser.add_argument('revision', nargs='?', default='.', help='Revision to check against (default: working parent)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    root = find_repo_root(os.getcwd())
+    if not root:
+        print("abort: no repository found in '{}' (.hg not found)!".format(os.getcwd()))
+        sys.exit(1)
+    if not shutil.which('patch'):
+        print("You need to install the patch tool.")
+        print("Try running 'sudo apt install patch'. Then run this command again")
+        sys.exit(1)
+    results = check_pool(root, args.patch_dir, args.project, args.revision, args.jobs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        sys.exit(0)
+    print("")
+    print("    Checking {} patches against revision '{}':".format(len(results), args.revision))
+    print("")
+    print("      {:<10} {:>6} {:>6} {:>7}  {}".format('STATUS', 'HUNKS', 'FUZZ', 'FAILED', 'PATCH'))
+    for result in results:
+        print("      {:<10} {:>6} {:>6} {:>7}  {}".format(
+            result['status'], result['hunks'], result['fuzz'] + result['offset'], result['failed'], result['patch']))
+    print("")
+    for status in ('clean', 'fuzz', 'conflict'):
+        print("    {:<10} {}".format(status + ':', sum(1 for result in results if result['status'] == status)))
+    print("")
+    sys.exit(0)
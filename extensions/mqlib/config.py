@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+#
+
+
+import os
+
+try:
+    import ConfigParser as configparser
+except:
+    import configparser as configparser
+
+
+MQ_HOME = os.path.join(os.path.expanduser("~"), ".mq")
+
+
+def mq_home(*paths):
+    """Return a path inside ~/.mq, creating the parent directory if needed."""
+    path = os.path.join(MQ_HOME, *paths)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class Config():
+    def __init__(self):
+        self.config = configparser.RawConfigParser()
+
+    def read_config(self):
+        self.config.read(os.path.join(os.path.expanduser("~"), ".hgrc"))
+        for each_section in self.config.sections():
+            if each_section == 'mq':
+                for (each_key, each_val) in self.config.items(each_section):
+                    setattr(self, each_key, each_val)
+
+    def getAll(self):
+        return [attr for attr in dir(self) if (not attr.startswith('__') and not attr.startswith('getAll'))]
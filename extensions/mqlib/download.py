@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+#
+
+
+import hashlib
+import json
+import os
+import threading
+
+from mqlib.config import MQ_HOME
+
+
+DIGEST_CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path):
+    """Return the sha256 of a file, or None if it does not exist."""
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+class DownloadIndex():
+    """Remember the content hash of every attachment we have downloaded, keyed by url, and
+    which files of the patch pool hold which content."""
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(MQ_HOME, 'downloads.json')
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            data = {}
+        if 'urls' not in data:
+            # Older indexes only held the urls
+            data = {'urls': data, 'pool': {}}
+        self.entries = data['urls']
+        self.pool = data.get('pool', {})
+
+    def digest(self, url):
+        return self.entries.get(url, {}).get('sha256')
+
+    def size(self, url):
+        return self.entries.get(url, {}).get('size')
+
+    def record(self, url, path):
+        digest = file_digest(path)
+        with self.lock:
+            self.entries[url] = {'sha256': digest, 'size': os.path.getsize(path)}
+        return digest
+
+    def record_pool_file(self, path, digest=None):
+        """Remember that the pool file at path holds content with the given sha256."""
+        digest = digest or file_digest(path)
+        if not digest:
+            return
+        with self.lock:
+            paths = self.pool.setdefault(digest, [])
+            if path not in paths:
+                paths.append(path)
+
+    def find_in_pool(self, digest, patch_dir, size=None):
+        """Return a file in patch_dir whose content has this sha256, or None.
+
+        Files we stored are looked up directly. Failing that (eg. the patch was imported by
+        hand) only the pool files of the same size are hashed.
+        """
+        if not digest:
+            return None
+        for path in list(self.pool.get(digest, [])):
+            if file_digest(path) == digest:
+                return path
+            with self.lock:
+                if path in self.pool.get(digest, []):
+                    self.pool[digest].remove(path)
+                    if not self.pool[digest]:
+                        del self.pool[digest]
+        if size is None:
+            return None
+        try:
+            entries = list(os.scandir(patch_dir))
+        except OSError:
+            return None
+        for entry in entries:
+            if entry.name.startswith('.') or not entry.is_file() or entry.stat().st_size != size:
+                continue
+            if file_digest(entry.path) == digest:
+                self.record_pool_file(entry.path, digest)
+                return entry.path
+        return None
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + '.tmp', 'w') as f:
+                json.dump({'urls': self.entries, 'pool': self.pool}, f, indent=1, sort_keys=True)
+            os.replace(self.path + '.tmp', self.path)
@@ -0,0 +1,245 @@
+#!/usr/bin/python3
+#
+# Persistent Mercurial command server for mq.
+#
+# Every 'hg' process pays Mercurial's full start-up cost. In the style of chg, the first
+# routed call in a repository starts a small daemon that keeps one
+# 'hg serve --cmdserver pipe' process alive for that repository and listens on a unix
+# socket under ~/.mq/run. Later calls, from this or any other mq invocation, are relayed
+# through it. The daemon exits after IDLE_TIMEOUT seconds without a request and restarts
+# its command server whenever an hgrc it depends on changes.
+#
+# Usage:
+#   python3 -m mqlib.hgserver run [HG ARGS...]     Run an hg command through the daemon
+#   python3 -m mqlib.hgserver serve ROOT           Run the daemon for the repository at ROOT
+#   python3 -m mqlib.hgserver stop                 Stop the daemon for the current repository
+#
+
+
+import hashlib
+import json
+import os
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import time
+
+from mqlib.config import MQ_HOME
+
+
+IDLE_TIMEOUT = 600
+START_TIMEOUT = 5.0
+RUN_DIR = os.path.join(MQ_HOME, 'run')
+
+
+def find_repo_root(path):
+    while True:
+        if os.path.isdir(os.path.join(path, '.hg')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def socket_path(root):
+    return os.path.join(RUN_DIR, 'hg-{}.sock'.format(hashlib.sha1(root.encode('utf-8')).hexdigest()[:16]))
+
+
+def read_exactly(stream, size):
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise EOFError('Unexpected end of stream from hg command server')
+        data += chunk
+    return data
+
+
+def read_message(stream):
+    channel, length = struct.unpack('>cI', read_exactly(stream, 5))
+    # Input channels carry the requested size instead of a payload
+    if channel in (b'I', b'L'):
+        return channel, length
+    return channel, read_exactly(stream, length)
+
+
+class CommandServer():
+    """A single 'hg serve --cmdserver pipe' process."""
+
+    def __init__(self, root):
+        self.root = root
+        self.proc = subprocess.Popen(
+            ['hg', 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False'],
+            cwd=root, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        channel, hello = read_message(self.proc.stdout)
+        if channel != b'o' or b'runcommand' not in hello:
+            raise RuntimeError('hg command server does not support runcommand')
+
+    def runcommand(self, args, send):
+        """Run args, passing every output/result frame to send(). Return the exit code."""
+        data = b'\0'.join(arg.encode('utf-8', 'surrogateescape') for arg in args)
+        self.proc.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+        self.proc.stdin.flush()
+        while True:
+            channel, payload = read_message(self.proc.stdout)
+            if channel in (b'I', b'L'):
+                # We never provide input. Answer every request with EOF
+                self.proc.stdin.write(struct.pack('>I', 0))
+                self.proc.stdin.flush()
+                continue
+            send(channel, payload)
+            if channel == b'r':
+                return struct.unpack('>i', payload)[0]
+
+    def close(self):
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=5)
+        except Exception:
+            self.proc.kill()
+
+
+class Daemon(socketserver.UnixStreamServer):
+
+    def __init__(self, root):
+        self.root = root
+        self.idle = False
+        self.hgrc_files = [os.path.join(os.path.expanduser('~'), '.hgrc'), os.path.join(root, '.hg', 'hgrc')]
+        self.hgrc_state = self.config_state()
+        path = socket_path(root)
+        if os.path.exists(path):
+            try:
+                connect(root).close()
+                raise RuntimeError('A command server is already running for %s' % root)
+            except OSError:
+                # Left behind by a daemon that did not shut down cleanly
+                os.remove(path)
+        self.server = CommandServer(root)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        self.timeout = IDLE_TIMEOUT
+
+    def config_state(self):
+        state = []
+        for path in self.hgrc_files:
+            try:
+                state.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                state.append(None)
+        return state
+
+    def command_server(self):
+        state = self.config_state()
+        if state != self.hgrc_state or self.server.proc.poll() is not None:
+            self.server.close()
+            self.server = CommandServer(self.root)
+            self.hgrc_state = state
+        return self.server
+
+    def handle_timeout(self):
+        self.idle = True
+
+    def serve(self):
+        try:
+            while not self.idle:
+                self.handle_request()
+        finally:
+            self.server.close()
+            self.server_close()
+            try:
+                os.remove(socket_path(self.root))
+            except OSError:
+                pass
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        if request.get('command') == 'stop':
+            self.server.idle = True
+            return
+
+        def send(channel, payload):
+            self.wfile.write(struct.pack('>cI', channel, len(payload)) + payload)
+
+        try:
+            self.server.command_server().runcommand(request['args'], send)
+        except (EOFError, OSError, RuntimeError) as error:
+            message = ('abort: mq command server failed: %s\n' % error).encode('utf-8')
+            send(b'e', message)
+            send(b'r', struct.pack('>i', 255))
+
+
+def connect(root):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path(root))
+    return client
+
+
+def start_daemon(root):
+    os.makedirs(RUN_DIR, mode=0o700, exist_ok=True)
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.Popen([sys.executable, '-m', 'mqlib.hgserver', 'serve', root], env=env, cwd=root,
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                     start_new_session=True)
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            return connect(root)
+        except OSError:
+            time.sleep(0.02)
+    return None
+
+
+def run(args):
+    """Relay an hg command through the daemon, falling back to plain hg."""
+    root = find_repo_root(os.getcwd())
+    client = None
+    if root:
+        try:
+            client = connect(root)
+        except OSError:
+            client = start_daemon(root)
+    if client is None:
+        os.execvp('hg', ['hg'] + args)
+    client.sendall((json.dumps({'command': 'run', 'args': args}) + '\n').encode('utf-8'))
+    stream = client.makefile('rb')
+    while True:
+        channel, payload = read_message(stream)
+        if channel == b'o':
+            sys.stdout.buffer.write(payload)
+        elif channel == b'e':
+            sys.stderr.buffer.write(payload)
+        elif channel == b'r':
+            sys.stdout.flush()
+            return struct.unpack('>i', payload)[0]
+
+
+def stop():
+    root = find_repo_root(os.getcwd())
+    try:
+        client = connect(root)
+    except (OSError, TypeError):
+        return 0
+    client.sendall((json.dumps({'command': 'stop'}) + '\n').encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'run':
+        sys.exit(run(sys.argv[2:]))
+    elif len(sys.argv) > 2 and sys.argv[1] == 'serve':
+        try:
+            daemon = Daemon(os.path.abspath(sys.argv[2]))
+        except RuntimeError:
+            sys.exit(0)
+        daemon.serve()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'stop':
+        sys.exit(stop())
+    else:
+        print('Usage: python3 -m mqlib.hgserver run|serve|stop [ARGS]')
+        sys.exit(1)
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+#
+# Version history for the patch cache pool.
+#
+# The pool itself stays a directory of plain patch files, as hg, the index and
+# everything else reads them directly. Every version mq writes to it (on pop, import and
+# refresh) is also kept under PATCH_DIR/.history:
+#
+#   objects/AB/ABCDEF...    One zlib compressed object per distinct patch content, named
+#                           by the sha1 of that content. An object holds either the full
+#                           text or a line delta against a full object
+#   log/NAME                One JSON line per version of the patch NAME
+#
+# This makes overwrites recoverable. It does not make the pool smaller: the history is
+# stored on top of the plain files, so every pool write costs a little more disk and I/O,
+# not less. To keep that small, identical content is only ever stored once, whichever
+# patch it belongs to, and every delta is made against the last full object of its patch
+# (recorded in the log) rather than the previous version. Reading any version then takes
+# at most two objects. A new full object is started every MAX_CHAIN versions, or when the
+# delta is no smaller than the full text.
+#
+# Usage:
+#   python3 -m mqlib.history store --patch-dir DIR --action ACTION SRC NAME
+#   python3 -m mqlib.history snapshot --patch-dir DIR --action ACTION NAME [FILE]
+#   python3 -m mqlib.history log --patch-dir DIR NAME
+#   python3 -m mqlib.history restore --patch-dir DIR NAME@N
+#
+
+
+import argparse
+import difflib
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+
+MAX_CHAIN = 16
+
+
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def make_delta(base, data):
+    """Describe data as a list of ops against base: [start, end] copies base lines, a string inserts."""
+    base_lines = base.splitlines(True)
+    lines = data.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, base_lines, lines).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(b''.join(lines[j1:j2]).decode('latin-1'))
+    return ops
+
+
+def apply_delta(base, ops):
+    base_lines = base.splitlines(True)
+    return b''.join(b''.join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op.encode('latin-1')
+                    for op in ops)
+
+
+class PatchHistory():
+
+    def __init__(self, patch_dir):
+        self.root = os.path.join(patch_dir, '.history')
+        self.patch_dir = patch_dir
+        # Content of the full objects read or written by this process, by sha
+        self.full_objects = {}
+
+    def object_path(self, sha):
+        return os.path.join(self.root, 'objects', sha[:2], sha)
+
+    def log_path(self, name):
+        return os.path.join(self.root, 'log', name)
+
+    def read_object(self, sha):
+        """Return (content, sha of the full object it is stored against)."""
+        if sha in self.full_objects:
+            return self.full_objects[sha], sha
+        with open(self.object_path(sha), 'rb') as f:
+            data = zlib.decompress(f.read())
+        kind, sep, body = data.partition(b'\n')
+        kind = kind.split()
+        if kind[0] == b'full':
+            self.full_objects[sha] = body
+            return body, sha
+        base, base_sha = self.read_object(kind[1].decode('ascii'))
+        return apply_delta(base, json.loads(body.decode('utf-8'))), base_sha
+
+    def write_object(self, data, base_sha=None):
+        """Store data, as a delta against the full object base_sha when that is smaller.
+        Return (sha, sha of the full object it is stored against)."""
+        sha = hashlib.sha1(data).hexdigest()
+        if os.path.exists(self.object_path(sha)):
+            return sha, self.read_object(sha)[1]
+        stored = b'full\n' + data
+        if base_sha:
+            base = self.read_object(base_sha)[0]
+            delta = 'delta {}\n'.format(base_sha).encode('ascii') + json.dumps(make_delta(base, data)).encode('utf-8')
+            if len(delta) < len(stored):
+                write_atomic(self.object_path(sha), zlib.compress(delta, 9))
+                return sha, base_sha
+        write_atomic(self.object_path(sha), zlib.compress(stored, 9))
+        self.full_objects[sha] = data
+        return sha, sha
+
+    def versions(self, name):
+        try:
+            with open(self.log_path(name)) as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except (IOError, OSError):
+            return []
+
+    def snapshot(self, name, data, action):
+        """Record data as the next version of name. Return the version, or None if unchanged."""
+        versions = self.versions(name)
+        sha = hashlib.sha1(data).hexdigest()
+        if versions and versions[-1]['object'] == sha:
+            return None
+        base_sha, depth = None, 0
+        if versions and versions[-1].get('depth', MAX_CHAIN) + 1 < MAX_CHAIN:
+            base_sha, depth = versions[-1]['base'], versions[-1]['depth'] + 1
+        sha, stored_base = self.write_object(data, base_sha)
+        entry = {
+            'version': len(versions) + 1,
+            'object': sha,
+            'base': stored_base,
+            'depth': depth if stored_base == base_sha else 0,
+            'action': action,
+            'date': int(time.time()),
+            'size': len(data),
+        }
+        os.makedirs(os.path.dirname(self.log_path(name)), exist_ok=True)
+        with open(self.log_path(name), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        return entry['version']
+
+    def snapshot_pool_file(self, name, action):
+        """Keep whatever is in the pool for name before it is replaced, if we do not have it yet.
+        Return that content, or None if there is no such file."""
+        path = os.path.join(self.patch_dir, name)
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.snapshot(name, data, action)
+        return data
+
+    def replace_pool_file(self, name, data, action):
+        """Write data to the pool as name, keeping both the old and the new content in the history."""
+        if self.snapshot_pool_file(name, 'replaced') != data:
+            write_atomic(os.path.join(self.patch_dir, name), data)
+        return self.snapshot(name, data, action)
+
+    def store(self, src, name, action):
+        """Copy src into the pool as name, keeping both the old and the new content in the history."""
+        with open(src, 'rb') as f:
+            data = f.read()
+        return self.replace_pool_file(name, data, action)
+
+    def read(self, name, version):
+        for entry in self.versions(name):
+            if entry['version'] == version:
+                return self.read_object(entry['object'])[0]
+        raise KeyError('{} has no version {}'.format(name, version))
+
+    def restore(self, name, version):
+        return self.replace_pool_file(name, self.read(name, version), 'restore {}'.format(version))
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq history')
+    parser.add_argument('command', choices=['store', 'snapshot', 'log', 'restore'])
+    parser.add_argument('--patch-dir', dest='patch_dir', required=True)
+    parser.add_argument('--action', dest='action', default='snapshot')
+    parser.add_argument('arguments', nargs='+')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    history = PatchHistory(args.patch_dir)
+    if args.command == 'store':
+        src, name = args.arguments[:2]
+        history.store(src, name, args.action)
+    elif args.command == 'snapshot':
+        name = args.arguments[0]
+        path = args.arguments[1] if len(args.arguments) > 1 else os.path.join(args.patch_dir, name)
+        with open(path, 'rb') as f:
+            history.snapshot(name, f.read(), args.action)
+    elif args.command == 'log':
+        name = args.arguments[0]
+        versions = history.versions(name)
+        if not versions:
+            print("No history found for {}.".format(name))
+            sys.exit(1)
+        for entry in reversed(versions):
+            print("    {}@{:<4} {}  {:<12} {:>9} bytes  {}".format(
+                name, entry['version'], time.strftime('%Y-%m-%d %H:%M', time.localtime(entry['date'])),
+                entry['action'], entry['size'], entry['object'][:12]))
+    elif args.command == 'restore':
+        name, sep, version = args.arguments[0].rpartition('@')
+        try:
+            history.restore(name, int(version))
+        except (KeyError, ValueError):
+            print("abort: unknown version '{}'. See 'mq history {}'.".format(args.arguments[0], name or args.arguments[0]))
+            sys.exit(1)
+        print("Restored {} to version {}.".format(name, version))
+    sys.exit(0)
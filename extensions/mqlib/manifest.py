@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+#
+# Build the command manifest used by 'mq help' and bash completion.
+#
+# The manifest is a directory of small text files that bash can read without starting
+# python or grepping the mq script:
+#
+#   commands            One line per built-in command: NAME<TAB>HELP
+#   extensions          One line per extension: NAME<TAB>SUB-COMMAND SUB-COMMAND...
+#   help-EXTENSION      The help text of an extension
+#
+# Extension metadata is read from the MQ_HELP and MQ_COMMANDS constants at the top of
+# each extension with the ast module, so none of the extensions (or their dependencies)
+# are imported.
+#
+
+
+import argparse
+import ast
+import os
+import re
+import sys
+
+
+COMMAND_RE = re.compile(r'^mq_([a-z]+)\(\)\s*\{\s*(?:#--\s*(.*?))?\s*$')
+
+
+def read_commands(script):
+    commands = []
+    with open(script) as f:
+        for line in f:
+            match = COMMAND_RE.match(line)
+            if match:
+                commands.append((match.group(1), match.group(2) or ''))
+    return commands
+
+
+def read_extension_metadata(path):
+    """Return (help, sub-commands) from an extension without importing it."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), filename=path)
+    metadata = {'MQ_HELP': '', 'MQ_COMMANDS': []}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name) and target.id in metadata:
+                    metadata[target.id] = ast.literal_eval(node.value)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.op, ast.Add):
+            if isinstance(node.target, ast.Name) and node.target.id in metadata:
+                metadata[node.target.id] += ast.literal_eval(node.value)
+    return metadata['MQ_HELP'], metadata['MQ_COMMANDS']
+
+
+def write_file(path, content):
+    with open(path + '.tmp', 'w') as f:
+        f.write(content)
+    os.replace(path + '.tmp', path)
+
+
+def build(script, output):
+    extensions_dir = os.path.join(os.path.dirname(script), 'extensions')
+    os.makedirs(output, exist_ok=True)
+    extensions = []
+    for name in sorted(os.listdir(extensions_dir)):
+        if not name.endswith('.py'):
+            continue
+        name = name[:-3]
+        try:
+            help_text, sub_commands = read_extension_metadata(os.path.join(extensions_dir, name + '.py'))
+        except (SyntaxError, ValueError):
+            help_text, sub_commands = '', []
+        write_file(os.path.join(output, 'help-' + name), help_text.rstrip('\n') + '\n')
+        extensions.append('{}\t{}\n'.format(name, ' '.join(sub_commands)))
+    write_file(os.path.join(output, 'extensions'), ''.join(extensions))
+    # Written last. Its mtime is what mq compares against to decide if the manifest is stale
+    write_file(os.path.join(output, 'commands'),
+               ''.join('{}\t{}\n'.format(name, help_text) for name, help_text in read_commands(script)))
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--script', dest='script', required=True, help='Path to the mq script')
+    parser.add_argument('--output', dest='output', required=True, help='Manifest directory')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    build(os.path.realpath(args.script), args.output)
+    sys.exit(0)
@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+#
+# Local full-text index of Mantis issues for 'mq mantis search'.
+#
+# 'mq mantis sync' stores the summary, description and attachments of each issue here,
+# along with the paths of the files touched by every attached patch. Searches are then
+# answered from SQLite's full-text search (FTS5, or FTS4 on older SQLite builds) without
+# going near the network.
+#
+
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import time
+
+from mqlib.config import MQ_HOME
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS issues (
+    id INTEGER PRIMARY KEY,
+    summary TEXT,
+    description TEXT,
+    updated TEXT,
+    page_hash TEXT,
+    synced INTEGER
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    url TEXT PRIMARY KEY,
+    issue INTEGER,
+    name TEXT,
+    files TEXT
+);
+CREATE INDEX IF NOT EXISTS attachments_issue ON attachments (issue);
+"""
+
+
+class MantisIndex():
+
+    def __init__(self, base_url, index_path=None):
+        if not index_path:
+            key = hashlib.sha1(base_url.encode('utf-8')).hexdigest()[:12]
+            index_path = os.path.join(MQ_HOME, 'cache', 'mantis-{}.sqlite'.format(key))
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.db = sqlite3.connect(index_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        if not self.db.execute("SELECT name FROM sqlite_master WHERE name = 'search'").fetchone():
+            for module in ('fts5', 'fts4'):
+                try:
+                    self.db.execute('CREATE VIRTUAL TABLE search USING {}(issue, summary, description, attachments, files)'
+                                    .format(module))
+                    break
+                except sqlite3.OperationalError:
+                    continue
+
+    def issue(self, issue_id):
+        row = self.db.execute('SELECT summary, description, updated, page_hash FROM issues WHERE id = ?',
+                              (int(issue_id),)).fetchone()
+        if not row:
+            return None
+        return dict(zip(('summary', 'description', 'updated', 'page_hash'), row))
+
+    def issue_ids(self):
+        return [row[0] for row in self.db.execute('SELECT id FROM issues ORDER BY id')]
+
+    def attachment_urls(self):
+        return set(row[0] for row in self.db.execute('SELECT url FROM attachments'))
+
+    def touch(self, issue_id):
+        """Record that an unchanged issue was checked."""
+        with self.db:
+            self.db.execute('UPDATE issues SET synced = ? WHERE id = ?', (int(time.time()), int(issue_id)))
+
+    def store(self, issue_id, summary, description, updated, page_hash, attachments):
+        """Replace everything stored for an issue. attachments is a list of (url, name, files)."""
+        issue_id = int(issue_id)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO issues VALUES (?, ?, ?, ?, ?, ?)',
+                            (issue_id, summary, description, updated, page_hash, int(time.time())))
+            self.db.execute('DELETE FROM attachments WHERE issue = ?', (issue_id,))
+            for url, name, files in attachments:
+                self.db.execute('INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)',
+                                (url, issue_id, name, json.dumps(files)))
+            self.db.execute('DELETE FROM search WHERE issue = ?', (str(issue_id),))
+            self.db.execute('INSERT INTO search (issue, summary, description, attachments, files) VALUES (?, ?, ?, ?, ?)',
+                            (str(issue_id), summary, description, ' '.join(name for url, name, files in attachments),
+                             ' '.join(path for url, name, files in attachments for path in files)))
+
+    def attachment_files(self, url):
+        row = self.db.execute('SELECT files FROM attachments WHERE url = ?', (url,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def search(self, query='', touched='', limit=50):
+        """Return matching issues, newest first, with the attachments that match."""
+        sql = 'SELECT search.issue, issues.summary FROM search JOIN issues ON issues.id = CAST(search.issue AS INTEGER)'
+        where = []
+        params = []
+        if query:
+            # Quote every word so that paths and punctuation are matched literally as phrases
+            terms = ['"{}"'.format(term.replace('"', '""')) for term in query.split()]
+            where.append('search MATCH ?')
+            params.append(' '.join(terms))
+        if touched:
+            # files holds a JSON list, so look for the path the way JSON writes it. instr() has
+            # no wildcards, unlike LIKE where '_' and '%' in a path would match anything
+            where.append('CAST(search.issue AS INTEGER) IN (SELECT issue FROM attachments WHERE instr(files, ?) > 0)')
+            params.append(json.dumps(touched)[1:-1])
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY CAST(search.issue AS INTEGER) DESC LIMIT ?'
+        params.append(limit)
+        results = []
+        for issue_id, summary in self.db.execute(sql, params).fetchall():
+            attachments = []
+            for name, files in self.db.execute('SELECT name, files FROM attachments WHERE issue = ? ORDER BY name',
+                                               (int(issue_id),)):
+                files = json.loads(files)
+                if touched:
+                    files = [path for path in files if touched in path]
+                    if not files:
+                        continue
+                attachments.append({'name': name, 'files': files})
+            results.append({'issue': int(issue_id), 'summary': summary, 'attachments': attachments})
+        return results
+
+
+def parse_issue_range(values):
+    """Expand '100-120' style ranges and plain ids into a sorted list of issue ids."""
+    issues = set()
+    for value in values:
+        match = re.match(r'^(\d+)-(\d+)$', value)
+        if match:
+            first, last = sorted((int(match.group(1)), int(match.group(2))))
+            issues.update(range(first, last + 1))
+        elif value.isdigit():
+            issues.add(int(value))
+        else:
+            raise ValueError('Not an issue number or range: {}'.format(value))
+    return sorted(issues)
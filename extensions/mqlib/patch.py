@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+#
+# Helpers for reading unified/git diffs as exported by hg.
+#
+
+
+import difflib
+import re
+
+
+HUNK_RE = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+
+class FilePatch():
+    """Changes made to a single file by a patch."""
+
+    def __init__(self, header):
+        self.header = [header]
+        self.old_path = None
+        self.new_path = None
+        self.hunks = []
+        self.hunk_count = 0
+        self.added = 0
+        self.removed = 0
+        self.binary = False
+        if header.startswith('diff --git '):
+            match = re.match(r'^diff --git a/(.*) b/(.*)$', header.rstrip('\n'))
+            if match:
+                self.old_path, self.new_path = match.groups()
+
+    @property
+    def path(self):
+        if self.new_path and self.new_path != '/dev/null':
+            return self.new_path
+        return self.old_path
+
+    def set_path(self, line):
+        path = line[4:].rstrip('\n').split('\t')[0]
+        if path != '/dev/null' and path[:2] in ('a/', 'b/'):
+            path = path[2:]
+        if line.startswith('---'):
+            self.old_path = path
+        else:
+            self.new_path = path
+
+
+def parse_hunk_header(line):
+    match = HUNK_RE.match(line)
+    if not match:
+        return None
+    old_start, old_len, new_start, new_len = match.groups()
+    return (int(old_start), 1 if old_len is None else int(old_len),
+            int(new_start), 1 if new_len is None else int(new_len))
+
+
+def iter_file_patches(lines, keep_hunks=True):
+    """Parse an iterable of diff lines, yielding one FilePatch per file.
+
+    Only the file currently being read is held in memory. Each hunk is stored as a
+    (header, lines) tuple when keep_hunks is set.
+    """
+    current = None
+    lines = iter(lines)
+    for line in lines:
+        if line.startswith('diff '):
+            if current:
+                yield current
+            current = FilePatch(line)
+        elif current is None:
+            continue
+        elif line.startswith('--- ') or line.startswith('+++ '):
+            current.header.append(line)
+            current.set_path(line)
+        elif line.startswith('@@'):
+            ranges = parse_hunk_header(line)
+            if ranges is None:
+                raise ValueError('Malformed hunk header: %r' % line)
+            old_left, new_left = ranges[1], ranges[3]
+            current.hunk_count += 1
+            body = []
+            while old_left > 0 or new_left > 0:
+                try:
+                    hunk_line = next(lines)
+                except StopIteration:
+                    raise ValueError('Truncated hunk in %s' % current.path)
+                if hunk_line.startswith('+'):
+                    new_left -= 1
+                    current.added += 1
+                elif hunk_line.startswith('-'):
+                    old_left -= 1
+                    current.removed += 1
+                elif hunk_line.startswith(' ') or hunk_line in ('\n', ''):
+                    old_left -= 1
+                    new_left -= 1
+                elif hunk_line.startswith('\\'):
+                    pass
+                else:
+                    raise ValueError('Unexpected line in hunk for %s: %r' % (current.path, hunk_line))
+                if keep_hunks:
+                    body.append(hunk_line)
+            if keep_hunks:
+                current.hunks.append((line, body))
+        elif line.startswith('\\'):
+            # "\ No newline at end of file" after the last line of a hunk
+            if keep_hunks and current.hunks:
+                current.hunks[-1][1].append(line)
+        else:
+            if line.startswith('Binary files') or line.startswith('GIT binary patch'):
+                current.binary = True
+            current.header.append(line)
+    if current:
+        yield current
+
+
+def read_header(lines):
+    """Return the author, date and message from an hg/git style patch header."""
+    header = {'user': '', 'date': '', 'message': []}
+    for line in lines:
+        if line.startswith('diff '):
+            break
+        if line.startswith('# User '):
+            header['user'] = line[7:].strip()
+        elif line.startswith('From: '):
+            header['user'] = line[6:].strip()
+        elif line.startswith('# Date '):
+            header['date'] = line[7:].strip()
+        elif line.startswith('Date: '):
+            header['date'] = line[6:].strip()
+        elif not line.startswith('#'):
+            header['message'].append(line.rstrip('\n'))
+    header['message'] = '\n'.join(header['message']).strip()
+    return header
+
+
+def diffstat(lines):
+    """Return a list of (path, added, removed, binary) for every file in a diff."""
+    return [(fp.path, fp.added, fp.removed, fp.binary) for fp in iter_file_patches(lines, keep_hunks=False)]
+
+
+
+def format_diffstat(stats, width=60):
+    """Format stats from diffstat() in the style of the diffstat tool."""
+    if not stats:
+        return []
+    name_width = max(len(path) for path, added, removed, binary in stats)
+    most = max(added + removed for path, added, removed, binary in stats) or 1
+    scale = min(1.0, float(width) / most)
+    output = []
+    for path, added, removed, binary in stats:
+        if binary:
+            output.append(' {} | Bin'.format(path.ljust(name_width)))
+            continue
+        graph = '+' * int(round(added * scale)) + '-' * int(round(removed * scale))
+        output.append(' {} | {:>4} {}'.format(path.ljust(name_width), added + removed, graph))
+    total_added = sum(stat[1] for stat in stats)
+    total_removed = sum(stat[2] for stat in stats)
+    output.append(' {} file{} changed, {} insertion{}(+), {} deletion{}(-)'.format(
+        len(stats), '' if len(stats) == 1 else 's',
+        total_added, '' if total_added == 1 else 's',
+        total_removed, '' if total_removed == 1 else 's'))
+    return output
+
+
+def validate_diff(text, content_type=None, allow_empty=False):
+    """Check that text is a complete unified/git diff. Raise ValueError if it is not.
+
+    Catches the usual ways a fetched diff goes wrong: an HTML error or login page instead
+    of a diff, an empty body or a diff truncated part way through a hunk. A diff without
+    any files is only valid if allow_empty is set (the caller knows the changeset is empty)
+    or its own header shows a merge. Return the number of files.
+    """
+    head = text.lstrip()[:512].lower()
+    if (content_type or '').lower().startswith('text/html') or head.startswith('<!doctype') or head.startswith('<html'):
+        raise ValueError('Response is an HTML page, not a diff')
+    files = 0
+    for file_patch in iter_file_patches(text.splitlines(True), keep_hunks=False):
+        files += 1
+        if not file_patch.hunk_count and not file_patch.binary and not is_metadata_only(file_patch):
+            raise ValueError('No hunks found for %s' % file_patch.path)
+    if not files and not allow_empty and sum(1 for line in text.splitlines() if line.startswith('# Parent ')) < 2:
+        raise ValueError('Empty diff')
+    return files
+
+
+def is_metadata_only(file_patch):
+    """True for git diffs that only rename, copy, change the mode or add/remove an empty file."""
+    return any(line.startswith(prefix) for line in file_patch.header
+               for prefix in ('rename ', 'copy ', 'old mode', 'new mode', 'new file mode', 'deleted file mode',
+                              'similarity index'))
+
+
+def hunk_ranges(header):
+    """Return the (old_start, old_len, new_start, new_len) of a hunk as half-open ranges.
+
+    Unified diff gives an empty range the number of the line *before* it, so shift those
+    by one to make every range [start, start + len).
+    """
+    old_start, old_len, new_start, new_len = parse_hunk_header(header)
+    if not old_len:
+        old_start += 1
+    if not new_len:
+        new_start += 1
+    return old_start, old_len, new_start, new_len
+
+
+def side(body, tags):
+    """Return the lines of one side of a hunk body. tags is ' -' for old, ' +' for new."""
+    # A bare newline is a context line whose leading space was stripped in transit
+    return [line if line == '\n' else line[1:] for line in body if line[:1] in tags or line == '\n']
+
+
+def format_hunk_header(old_start, old_len, new_start, new_len):
+    if not old_len:
+        old_start -= 1
+    if not new_len:
+        new_start -= 1
+    return '@@ -{},{} +{},{} @@\n'.format(old_start, old_len, new_start, new_len)
+
+
+def make_hunks(old_lines, new_lines, context=3, old_start=1, new_start=1):
+    """Diff two lists of lines into (header, body) hunks.
+
+    old_start and new_start are the line numbers of the first line of each list, for
+    diffing part of a file.
+    """
+    def prefixed(prefix, lines):
+        for line in lines:
+            if line.endswith('\n'):
+                yield prefix + line
+            else:
+                yield prefix + line + '\n'
+                yield '\\ No newline at end of file\n'
+
+    hunks = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for group in matcher.get_grouped_opcodes(context):
+        i1, i2, j1, j2 = group[0][1], group[-1][2], group[0][3], group[-1][4]
+        body = []
+        for tag, a1, a2, b1, b2 in group:
+            if tag == 'equal':
+                body.extend(prefixed(' ', old_lines[a1:a2]))
+                continue
+            body.extend(prefixed('-', old_lines[a1:a2]))
+            body.extend(prefixed('+', new_lines[b1:b2]))
+        hunks.append((format_hunk_header(old_start + i1, i2 - i1, new_start + j1, j2 - j1), body))
+    return hunks
+
+
+def compose_hunks(first, second, context=3):
+    """Compose two lists of hunks (base->mid, mid->final) into one list (base->final).
+
+    The regions touched by either diff are merged into windows over the intermediate
+    file. Inside a window every base, intermediate and final line is known from the hunk
+    bodies, so the net change can be diffed again directly. Raises ValueError if the
+    diffs do not chain (the second does not apply to the result of the first).
+    """
+    first = [(hunk_ranges(header), body) for header, body in first]
+    second = [(hunk_ranges(header), body) for header, body in second]
+    # Intervals in intermediate ('mid') coordinates
+    intervals = sorted([(r[2], r[2] + r[3]) for r, body in first] + [(r[0], r[0] + r[1]) for r, body in second])
+    windows = []
+    for start, end in intervals:
+        if windows and start <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+
+    mid = {}
+    for (old_start, old_len, new_start, new_len), body in first:
+        for offset, line in enumerate(side(body, ' +')):
+            mid[new_start + offset] = line
+    for (old_start, old_len, new_start, new_len), body in second:
+        for offset, line in enumerate(side(body, ' -')):
+            if mid.setdefault(old_start + offset, line) != line:
+                raise ValueError('Diffs do not apply on top of each other at line %d' % (old_start + offset))
+
+    def rebuild(hunks, start, end, mid_side, other_side):
+        """Walk mid lines start..end, replacing each hunk's mid side with its other side."""
+        by_start = dict((r[mid_side], (r, body)) for r, body in hunks if start <= r[mid_side] <= end)
+        lines = []
+        position = start
+        while position < end or position in by_start:
+            if position in by_start:
+                r, body = by_start.pop(position)
+                lines.extend(side(body, other_side))
+                position += r[mid_side + 1]
+                continue
+            if position not in mid:
+                raise ValueError('Missing context for line %d' % position)
+            lines.append(mid[position])
+            position += 1
+        return lines
+
+    result = []
+    delta_first = delta_second = 0
+    for start, end in windows:
+        base_lines = rebuild(first, start, end, 2, ' -')
+        final_lines = rebuild(second, start, end, 0, ' +')
+        result.extend(make_hunks(base_lines, final_lines, context, start - delta_first, start + delta_second))
+        delta_first += sum(r[3] - r[1] for r, body in first if start <= r[2] <= end)
+        delta_second += sum(r[3] - r[1] for r, body in second if start <= r[0] <= end)
+        # Hunks from windows we have passed no longer need to be considered
+        first = [(r, body) for r, body in first if r[2] > end]
+        second = [(r, body) for r, body in second if r[0] > end]
+    return result
+
+
+def can_fold(first, second):
+    """True if second can be folded into first as plain text changes to the same file."""
+    if first.binary or second.binary or first.path != second.path or second.old_path != second.path:
+        return False
+    for file_patch in (first, second):
+        for body in (body for header, body in file_patch.hunks):
+            if any(line.startswith('\\') for line in body):
+                return False
+    blocked = ('rename ', 'copy ', 'old mode', 'new mode', 'deleted file mode')
+    if any(line.startswith(prefix) for line in first.header for prefix in blocked):
+        return False
+    blocked += ('new file mode',)
+    return not any(line.startswith(prefix) for line in second.header for prefix in blocked)
+
+
+class DiffFolder():
+    """Fold a sequence of diffs into one net diff per file where it is safe to do so."""
+
+    def __init__(self):
+        self.entries = []
+        self.last_index = {}
+
+    def add(self, file_patch):
+        index = self.last_index.get(file_patch.path)
+        if index is not None and can_fold(self.entries[index], file_patch):
+            existing = self.entries[index]
+            try:
+                hunks = compose_hunks(existing.hunks, file_patch.hunks)
+            except ValueError:
+                hunks = None
+            if hunks is not None:
+                existing.hunks = hunks
+                existing.added = sum(1 for header, body in hunks for line in body if line.startswith('+'))
+                existing.removed = sum(1 for header, body in hunks for line in body if line.startswith('-'))
+                existing.hunk_count = len(hunks)
+                return
+        self.entries.append(file_patch)
+        for path in (file_patch.old_path, file_patch.new_path):
+            if path and path != '/dev/null':
+                self.last_index[path] = len(self.entries) - 1
+
+    def lines(self):
+        for file_patch in self.entries:
+            for line in file_patch.header:
+                yield line
+            for header, body in file_patch.hunks:
+                yield header
+                for line in body:
+                    yield line
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+#
+# Index of the shared patch cache pool.
+#
+# The pool can hold thousands of patches for many projects. Rather than listing and
+# filtering the whole directory in bash, mq keeps a small SQLite index (under ~/.mq so
+# that it never sits on a shared NFS pool) which is refreshed incrementally by comparing
+# each file's mtime and size with what was last indexed.
+#
+
+
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from mqlib.config import MQ_HOME
+from mqlib import patch
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS patches (
+    name TEXT PRIMARY KEY,
+    project TEXT,
+    mtime INTEGER,
+    size INTEGER,
+    author TEXT,
+    date TEXT,
+    files TEXT,
+    insertions INTEGER,
+    deletions INTEGER,
+    diffstat TEXT
+);
+CREATE INDEX IF NOT EXISTS patches_project ON patches (project);
+"""
+
+SORT_KEYS = {
+    'name': 'name',
+    'age': 'mtime DESC',
+    'author': 'author COLLATE NOCASE, name',
+    'size': 'size DESC',
+}
+
+
+def patch_project(name):
+    """Same rule as mq: the project is everything after the last '_' of the patch name."""
+    return name.rsplit('_', 1)[-1]
+
+
+class PatchIndex():
+
+    def __init__(self, patch_dir, index_path=None):
+        self.patch_dir = os.path.abspath(patch_dir)
+        if not index_path:
+            key = hashlib.sha1(self.patch_dir.encode('utf-8')).hexdigest()[:12]
+            index_path = os.path.join(MQ_HOME, 'cache', 'patchindex-{}.sqlite'.format(key))
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        self.db = sqlite3.connect(index_path)
+        self.db.executescript(SCHEMA)
+
+    def scan_patch(self, path):
+        with open(path, errors='replace') as f:
+            header = patch.read_header(f)
+            f.seek(0)
+            try:
+                stats = patch.diffstat(f)
+            except ValueError:
+                stats = []
+        return {
+            'author': header['user'],
+            'date': header['date'],
+            'files': [stat[0] for stat in stats],
+            'insertions': sum(stat[1] for stat in stats),
+            'deletions': sum(stat[2] for stat in stats),
+            'diffstat': stats,
+        }
+
+    def sync(self):
+        """Bring the index up to date with the pool. Only new or modified patches are parsed."""
+        indexed = dict((row[0], (row[1], row[2])) for row in self.db.execute('SELECT name, mtime, size FROM patches'))
+        present = set()
+        with self.db:
+            for entry in os.scandir(self.patch_dir):
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                present.add(entry.name)
+                st = entry.stat()
+                if indexed.get(entry.name) == (st.st_mtime_ns, st.st_size):
+                    continue
+                info = self.scan_patch(entry.path)
+                self.db.execute(
+                    'INSERT OR REPLACE INTO patches VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (entry.name, patch_project(entry.name), st.st_mtime_ns, st.st_size, info['author'],
+                     info['date'], json.dumps(info['files']), info['insertions'], info['deletions'],
+                     json.dumps(info['diffstat'])))
+            for name in set(indexed) - present:
+                self.db.execute('DELETE FROM patches WHERE name = ?', (name,))
+
+    def query(self, project=None, touched=None, author=None, sort='name', reverse=False):
+        sql = 'SELECT name, project, mtime, size, author, date, files, insertions, deletions FROM patches'
+        params = []
+        if project:
+            sql += ' WHERE project = ?'
+            params.append(project)
+        sql += ' ORDER BY ' + SORT_KEYS.get(sort, 'name')
+        rows = []
+        for row in self.db.execute(sql, params):
+            entry = dict(zip(('name', 'project', 'mtime', 'size', 'author', 'date', 'files', 'insertions', 'deletions'), row))
+            entry['files'] = json.loads(entry['files'])
+            if author and author.lower() not in entry['author'].lower():
+                continue
+            if touched and not any(fnmatch.fnmatch(f, touched) or touched in f for f in entry['files']):
+                continue
+            rows.append(entry)
+        if reverse:
+            rows.reverse()
+        return rows
+
+
+def format_age(mtime_ns):
+    seconds = max(0, time.time() - mtime_ns / 1e9)
+    for unit, size in (('d', 86400), ('h', 3600), ('m', 60)):
+        if seconds >= size:
+            return '{}{}'.format(int(seconds // size), unit)
+    return '{}s'.format(int(seconds))
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq list')
+    parser.add_argument('command', choices=['list', 'sync'])
+    parser.add_argument('--patch-dir', dest='patch_dir', required=True)
+    parser.add_argument('--project', dest='project', default='')
+    parser.add_argument('--file', dest='touched', default='', help='Only patches touching files matching this path or glob')
+    parser.add_argument('--author', dest='author', default='', help='Only patches by this author')
+    parser.add_argument('--sort', dest='sort', choices=sorted(SORT_KEYS), default='name')
+    parser.add_argument('--reverse', dest='reverse', action='store_true', default=False)
+    parser.add_argument('--long', dest='long', action='store_true', default=False, help='Show author, age and diffstat')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    index = PatchIndex(args.patch_dir)
+    index.sync()
+    if args.command == 'list':
+        entries = index.query(args.project, args.touched, args.author, args.sort, args.reverse)
+        name_width = max([len(entry['name']) for entry in entries] or [0])
+        author_width = max([len(entry['author']) for entry in entries] or [1])
+        for entry in entries:
+            if args.long:
+                print('{}  {}  {:>4}  {} files +{} -{}'.format(
+                    entry['name'].ljust(name_width), (entry['author'] or '-').ljust(author_width),
+                    format_age(entry['mtime']), len(entry['files']), entry['insertions'], entry['deletions']))
+            else:
+                print(entry['name'])
+    sys.exit(0)
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+#
+
+
+import filecmp
+import os
+import shutil
+import subprocess
+
+from mqlib import trace
+from mqlib.config import MQ_HOME
+from mqlib.history import PatchHistory
+
+
+def hg(*args, cwd=None):
+    """Run an hg command and return its output. Return None if it fails."""
+    with trace.span('hg', ' '.join(('hg',) + args), cwd=cwd or os.getcwd()) as trace_args:
+        try:
+            output = subprocess.check_output(['hg'] + list(args), cwd=cwd, stderr=subprocess.DEVNULL,
+                                             universal_newlines=True)
+        except (OSError, subprocess.CalledProcessError) as error:
+            trace_args['status'] = getattr(error, 'returncode', 255)
+            return None
+        trace_args['status'] = 0
+        trace_args['bytes_received'] = len(output)
+        return output
+
+
+def hg_config(cwd=None):
+    """Read every hg config value with a single 'hg config' call."""
+    config = {}
+    for line in (hg('config', cwd=cwd) or "").splitlines():
+        key, sep, value = line.partition('=')
+        if sep:
+            config[key] = value
+    return config
+
+
+def expand_path(value):
+    return os.path.expandvars(os.path.expanduser(value))
+
+
+def working_project(cwd=None):
+    """Same rules as the 'working_project' function in mq: the basename of the repo remote."""
+    remote = (hg('paths', cwd=cwd) or "").strip()
+    return remote.rstrip('/').split('/')[-1]
+
+
+class PatchPool():
+    """The shared patch cache pool (mq.patch_dir) seen from the current project."""
+
+    def __init__(self, cwd=None, config=None, project=None):
+        self.config = config if config is not None else hg_config(cwd)
+        self.patch_dir = expand_path(self.config.get('mq.patch_dir', '')) or os.path.join(MQ_HOME, 'patches')
+        self.naming = expand_path(self.config.get('mq.patch_naming', '')) or '%s'
+        self.project = project if project is not None else working_project(cwd)
+        os.makedirs(self.patch_dir, exist_ok=True)
+
+    def patch_name(self, name):
+        return "{}_{}".format(self.naming.replace('%s', str(name)), self.project)
+
+    def patch_path(self, name):
+        return os.path.join(self.patch_dir, self.patch_name(name))
+
+    def import_patch(self, src, name, overwrite=False):
+        """Copy a patch file into the pool. Return one of 'imported', 'unchanged' or 'exists'."""
+        dest = self.patch_path(name)
+        if os.path.exists(dest) and os.path.getsize(dest):
+            if filecmp.cmp(src, dest, shallow=False):
+                return 'unchanged'
+            if not overwrite:
+                return 'exists'
+        PatchHistory(self.patch_dir).store(src, os.path.basename(dest), 'import')
+        return 'imported'
+
+    def link_patch(self, src, name, overwrite=False):
+        """Store a pool file that is already in the pool under another name too, as a hard
+        link where possible. Return one of 'linked', 'unchanged' or 'exists'."""
+        dest = self.patch_path(name)
+        if os.path.exists(dest) and os.path.getsize(dest):
+            if filecmp.cmp(src, dest, shallow=False):
+                return 'unchanged'
+            if not overwrite:
+                return 'exists'
+        history = PatchHistory(self.patch_dir)
+        history.snapshot_pool_file(os.path.basename(dest), 'replaced')
+        tmp_path = dest + '.link'
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            shutil.copyfile(src, tmp_path)
+        # Pool files are only ever replaced (never written in place), so sharing the inode is safe
+        os.replace(tmp_path, dest)
+        with open(dest, 'rb') as f:
+            history.snapshot(os.path.basename(dest), f.read(), 'import')
+        return 'linked'
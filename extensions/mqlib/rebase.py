@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+#
+# Rebase a patch file onto another revision without touching the working copy.
+#
+# Only the files the patch touches are read, with 'hg cat', at the patch's parent and at
+# the destination. The patch is applied to the parent versions and the result is merged
+# (three-way, in memory) with the destination versions. If every file merges cleanly the
+# patch file is rewritten against the destination. Otherwise nothing is changed and the
+# exit status tells mq to fall back to rebasing in the working copy.
+#
+# Usage:
+#   python3 -m mqlib.rebase [--dest REV] PATCH_FILE
+#
+
+
+import argparse
+import difflib
+import os
+import shutil
+import sys
+import tempfile
+
+from mqlib import patch
+from mqlib.check import export_files
+from mqlib.hgserver import find_repo_root
+from mqlib.pool import hg
+from mqlib.wiggle import apply_hunks
+
+
+class RebaseConflict(Exception):
+    pass
+
+
+def find_sync_regions(base, ours, theirs):
+    """Return the regions where base, ours and theirs all match.
+
+    Each region is (base_start, base_end, ours_start, ours_end, theirs_start, theirs_end)
+    and the last one is always the empty region at the end of all three.
+    """
+    ours_matches = difflib.SequenceMatcher(None, base, ours, autojunk=False).get_matching_blocks()
+    theirs_matches = difflib.SequenceMatcher(None, base, theirs, autojunk=False).get_matching_blocks()
+    regions = []
+    ia = ib = 0
+    while ia < len(ours_matches) and ib < len(theirs_matches):
+        a_base, a_match, a_len = ours_matches[ia]
+        b_base, b_match, b_len = theirs_matches[ib]
+        start = max(a_base, b_base)
+        end = min(a_base + a_len, b_base + b_len)
+        if start < end:
+            a_start = a_match + start - a_base
+            b_start = b_match + start - b_base
+            regions.append((start, end, a_start, a_start + end - start, b_start, b_start + end - start))
+        if a_base + a_len < b_base + b_len:
+            ia += 1
+        else:
+            ib += 1
+    regions.append((len(base), len(base), len(ours), len(ours), len(theirs), len(theirs)))
+    return regions
+
+
+def merge3(base, ours, theirs):
+    """Three-way merge of lists of lines. Return (lines, conflicts)."""
+    merged = []
+    conflicts = 0
+    iz = ia = ib = 0
+    for z_start, z_end, a_start, a_end, b_start, b_end in find_sync_regions(base, ours, theirs):
+        base_part, ours_part, theirs_part = base[iz:z_start], ours[ia:a_start], theirs[ib:b_start]
+        if ours_part == theirs_part:
+            merged.extend(ours_part)
+        elif base_part == ours_part:
+            merged.extend(theirs_part)
+        elif base_part == theirs_part:
+            merged.extend(ours_part)
+        else:
+            conflicts += 1
+        merged.extend(base[z_start:z_end])
+        iz, ia, ib = z_end, a_end, b_end
+    return merged, conflicts
+
+
+def read_lines(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, errors='surrogateescape') as f:
+        return f.readlines()
+
+
+def rebase_file(file_patch, base, tip):
+    """Return the hunks of file_patch rebased from base onto tip (lists of lines or None).
+
+    Only changes to the lines of a text file can be rebased. Binary files, renames, copies
+    and mode changes raise RebaseConflict, so that mq rebases the patch with hg instead.
+    """
+    if file_patch.binary:
+        raise RebaseConflict('{} is binary'.format(file_patch.path))
+    if file_patch.old_path != file_patch.new_path and '/dev/null' not in (file_patch.old_path, file_patch.new_path) \
+            or any(line.startswith(prefix) for line in file_patch.header
+                   for prefix in ('rename ', 'copy ', 'old mode', 'new mode')):
+        raise RebaseConflict('{} is renamed, copied or changes mode'.format(file_patch.path))
+    # Git diffs of empty files have no ---/+++ lines, only the file mode line
+    if file_patch.old_path == '/dev/null' or any(line.startswith('new file mode') for line in file_patch.header):
+        # Added by the patch
+        if tip is not None:
+            raise RebaseConflict('{} has also been added upstream'.format(file_patch.path))
+        return file_patch.hunks
+    if base is None or tip is None:
+        raise RebaseConflict('{} is missing at the parent or destination'.format(file_patch.path))
+    patched, failed = apply_hunks(base, file_patch.hunks, max_fuzz=0)
+    if failed:
+        raise RebaseConflict('{} does not apply to its own parent'.format(file_patch.path))
+    if file_patch.new_path == '/dev/null' or any(line.startswith('deleted file mode') for line in file_patch.header):
+        # Removed by the patch
+        if tip != base:
+            raise RebaseConflict('{} is removed by the patch but changed upstream'.format(file_patch.path))
+        return file_patch.hunks
+    merged, conflicts = merge3(base, patched, tip)
+    if conflicts:
+        raise RebaseConflict('{} has {} conflicting change{}'.format(
+            file_patch.path, conflicts, '' if conflicts == 1 else 's'))
+    return patch.make_hunks(tip, merged)
+
+
+def rebase_patch(root, patch_file, dest='tip'):
+    """Rewrite patch_file so that it applies to dest. Raise RebaseConflict if it cannot."""
+    with open(patch_file, errors='surrogateescape') as f:
+        lines = f.readlines()
+    header = []
+    for line in lines:
+        if line.startswith('diff '):
+            break
+        header.append(line)
+    parent = next((line.split()[2] for line in header if line.startswith('# Parent ') and len(line.split()) > 2), None)
+    if not parent:
+        raise RebaseConflict('The patch has no "# Parent" header')
+    dest_node = (hg('log', '-r', dest, '--template', '{node}', cwd=root) or '').strip()
+    parent_node = (hg('log', '-r', parent, '--template', '{node}', cwd=root) or '').strip()
+    if not dest_node or not parent_node:
+        raise RebaseConflict('Unable to find revision {}'.format(dest if not dest_node else parent))
+    if parent_node == dest_node:
+        return False
+    file_patches = list(patch.iter_file_patches(lines[len(header):]))
+    touched = set()
+    for file_patch in file_patches:
+        touched.update(path for path in (file_patch.old_path, file_patch.new_path) if path and path != '/dev/null')
+    work = tempfile.mkdtemp(prefix='mq-rebase-')
+    try:
+        export_files(root, parent_node, touched, os.path.join(work, 'base'))
+        export_files(root, dest_node, touched, os.path.join(work, 'dest'))
+        output = []
+        for line in header:
+            output.append('# Parent  {}\n'.format(dest_node) if line.startswith('# Parent ') else line)
+        for file_patch in file_patches:
+            # An added file only exists at the destination, under its new path
+            base = None if file_patch.old_path == '/dev/null' else read_lines(os.path.join(work, 'base', file_patch.old_path))
+            hunks = rebase_file(file_patch, base, read_lines(os.path.join(work, 'dest', file_patch.path)))
+            if file_patch.hunks and not hunks:
+                # Already made upstream
+                continue
+            output.extend(file_patch.header)
+            for hunk_header, body in hunks:
+                output.append(hunk_header)
+                output.extend(body)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    with open(patch_file + '.rebase', 'w', errors='surrogateescape') as f:
+        f.writelines(output)
+    os.replace(patch_file + '.rebase', patch_file)
+    return True
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq rebase')
+    parser.add_argument('--dest', dest='dest', default='tip', help='Revision to rebase onto (default: tip)')
+    parser.add_argument('patch_file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    root = find_repo_root(os.getcwd())
+    if not root:
+        print("abort: no repository found in '{}' (.hg not found)!".format(os.getcwd()))
+        sys.exit(2)
+    try:
+        if rebase_patch(root, os.path.abspath(args.patch_file), args.dest):
+            print("Rebased {} onto {} in memory.".format(os.path.basename(args.patch_file), args.dest))
+        else:
+            print("{} is already based on {}.".format(os.path.basename(args.patch_file), args.dest))
+    except (RebaseConflict, ValueError) as error:
+        print("Unable to rebase in memory: {}".format(error))
+        print("Falling back to rebasing in the working copy...")
+        sys.exit(1)
+    sys.exit(0)
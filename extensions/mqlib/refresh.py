@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+#
+# Stat cache for incremental 'mq commit' and 'mq diff'.
+#
+# A plain 'hg qrefresh' or 'hg qdiff' walks and diffs the whole working copy. After each
+# refresh we record the size and mtime of every tracked file in .hg/patches/.mq-statcache,
+# along with the node and patch file of the applied patch and the dirstate. The next
+# incremental refresh only has to stat the files (no hg call) to know which ones changed.
+# 'hg qrefresh --short' is then given just those (it adds the files already in the patch
+# itself) and 'hg qdiff' the files in the patch plus those, so hg never walks the tree.
+#
+# The cache is only trusted while the top applied patch is still the one it was written
+# for and the dirstate has not been written since. Anything else (a patch pushed or
+# popped, a plain 'hg qrefresh', files added, removed, copied or renamed) makes 'files'
+# exit with 1 so that mq falls back to a full refresh.
+#
+# Usage:
+#   python3 -m mqlib.refresh files [--changed]
+#   python3 -m mqlib.refresh update [--full] [FILE...]
+#   python3 -m mqlib.refresh invalidate
+#
+
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from mqlib import patch
+from mqlib.hgserver import find_repo_root
+from mqlib.pool import hg
+
+
+CACHE_NAME = '.mq-statcache'
+CACHE_VERSION = 1
+# Files written this close to the cache itself may change again within the same mtime
+UNSURE_NS = 2 * 1000000000
+
+
+class InvalidCache(Exception):
+    pass
+
+
+def file_stat(path):
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+class StatCache():
+
+    def __init__(self, root):
+        self.root = root
+        self.patch_dir = os.path.join(root, '.hg', 'patches')
+        self.path = os.path.join(self.patch_dir, CACHE_NAME)
+        self.dirstate = os.path.join(root, '.hg', 'dirstate')
+
+    def applied_patch(self):
+        """Return (node, name) of the top applied patch, read from the mq status file."""
+        try:
+            with open(os.path.join(self.patch_dir, 'status')) as f:
+                lines = [line.strip() for line in f if line.strip()]
+        except (IOError, OSError):
+            return None, None
+        if not lines:
+            return None, None
+        node, sep, name = lines[-1].partition(':')
+        return node, name
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            raise InvalidCache('no stat cache')
+        node, name = self.applied_patch()
+        if cache.get('version') != CACHE_VERSION:
+            raise InvalidCache('stat cache from another version')
+        if not node or cache.get('node') != node or cache.get('patch') != name:
+            raise InvalidCache('applied patch changed')
+        if cache.get('patch_stat') != file_stat(os.path.join(self.patch_dir, name)):
+            raise InvalidCache('patch file changed')
+        if cache.get('dirstate_stat') != file_stat(self.dirstate):
+            # Files may have been added, removed, copied or renamed with hg
+            raise InvalidCache('dirstate changed')
+        return cache
+
+    def patch_files(self, name):
+        with open(os.path.join(self.patch_dir, name), errors='surrogateescape') as f:
+            lines = f.readlines()
+        files = set()
+        for file_patch in patch.iter_file_patches(lines, keep_hunks=False):
+            files.update(path for path in (file_patch.old_path, file_patch.new_path) if path and path != '/dev/null')
+        return files
+
+    def changed_files(self, cache):
+        """Return the tracked files whose size or mtime differ from the cache."""
+        changed = set(cache.get('unsure', []))
+        for path, stat in cache['files'].items():
+            if file_stat(os.path.join(self.root, path)) != stat:
+                changed.add(path)
+        return changed
+
+    def files(self, changed_only=False):
+        """Return the files changed since the last refresh, plus those in the patch unless changed_only is set."""
+        cache = self.load()
+        files = self.changed_files(cache)
+        if not changed_only:
+            files |= self.patch_files(cache['patch'])
+        return sorted(files)
+
+    def update(self, paths=None):
+        """Write the cache for the patch that is now applied.
+
+        With paths only those files are stat'ed again and every other entry is kept,
+        otherwise the list of tracked files is read from hg.
+        """
+        node, name = self.applied_patch()
+        if not node:
+            self.invalidate()
+            return False
+        if paths is None:
+            output = hg('files', cwd=self.root)
+            if output is None:
+                self.invalidate()
+                return False
+            files = {}
+            paths = output.splitlines()
+        else:
+            try:
+                with open(self.path) as f:
+                    files = json.load(f)['files']
+            except (IOError, OSError, ValueError, KeyError):
+                self.invalidate()
+                return False
+        written = time.time_ns()
+        unsure = []
+        for path in paths:
+            stat = file_stat(os.path.join(self.root, path))
+            if stat is None:
+                files.pop(path, None)
+                continue
+            files[path] = stat
+            if stat[0] >= written - UNSURE_NS:
+                unsure.append(path)
+        cache = {
+            'version': CACHE_VERSION,
+            'node': node,
+            'patch': name,
+            'patch_stat': file_stat(os.path.join(self.patch_dir, name)),
+            'dirstate_stat': file_stat(self.dirstate),
+            'unsure': unsure,
+            'files': files,
+        }
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(cache, f, separators=(',', ':'))
+        os.replace(self.path + '.tmp', self.path)
+        return True
+
+    def invalidate(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq refresh')
+    parser.add_argument('command', choices=['files', 'update', 'invalidate'])
+    parser.add_argument('--full', dest='full', action='store_true', help='Re-read the list of tracked files')
+    parser.add_argument('--changed', dest='changed', action='store_true',
+                        help='Only list changed files, not those already in the patch')
+    parser.add_argument('files', nargs='*')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    root = find_repo_root(os.getcwd())
+    if not root:
+        sys.exit(1)
+    stat_cache = StatCache(root)
+    if args.command == 'files':
+        try:
+            files = stat_cache.files(args.changed)
+        except (InvalidCache, IOError, OSError) as error:
+            print("Full refresh ({}).".format(error), file=sys.stderr)
+            sys.exit(1)
+        # 'path:' patterns are relative to the repository root, wherever mq was run from
+        for path in files:
+            print('path:' + path)
+    elif args.command == 'update':
+        stat_cache.update(None if args.full else [path[len('path:'):] if path.startswith('path:') else path
+                                                  for path in args.files])
+    elif args.command == 'invalidate':
+        stat_cache.invalidate()
+    sys.exit(0)
@@ -0,0 +1,337 @@
+#!/usr/bin/python3
+#
+
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util.retry import Retry
+
+from mqlib import trace
+from mqlib.config import MQ_HOME
+
+
+POOL_SIZE = 16
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.5
+RETRY_STATUS = (500, 502, 503, 504)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def retry_policy():
+    kwargs = {
+        'total': RETRY_TOTAL,
+        'backoff_factor': RETRY_BACKOFF,
+        'status_forcelist': RETRY_STATUS,
+        'raise_on_status': False,
+    }
+    # urllib3 renamed 'method_whitelist' to 'allowed_methods' in 1.26
+    try:
+        return Retry(allowed_methods=frozenset(['GET', 'HEAD']), **kwargs)
+    except TypeError:
+        return Retry(method_whitelist=frozenset(['GET', 'HEAD']), **kwargs)
+
+
+class ResponseCache():
+    """On-disk cache of GET responses, revalidated with ETag/Last-Modified.
+
+    Entries are keyed by the account (identity) as well as the request, as the same page
+    can differ between users. Cookies are never written to the cache.
+    """
+
+    # Headers that are specific to a session and must not be replayed from the cache
+    PRIVATE_HEADERS = ('set-cookie',)
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.path.join(MQ_HOME, 'cache', 'http')
+
+    def _path(self, url, params, identity=''):
+        key = hashlib.sha1(json.dumps([url, params, identity], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def load(self, url, params, identity=''):
+        path = self._path(url, params, identity)
+        try:
+            with open(path + '.json') as f:
+                meta = json.load(f)
+            with open(path + '.body', 'rb') as f:
+                body = f.read()
+        except (IOError, OSError, ValueError):
+            return None
+        return meta, body
+
+    def validators(self, meta):
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def store(self, url, params, response, identity=''):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if response.status_code != 200 or response.history or not (etag or last_modified):
+            return
+        meta = {
+            'url': response.url,
+            'etag': etag,
+            'last_modified': last_modified,
+            'encoding': response.encoding,
+            'headers': dict((name, value) for name, value in response.headers.items()
+                            if name.lower() not in self.PRIVATE_HEADERS),
+        }
+        path = self._path(url, params, identity)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._write(path + '.body', response.content)
+        self._write(path + '.json', json.dumps(meta).encode('utf-8'))
+
+    def _write(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def response(self, meta, body, not_modified):
+        """Rebuild a requests.Response from a cache entry."""
+        res = requests.models.Response()
+        res.status_code = 200
+        res._content = body
+        res.headers = CaseInsensitiveDict(meta.get('headers', {}))
+        res.url = meta.get('url')
+        res.encoding = meta.get('encoding')
+        res.request = not_modified.request
+        res.elapsed = not_modified.elapsed
+        res.from_cache = True
+        return res
+
+
+class MultipartStream():
+    """A multipart/form-data request body that streams files from disk.
+
+    fields is a dict or a list of (name, value) pairs. files is a list of
+    (field, filename, path, content type). The length is known up front, so the upload is
+    sent with a Content-Length in DOWNLOAD_CHUNK_SIZE pieces rather than read into memory.
+    """
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.parts = []
+        for name, value in (fields.items() if isinstance(fields, dict) else fields):
+            self.parts.append(self._part_header(name) + str(value).encode('utf-8') + b'\r\n')
+        for field, filename, path, content_type in files:
+            self.parts.append(self._part_header(field, filename, content_type))
+            self.parts.append(path)
+            self.parts.append(b'\r\n')
+        self.parts.append('--{}--\r\n'.format(self.boundary).encode('ascii'))
+
+    def _part_header(self, name, filename=None, content_type=None):
+        disposition = 'form-data; name="{}"'.format(name.replace('"', '%22'))
+        if filename is not None:
+            disposition += '; filename="{}"'.format(filename.replace('"', '%22'))
+        header = '--{}\r\nContent-Disposition: {}\r\n'.format(self.boundary, disposition)
+        if content_type:
+            header += 'Content-Type: {}\r\n'.format(content_type)
+        return (header + '\r\n').encode('utf-8')
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary={}'.format(self.boundary)
+
+    def __len__(self):
+        return sum(len(part) if isinstance(part, bytes) else os.path.getsize(part) for part in self.parts)
+
+    def __iter__(self):
+        # Each iteration starts from the beginning, so a retried request sends the whole body again
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            with open(part, 'rb') as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    yield chunk
+
+
+class REMOTE():
+    def __init__(self, timeout=20, debug=False, cache=True, identity=''):
+        self.timeout = timeout
+        self.debug = debug
+        self.cache = ResponseCache() if cache else None
+        # Who we are authenticated as (eg. server and user name). Keeps cached responses apart
+        self.identity = identity
+        # Configure session and cookies. A single pooled, keep-alive session is
+        # shared by every request (and thread) made through this instance.
+        self.http_session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry_policy())
+        self.http_session.mount('http://', adapter)
+        self.http_session.mount('https://', adapter)
+
+    def log(self, string):
+        if self.debug:
+            try:
+                print('[REMOTE]: %s' % string)
+            except Exception:
+                pass
+
+    def cache_identity(self, headers):
+        identity = self.identity
+        if headers and headers.get('Authorization'):
+            identity += '\0' + headers['Authorization']
+        return identity
+
+    def _get_cached(self, url, payload, headers, allow_redirects):
+        identity = self.cache_identity(headers)
+        cached = self.cache.load(url, payload, identity)
+        request_headers = dict(headers or {})
+        if cached:
+            request_headers.update(self.cache.validators(cached[0]))
+        req = self.http_session.get(
+            url, params=payload, headers=request_headers, allow_redirects=allow_redirects, timeout=self.timeout)
+        if req.status_code == 304 and cached:
+            self.log('Response code: 304 (using cached response)')
+            return self.cache.response(cached[0], cached[1], req)
+        req.raise_for_status()
+        self.cache.store(url, payload, req, identity)
+        return req
+
+    def make_request(self, url, method, payload=None, headers=None, allow_redirects=True, files=None, cache=True):
+        """Make an http request. Return the response.
+
+        For the 'files' method, files is a list of (field, filename, path, content type)
+        that is streamed from disk. Set cache to False to skip the response cache for a GET.
+        """
+        if not trace.enabled():
+            return self._make_request(url, method, payload, headers, allow_redirects, files, cache)
+        with trace.span('http', '%s %s' % (method.upper(), url), method=method, url=url) as args:
+            req = self._make_request(url, method, payload, headers, allow_redirects, files, cache)
+            body = req.request.body if req.request is not None else None
+            args['status'] = req.status_code
+            args['cached'] = getattr(req, 'from_cache', False)
+            args['bytes_sent'] = len(body) if isinstance(body, (str, bytes, MultipartStream)) else 0
+            if method == 'getfile':
+                # Streamed. The body has not been read yet
+                args['bytes_received'] = int(req.headers.get('Content-Length') or 0)
+            else:
+                args['bytes_received'] = 0 if args['cached'] else len(req.content)
+            return req
+
+    def _make_request(self, url, method, payload=None, headers=None, allow_redirects=True, files=None, cache=True):
+        self.log('Request URL: %s' % url)
+        self.log('Headers: %s' % headers)
+        self.log('Payload: %s' % payload)
+        try:
+            if method == 'get' and self.cache and cache:
+                req = self._get_cached(url, payload, headers, allow_redirects)
+            elif method == 'get':
+                req = self.http_session.get(
+                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
+            elif method == 'files':
+                body = MultipartStream(payload or {}, files or [])
+                request_headers = dict(headers or {})
+                request_headers['Content-Type'] = body.content_type
+                req = self.http_session.post(
+                    url, data=body, headers=request_headers, allow_redirects=allow_redirects, timeout=self.timeout)
+            elif method == 'getfile':
+                req = self.http_session.get(
+                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout, stream=True)
+            else:  # post
+                req = self.http_session.post(
+                    url, data=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
+            req.raise_for_status()
+            self.log('Response code: %s' % req.status_code)
+            #self.log('Response: %s' % req.content)
+            return req
+        except requests.exceptions.HTTPError as error:
+            self.log('An HTTP error occurred: %s' % error)
+            raise
+        except requests.exceptions.ProxyError:
+            self.log('Error connecting to proxy server')
+            raise
+        except requests.exceptions.ConnectionError as error:
+            self.log('Connection Error: - %s' % error)
+            raise
+        except requests.exceptions.RequestException as error:
+            self.log('Error: - %s' % error)
+            raise
+
+    def download(self, url, dest, headers=None, attempts=RETRY_TOTAL):
+        """Stream url into dest.
+
+        Data is written to a '.part' file named after the url and only renamed to dest once
+        complete. If the transfer is interrupted it is resumed with an HTTP Range request,
+        guarded by If-Range so that the server sends the whole file again if it has changed.
+        """
+        part = '%s.%s.part' % (dest, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16])
+        validator_path = part + '.validator'
+        for attempt in range(1, attempts + 1):
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            validator = self._read_validator(validator_path) if offset else None
+            request_headers = dict(headers or {})
+            if validator:
+                request_headers['Range'] = 'bytes=%d-' % offset
+                request_headers['If-Range'] = validator
+            else:
+                # Nothing to check a partial file against. Start again from the beginning
+                offset = 0
+            try:
+                req = self.make_request(url, 'getfile', headers=request_headers)
+                if offset and req.status_code != 206:
+                    # Server ignored our range request, or the file changed. Start again from the beginning
+                    offset = 0
+                if not offset:
+                    self._write_validator(validator_path, req)
+                expected = req.headers.get('Content-Length')
+                written = 0
+                with open(part, 'ab' if offset else 'wb') as f:
+                    for chunk in req.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+                if expected is not None and written < int(expected):
+                    raise requests.exceptions.ChunkedEncodingError(
+                        'Download truncated after %d of %s bytes' % (written, expected))
+                os.replace(part, dest)
+                self._remove(validator_path)
+                return dest
+            except requests.exceptions.HTTPError as error:
+                if offset and error.response is not None and error.response.status_code == 416:
+                    # Our partial file is no longer valid for this resource
+                    self._remove(part)
+                elif attempt == attempts:
+                    raise
+            except requests.exceptions.RequestException as error:
+                self.log('Download interrupted (attempt %d/%d): %s' % (attempt, attempts, error))
+                if attempt == attempts:
+                    raise
+                time.sleep(RETRY_BACKOFF * (2 ** attempt))
+        raise requests.exceptions.RequestException('Failed to download %s' % url)
+
+    def _read_validator(self, path):
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return None
+
+    def _write_validator(self, path, response):
+        """Remember what identifies the version of the file being downloaded, for If-Range."""
+        etag = response.headers.get('ETag')
+        # Weak ETags cannot be used with If-Range
+        validator = etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified')
+        if validator:
+            with open(path, 'w') as f:
+                f.write(validator)
+        else:
+            self._remove(path)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
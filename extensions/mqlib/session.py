@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+#
+
+
+import hashlib
+import os
+
+from mqlib.config import MQ_HOME
+
+
+class SessionStore():
+    """Persist a login cookie under ~/.mq/sessions, readable only by the current user."""
+
+    def __init__(self, service, *identity):
+        key = hashlib.sha1('\0'.join(identity).encode('utf-8')).hexdigest()[:16]
+        self.session_dir = os.path.join(MQ_HOME, 'sessions')
+        self.path = os.path.join(self.session_dir, '{}-{}'.format(service, key))
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            return ""
+
+    def save(self, cookie):
+        os.makedirs(self.session_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.session_dir, 0o700)
+        fd = os.open(self.path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(cookie)
+        os.replace(self.path + '.tmp', self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
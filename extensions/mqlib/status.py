@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+#
+# Single pass 'mq status'.
+#
+# The branch and the applied patch are read straight from .hg/branch and
+# .hg/patches/series, the patch diffstat is computed by parsing the patch file and
+# 'hg status' is run exactly once.
+#
+
+
+import argparse
+import json
+import os
+import sys
+
+from mqlib import patch
+from mqlib.hgserver import find_repo_root
+from mqlib.pool import hg
+
+
+CHEAD = "\033[93m"
+CPATCH = "\033[92m"
+CNORM = "\033[0m"
+STATUS_COLOURS = {
+    'M': "\033[1;94m",      # Light Blue (bold)
+    '?': "\033[1;4;95m",    # Light Mag (bold underlined)
+    '!': "\033[1;4;36m",    # Cyan (bold underlined)
+    'R': "\033[1;91m",      # Light Red (bold)
+    'A': "\033[1;92m",      # Light Green (bold)
+}
+STATUS_HELP = """  The codes used to show the status of files are:
+
+    M = modified
+    A = added
+    R = removed
+    C = clean
+    ! = missing (deleted by non-hg command, but still tracked)
+    ? = not tracked
+    I = ignored
+      = origin of the previous file (with --copies)"""
+INDENT = "                        "
+
+
+def read_lines(path):
+    try:
+        with open(path) as f:
+            return f.read().splitlines()
+    except (IOError, OSError):
+        return []
+
+
+def gather(root, status_args=None, cwd=None):
+    """Collect everything 'mq status' shows. 'hg status' is run from cwd (default: the current directory)."""
+    branch = (read_lines(os.path.join(root, '.hg', 'branch')) or ['default'])[0].strip() or 'default'
+    series = []
+    for line in read_lines(os.path.join(root, '.hg', 'patches', 'series')):
+        # Strip guards ("name #+guard") and comment lines
+        name = line.split('#', 1)[0].strip()
+        if name:
+            series.append(name)
+    stats = []
+    if series:
+        patch_path = os.path.join(root, '.hg', 'patches', series[0])
+        if os.path.isfile(patch_path):
+            with open(patch_path, errors='replace') as f:
+                try:
+                    stats = patch.diffstat(f)
+                except ValueError:
+                    stats = []
+    changes = []
+    for line in (hg('status', *(status_args or []), cwd=cwd) or '').splitlines():
+        if line:
+            changes.append((line[0], line[2:]))
+    return {
+        'branch': branch,
+        'series': series,
+        'applied_patch': series[0] if series else None,
+        'patch_stats': stats,
+        'changes': changes,
+    }
+
+
+def as_json(state):
+    return json.dumps({
+        'branch': state['branch'],
+        'applied_patch': state['applied_patch'],
+        'series': state['series'],
+        'patch_stats': [{'file': path, 'added': added, 'removed': removed, 'binary': binary}
+                        for path, added, removed, binary in state['patch_stats']],
+        'insertions': sum(stat[1] for stat in state['patch_stats']),
+        'deletions': sum(stat[2] for stat in state['patch_stats']),
+        'changes': [{'status': code, 'file': path} for code, path in state['changes']],
+    }, indent=2)
+
+
+def as_text(state):
+    patch_stats = ''.join('\n' + INDENT + line.strip() for line in patch.format_diffstat(state['patch_stats']))
+    if not state['changes']:
+        hg_status = "\n" + INDENT + "0 files changed\n        "
+    else:
+        files_changed = ''.join('\n{}{}{} {}{}'.format(INDENT, STATUS_COLOURS.get(code, ''), code, path, CNORM)
+                                for code, path in state['changes'])
+        hg_status = "{}\n\n            {}\n        ".format(STATUS_HELP, files_changed)
+    return """
+{head}Current branch:{norm}         {branch}
+
+
+{head}Applied patch:{norm}          {cpatch}{series}{norm}
+{patch_stats}
+
+
+{head}HG Status (modifications not saved to patch file):{norm}
+
+{hg_status}
+    """.format(head=CHEAD, norm=CNORM, cpatch=CPATCH, branch=state['branch'], series='\n'.join(state['series']),
+               patch_stats=patch_stats, hg_status=hg_status)
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq status')
+    parser.add_argument('--json', dest='json', action='store_true', default=False, help='Print machine readable output')
+    # Anything else (files, 'hg status' options) is passed on to 'hg status'
+    return parser.parse_known_args()
+
+
+if __name__ == '__main__':
+    args, status_args = get_params()
+    root = find_repo_root(os.getcwd())
+    if not root:
+        print("abort: no repository found in '{}' (.hg not found)!".format(os.getcwd()))
+        sys.exit(1)
+    state = gather(root, status_args)
+    if args.json:
+        print(as_json(state))
+    else:
+        print(as_text(state))
+    sys.exit(0)
@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+#
+# Opt-in tracing of hg calls, HTTP requests and prompts.
+#
+# Set MQ_TRACE to a file to enable it. Every event is appended to that file as a Chrome
+# trace "complete" event, so the same file can be written by the mq script and all of
+# the python processes it starts:
+#
+#   MQ_TRACE=/tmp/mq-trace.json     Chrome trace (JSON array). Load it in chrome://tracing,
+#                                   Perfetto or speedscope
+#   MQ_TRACE=/tmp/mq-trace.jsonl    One JSON event per line, for aggregating with other tools
+#
+# Events have a category of 'mq' (a whole mq command), 'hg', 'http' or 'prompt'. Time
+# spent waiting on the user is only ever recorded under 'prompt' so it can be subtracted
+# from the rest.
+#
+
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+def enabled():
+    return bool(os.environ.get('MQ_TRACE'))
+
+
+def now():
+    """Microseconds since the epoch. The same clock the mq script uses."""
+    return int(time.time() * 1000000)
+
+
+def record(category, name, start, end, **args):
+    path = os.environ.get('MQ_TRACE')
+    if not path:
+        return
+    event = {
+        'name': name,
+        'cat': category,
+        'ph': 'X',
+        'ts': start,
+        'dur': end - start,
+        # Group everything under the mq command that started us
+        'pid': int(os.environ.get('MQ_TRACE_PID') or os.getpid()),
+        'tid': os.getpid() if threading.current_thread() is threading.main_thread() else threading.get_ident(),
+        'args': args,
+    }
+    line = json.dumps(event, default=str)
+    try:
+        with open(path, 'a') as f:
+            if path.endswith('.json'):
+                if f.tell() == 0:
+                    f.write('[\n')
+                line += ','
+            f.write(line + '\n')
+    except (IOError, OSError):
+        pass
+
+
+@contextlib.contextmanager
+def span(category, name, **args):
+    """Record the time spent in a block. Values added to the yielded dict are recorded too."""
+    if not enabled():
+        yield args
+        return
+    start = now()
+    try:
+        yield args
+    except Exception as error:
+        args.setdefault('error', '{}: {}'.format(type(error).__name__, error))
+        raise
+    finally:
+        record(category, name, start, now(), **args)
+
+
+def prompt(text, reader=input):
+    """input() that records the time spent waiting for an answer."""
+    with span('prompt', text.strip()):
+        return reader(text)
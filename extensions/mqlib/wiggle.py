@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+#
+# Resolve every reject file of a failed patch at once.
+#
+# Each .rej file is handed to a process pool. A worker runs 'wiggle' on it (or, when
+# wiggle is not installed, a small fuzzy hunk applier) and writes clean results straight
+# back to the file. Only files left with conflicts are then opened, one after the other,
+# in the merge tool.
+#
+
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from mqlib import patch
+
+
+MAX_FUZZ = 2
+MERGE_TOOL = 'meld'
+
+
+def find_rejects(path):
+    rejects = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = [name for name in dirnames if name != '.hg']
+        rejects.extend(os.path.join(dirpath, name) for name in filenames if name.endswith('.rej'))
+    return sorted(rejects)
+
+
+def read_rejects(path):
+    """Return the (header, body) hunks of a reject file."""
+    with open(path, errors='replace') as f:
+        lines = f.readlines()
+    # Reject files only have ---/+++ lines. Give the parser a 'diff' line to start the file on
+    hunks = [hunk for file_patch in patch.iter_file_patches(['diff rejects\n'] + lines) for hunk in file_patch.hunks]
+    if not hunks:
+        raise ValueError('No hunks found in {}'.format(path))
+    return hunks
+
+
+def trim_context(body, fuzz):
+    """Drop up to fuzz context lines from each end of a hunk body, like patch's fuzz factor."""
+    leading = 0
+    while leading < min(fuzz, len(body)) and body[leading][:1] in (' ', '\n'):
+        leading += 1
+    trailing = 0
+    while trailing < min(fuzz, len(body) - leading) and body[-1 - trailing][:1] in (' ', '\n'):
+        trailing += 1
+    return leading, body[leading:len(body) - trailing]
+
+
+def find_hunk(lines, old, start, expected):
+    """Return the position nearest to expected, at or after start, where old matches lines."""
+    candidates = range(start, len(lines) - len(old) + 1)
+    for position in sorted(candidates, key=lambda candidate: abs(candidate - expected)):
+        if lines[position:position + len(old)] == old:
+            return position
+    return None
+
+
+def apply_hunks(lines, hunks, max_fuzz=MAX_FUZZ):
+    """Apply hunks to lines allowing offsets and fuzz.
+
+    Return (lines, conflicts). Hunks that cannot be placed are written in at their
+    expected position between wiggle style conflict markers.
+    """
+    output = []
+    position = 0
+    offset = 0
+    conflicts = 0
+    for header, body in hunks:
+        expected = patch.hunk_ranges(header)[0] - 1 + offset
+        for fuzz in range(max_fuzz + 1):
+            leading, trimmed = trim_context(body, fuzz)
+            old = patch.side(trimmed, ' -')
+            found = find_hunk(lines, old, position, expected + leading) if old else None
+            if found is not None:
+                break
+        if found is not None:
+            output.extend(lines[position:found])
+            output.extend(patch.side(trimmed, ' +'))
+            position = found + len(old)
+            offset = found - leading - (patch.hunk_ranges(header)[0] - 1)
+            continue
+        conflicts += 1
+        old = patch.side(body, ' -')
+        at = min(max(expected, position), len(lines))
+        found_lines = lines[at:at + len(old)]
+        output.extend(lines[position:at])
+        output.append('<<<<<<< found\n')
+        output.extend(found_lines)
+        output.append('||||||| expected\n')
+        output.extend(old)
+        output.append('=======\n')
+        output.extend(patch.side(body, ' +'))
+        output.append('>>>>>>> replacement\n')
+        position = at + len(found_lines)
+    output.extend(lines[position:])
+    return output, conflicts
+
+
+def resolve(rej_file, use_wiggle=True):
+    """Resolve one reject file. Clean results replace the original file."""
+    orig_file = rej_file[:-len('.rej')]
+    result = {'reject': rej_file, 'file': orig_file, 'hunks': 0, 'conflicts': 0, 'message': ''}
+    try:
+        hunks = read_rejects(rej_file)
+        result['hunks'] = len(hunks)
+        if not os.path.isfile(orig_file):
+            raise IOError('{} does not exist'.format(orig_file))
+        if use_wiggle:
+            proc = subprocess.run(['wiggle', '--merge', orig_file, rej_file],
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode > 1:
+                raise IOError(proc.stderr.decode('utf-8', 'replace').strip() or 'wiggle failed')
+            merged = proc.stdout
+            result['conflicts'] = merged.count(b'\n<<<<<<<') + merged.startswith(b'<<<<<<<')
+        else:
+            with open(orig_file, errors='surrogateescape') as f:
+                lines, result['conflicts'] = apply_hunks(f.readlines(), hunks)
+            merged = ''.join(lines).encode('utf-8', 'surrogateescape')
+    except (IOError, OSError, ValueError) as error:
+        result['status'] = 'error'
+        result['message'] = str(error)
+        return result
+    if result['conflicts']:
+        result['status'] = 'conflict'
+        with open(orig_file + '.wiggle', 'wb') as f:
+            f.write(merged)
+        return result
+    result['status'] = 'clean'
+    with open(orig_file, 'wb') as f:
+        f.write(merged)
+    os.rename(rej_file, rej_file + '.merged')
+    return result
+
+
+def resolve_all(path, workers=None, use_wiggle=True):
+    rejects = find_rejects(path)
+    if not rejects:
+        return []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(resolve, rej_file, use_wiggle) for rej_file in rejects]
+        return [future.result() for future in futures]
+
+
+def merge_conflicts(results):
+    """Open each conflicting file in the merge tool, one at a time."""
+    for result in results:
+        if result['status'] != 'conflict':
+            continue
+        print("Resolve unresolved conflicts in {} with {}...".format(result['file'], MERGE_TOOL))
+        subprocess.run([MERGE_TOOL, result['file'], result['file'] + '.wiggle'])
+        os.remove(result['file'] + '.wiggle')
+        os.rename(result['reject'], result['reject'] + '.merged')
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq wiggle --batch')
+    parser.add_argument('--batch', dest='batch', action='store_true', default=True, help=argparse.SUPPRESS)
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('--no-merge', dest='merge', action='store_false', default=True,
+                        help='Leave conflicting files as FILE.wiggle instead of opening the merge tool')
+    parser.add_argument('--json', dest='json', action='store_true', default=False, help='Print machine readable output')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    use_wiggle = bool(shutil.which('wiggle'))
+    results = resolve_all(os.getcwd(), args.jobs, use_wiggle)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        sys.exit(0)
+    if not results:
+        print("No reject files found.")
+        sys.exit(0)
+    if not use_wiggle:
+        print("wiggle is not installed. Using the built in fuzzy hunk applier.")
+    print("")
+    print("      {:<10} {:>6} {:>9}  {}".format('STATUS', 'HUNKS', 'CONFLICTS', 'FILE'))
+    for result in results:
+        print("      {:<10} {:>6} {:>9}  {}".format(
+            result['status'], result['hunks'], result['conflicts'], os.path.relpath(result['file'])))
+        if result['message']:
+            print("                 {}".format(result['message']))
+    print("")
+    for status in ('clean', 'conflict', 'error'):
+        print("    {:<10} {}".format(status + ':', sum(1 for result in results if result['status'] == status)))
+    print("")
+    if args.merge and any(result['status'] == 'conflict' for result in results):
+        if shutil.which(MERGE_TOOL):
+            merge_conflicts(results)
+        else:
+            print("{} is not installed. Conflicting files were left as FILE.wiggle.".format(MERGE_TOOL))
+    sys.exit(0)
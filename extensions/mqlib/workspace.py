@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+#
+# 'mq --all COMMAND': run status, list, check or rebase across every repository of a
+# workspace at once.
+#
+# The workspace file (mq.workspace, default ~/.mq/workspace) lists one repository per
+# line. '~', environment variables and globs are expanded and '#' starts a comment:
+#
+#   ~/src/product/core
+#   ~/src/product/plugins/*
+#
+# The patch cache pool is scanned once and its patches grouped by project. Each
+# repository is then handled by a thread of a worker pool, so the whole run takes about
+# as long as the slowest repository. Nothing is printed until every repository is done,
+# then one combined report is shown in workspace order.
+#
+# 'rebase' never prompts. Patches are rebased in memory (see mqlib.rebase). A repository
+# with uncommitted changes is skipped and one whose patch conflicts is left as it was,
+# to be rebased with 'mq rebase' in that repository.
+#
+# Usage:
+#   python3 -m mqlib.workspace --patch-dir DIR [--workspace FILE] [--jobs N] [--json] COMMAND [--pull] [REVISION]
+#
+
+
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mqlib import status
+from mqlib.check import check_pool
+from mqlib.config import MQ_HOME
+from mqlib.patchindex import PatchIndex
+from mqlib.pool import expand_path, hg, working_project
+from mqlib.rebase import RebaseConflict, rebase_patch
+
+
+COMMANDS = ['status', 'list', 'check', 'rebase']
+CHEAD = "\033[93m"
+CPATCH = "\033[92m"
+CERROR = "\033[91m"
+CNORM = "\033[0m"
+
+
+def read_workspace(path):
+    """Return the repositories listed in a workspace file, in order and without duplicates."""
+    repos = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            line = expand_path(line)
+            matches = sorted(glob.glob(line)) if glob.has_magic(line) else [line]
+            for repo in matches:
+                repo = os.path.abspath(repo)
+                if repo not in repos:
+                    repos.append(repo)
+    return repos
+
+
+def read_series(root):
+    series = []
+    for line in status.read_lines(os.path.join(root, '.hg', 'patches', 'series')):
+        name = line.split('#', 1)[0].strip()
+        if name:
+            series.append(name)
+    return series
+
+
+def group_patches(patch_dir):
+    """Scan the pool once and return its patches grouped by project."""
+    index = PatchIndex(patch_dir)
+    index.sync()
+    groups = {}
+    for entry in index.query():
+        groups.setdefault(entry['project'], []).append(entry)
+    return groups
+
+
+def repo_status(root, project, context):
+    return status.gather(root, cwd=root)
+
+
+def repo_list(root, project, context):
+    series = read_series(root)
+    return {
+        'applied_patch': series[0] if series else None,
+        'patches': [{'name': entry['name'], 'author': entry['author'], 'files': len(entry['files']),
+                     'insertions': entry['insertions'], 'deletions': entry['deletions']}
+                    for entry in context['groups'].get(project, [])],
+    }
+
+
+def repo_check(root, project, context):
+    entries = context['groups'].get(project, [])
+    if not entries:
+        return {'results': []}
+    return {'results': check_pool(root, context['patch_dir'], project, context['revision'], context['check_jobs'],
+                                  entries=entries)}
+
+
+def repo_rebase(root, project, context):
+    series = read_series(root)
+    if not series:
+        return {'result': 'skipped', 'detail': 'no patch applied'}
+    name = series[0]
+    changes = hg('status', '-mard', cwd=root)
+    if changes is None:
+        raise RuntimeError('hg status failed')
+    if changes.strip():
+        return {'result': 'skipped', 'detail': 'uncommitted changes', 'applied_patch': name}
+    if context['pull'] and hg('pull', cwd=root) is None:
+        raise RuntimeError('hg pull failed')
+    if hg('qpop', '-a', cwd=root) is None:
+        raise RuntimeError('hg qpop failed')
+    try:
+        rebased = rebase_patch(root, os.path.join(root, '.hg', 'patches', name), 'tip')
+    except (RebaseConflict, ValueError) as error:
+        # Put things back as they were. The patch still applies to the old parent
+        if hg('qpush', name, cwd=root) is None:
+            raise RuntimeError('{} (hg qpush {} failed too, the patch is no longer applied)'.format(error, name))
+        return {'result': 'conflict', 'detail': str(error), 'applied_patch': name}
+    if rebased and hg('update', '-r', 'tip', cwd=root) is None:
+        raise RuntimeError('hg update failed')
+    if hg('qpush', name, cwd=root) is None:
+        raise RuntimeError('hg qpush {} failed'.format(name))
+    return {'result': 'rebased' if rebased else 'up to date', 'applied_patch': name}
+
+
+HANDLERS = {
+    'status': repo_status,
+    'list': repo_list,
+    'check': repo_check,
+    'rebase': repo_rebase,
+}
+
+
+def run_repo(root, command, context):
+    start = time.time()
+    result = {'repo': root, 'project': None}
+    try:
+        if not os.path.isdir(root):
+            raise RuntimeError('no such directory')
+        if not os.path.isdir(os.path.join(root, '.hg')):
+            raise RuntimeError('not a Mercurial repository')
+        result['project'] = working_project(root)
+        result.update(HANDLERS[command](root, result['project'], context))
+    except Exception as error:
+        result['error'] = str(error) or type(error).__name__
+    result['seconds'] = round(time.time() - start, 2)
+    return result
+
+
+def run(repos, command, context, jobs=None):
+    """Run command in every repository concurrently. Results are returned in workspace order."""
+    with ThreadPoolExecutor(max_workers=jobs or min(len(repos), 8) or 1) as executor:
+        futures = [executor.submit(run_repo, repo, command, context) for repo in repos]
+        return [future.result() for future in futures]
+
+
+def print_status(result):
+    print("      branch: {}   applied patch: {}{}{}".format(
+        result['branch'], CPATCH, result['applied_patch'] or '-', CNORM))
+    if result['patch_stats']:
+        stats = result['patch_stats']
+        print("      patch: {} files, +{} -{}".format(len(stats), sum(s[1] for s in stats), sum(s[2] for s in stats)))
+    if result['changes']:
+        print("      modifications not saved to patch file:")
+        for code, path in result['changes']:
+            print("        {}{} {}{}".format(status.STATUS_COLOURS.get(code, ''), code, path, CNORM))
+
+
+def print_list(result):
+    if not result['patches']:
+        print("      no patches in the pool")
+    for entry in result['patches']:
+        applied = CPATCH + '*' if entry['name'] == result['applied_patch'] else ' '
+        print("    {} {}  ({} files +{} -{}){}".format(
+            applied, entry['name'], entry['files'], entry['insertions'], entry['deletions'], CNORM))
+
+
+def print_check(result):
+    if not result['results']:
+        print("      no patches in the pool")
+    for check in result['results']:
+        print("      {:<10} {:>6} {:>6} {:>7}  {}".format(
+            check['status'], check['hunks'], check['fuzz'] + check['offset'], check['failed'], check['patch']))
+
+
+def print_rebase(result):
+    print("      {}{}{}".format(result.get('applied_patch') or '', ': ' if result.get('applied_patch') else '',
+                                 result['result']))
+    if result.get('detail'):
+        print("      {}".format(result['detail']))
+
+
+PRINTERS = {
+    'status': print_status,
+    'list': print_list,
+    'check': print_check,
+    'rebase': print_rebase,
+}
+
+
+def summary(command, result):
+    if 'error' in result:
+        return CERROR + 'error' + CNORM
+    if command == 'status':
+        return '{} changes'.format(len(result['changes'])) if result['changes'] else 'clean'
+    if command == 'list':
+        return '{} patches'.format(len(result['patches']))
+    if command == 'check':
+        counts = [(s, sum(1 for check in result['results'] if check['status'] == s)) for s in ('clean', 'fuzz', 'conflict')]
+        return ', '.join('{} {}'.format(count, s) for s, count in counts if count) or 'no patches'
+    return result['result']
+
+
+def print_report(command, results, elapsed):
+    print("")
+    for result in results:
+        print("    {}{}{} ({})".format(CHEAD, result['repo'], CNORM, result['project'] or '?'))
+        if 'error' in result:
+            print("      {}abort: {}{}".format(CERROR, result['error'], CNORM))
+        else:
+            PRINTERS[command](result)
+        print("")
+    width = max(len(result['repo']) for result in results)
+    print("    {}Summary:{}".format(CHEAD, CNORM))
+    for result in results:
+        print("      {}  {:>6.1f}s  {}".format(result['repo'].ljust(width), result['seconds'], summary(command, result)))
+    print("")
+    print("    {} repositories in {:.1f}s (slowest {:.1f}s)".format(
+        len(results), elapsed, max(result['seconds'] for result in results)))
+    print("")
+
+
+def get_params():
+    parser = argparse.ArgumentParser(prog='mq --all')
+    parser.add_argument('--patch-dir', dest='patch_dir', required=True)
+    parser.add_argument('--workspace', dest='workspace', default='',
+                        help='Workspace file listing the repositories (default: ~/.mq/workspace)')
+    parser.add_argument('--jobs', dest='jobs', type=int, default=None, help='Number of repositories handled at once')
+    parser.add_argument('--json', dest='json', action='store_true', default=False, help='Print machine readable output')
+    parser.add_argument('--pull', dest='pull', action='store_true', default=False, help='rebase: run hg pull first')
+    parser.add_argument('command', choices=COMMANDS)
+    parser.add_argument('revision', nargs='?', default='.', help='check: revision to check against')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_params()
+    workspace = expand_path(args.workspace) or os.path.join(MQ_HOME, 'workspace')
+    try:
+        repos = read_workspace(workspace)
+    except (IOError, OSError):
+        print("abort: unable to read the workspace file '{}'.".format(workspace))
+        print("List one repository per line in it, or set 'workspace' in the [mq] section of your hgrc.")
+        sys.exit(1)
+    if not repos:
+        print("abort: no repositories listed in '{}'.".format(workspace))
+        sys.exit(1)
+    jobs = args.jobs or min(len(repos), 8)
+    context = {
+        'patch_dir': args.patch_dir,
+        'groups': group_patches(args.patch_dir) if args.command in ('list', 'check') else {},
+        'revision': args.revision,
+        # Checks run in the worker threads. Forking a process pool from there, while other
+        # threads are running hg, is not safe. The repositories are checked in parallel instead
+        'check_jobs': 1,
+        'pull': args.pull,
+    }
+    start = time.time()
+    results = run(repos, args.command, context, jobs)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(args.command, results, time.time() - start)
+    sys.exit(1 if any('error' in result for result in results) else 0)
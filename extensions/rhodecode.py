@@ -1,22 +1,34 @@
 #!/usr/bin/python3
 #
 
+# Extension metadata. Read by mq (without importing this file) for help and completion
+MQ_HELP = ""
+MQ_HELP += "        rhodecode        Fetch pull requests from RhodeCode and import it as a patch.\n"
+MQ_HELP += "                         Usage:\n"
+MQ_HELP += "                                 mq rhodecode primport [PULLREQUEST NUMBER]\n"
+MQ_HELP += "                                 mq rhodecode primport --fold [PULLREQUEST NUMBER]    (fold the commits into one diff per file)\n"
+MQ_COMMANDS = ["primport"]
+
 
 import requests
+import hashlib
 import os
 import sys
 import time
 import subprocess
 import argparse
+import collections
+import itertools
+import json
+from concurrent.futures import ThreadPoolExecutor
 from lxml import html
 from pprint import pprint
 
 import xml.sax.saxutils as saxutils
 
-try:
-    import ConfigParser as configparser
-except:
-    import configparser as configparser
+from mqlib.config import Config
+from mqlib.remote import REMOTE
+from mqlib import patch
 
 
 
@@ -25,77 +37,10 @@ PATCH_HEADER += "# HG changeset patch\n"
 PATCH_HEADER += "# User {}\n"
 PATCH_HEADER += "{}\n\n"
 
+DEFAULT_CONCURRENCY = 4
+DIFF_FETCH_RETRIES = 3
 
 
-class Config():
-    def __init__(self):
-        self.config = configparser.RawConfigParser()
-
-    def read_config(self):
-        self.config.read(os.path.join(os.path.expanduser("~"), ".hgrc"))
-        for each_section in self.config.sections():
-            if each_section == 'mq':
-                for (each_key, each_val) in self.config.items(each_section):
-                    setattr(self, each_key, each_val)
-
-    def getAll(self):
-        return [attr for attr in dir(self) if (not attr.startswith('__') and not attr.startswith('getAll'))]
-
-
-class REMOTE():
-    def __init__(self, timeout=20, debug=False):
-        self.timeout = timeout
-        self.debug = debug
-        # Configure session and cookies
-        self.http_session = requests.Session()
-
-    def log(self, string):
-        if self.debug:
-            try:
-                print('[REMOTE]: %s' % string)
-            except UnicodeEncodeError:
-                # we can't anticipate everything in unicode they might throw at
-                # us, but we can handle a simple BOM
-                bom = unicode(codecs.BOM_UTF8, 'utf8')
-                print('[REMOTE]: %s' % string.replace(bom, ''))
-            except Exception:
-                pass
-
-    def make_request(self, url, method, payload=None, headers=None, allow_redirects=True, files=None):
-        """Make an http request. Return the response."""
-        self.log('Request URL: %s' % url)
-        self.log('Headers: %s' % headers)
-        self.log('Payload: %s' % payload)
-        try:
-            if method == 'get':
-                req = self.http_session.get(
-                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            elif method == 'files':
-                req = self.http_session.post(
-                    url, data=payload, files=files, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            elif method == 'getfile':
-                req = self.http_session.get(
-                    url, params=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout, stream=True)
-            else:  # post
-                req = self.http_session.post(
-                    url, data=payload, headers=headers, allow_redirects=allow_redirects, timeout=self.timeout)
-            req.raise_for_status()
-            self.log('Response code: %s' % req.status_code)
-            #self.log('Response: %s' % req.content)
-            return req
-        except requests.exceptions.HTTPError as error:
-            self.log('An HTTP error occurred: %s' % error)
-            raise
-        except requests.exceptions.ProxyError:
-            self.log('Error connecting to proxy server')
-            raise
-        except requests.exceptions.ConnectionError as error:
-            self.log('Connection Error: - %s' % error.message)
-            raise
-        except requests.exceptions.RequestException as error:
-            self.log('Error: - %s' % error.value)
-            raise
-
 
 class Rhodecode(object):
 
@@ -105,8 +50,14 @@ class Rhodecode(object):
         if 'debug' in kwargs:
             self.debug = kwargs.get("debug");
         self.BASE_URL = self.getConfig("rhodecode_url");
-        self.req = REMOTE(debug=self.debug);
+        self.API_TOKEN = self.getConfig("rhodecode_api_token");
+        self.api_ids = itertools.count(1);
+        self.req = REMOTE(debug=self.debug, identity="{} {}".format(self.BASE_URL, hashlib.sha1(self.API_TOKEN.encode('utf-8')).hexdigest()));
         self.headers = [];
+        try:
+            self.concurrency = max(1, int(self.getConfig("rhodecode_concurrency") or DEFAULT_CONCURRENCY));
+        except ValueError:
+            self.concurrency = DEFAULT_CONCURRENCY;
 
     def getConfig(self, config_id):
         if str(config_id) in self.config.getAll():
@@ -125,19 +76,95 @@ class Rhodecode(object):
             except Exception:
                 pass;
 
+    def api_call(self, method, **kwargs):
+        """Call a method of the RhodeCode JSON-RPC API. Return its result."""
+        payload = {
+            "id": next(self.api_ids),
+            "auth_token": self.API_TOKEN,
+            "method": method,
+            "args": kwargs,
+        };
+        ret = self.req.make_request(self.BASE_URL + "/_admin/api", 'post', payload=json.dumps(payload),
+                                    headers={"Content-Type": "application/json"});
+        response = ret.json();
+        if response.get("error"):
+            raise ValueError("RhodeCode API {} failed: {}".format(method, response["error"]));
+        return response.get("result");
+
+    def fetch_changeset_diff(self, repo_name, commit_id):
+        """Return the diff of a commit and whether its metadata says the commit is empty (a
+        merge, or no files added, changed or removed) so that an empty diff is expected."""
+        result = self.api_call("get_repo_changeset", repoid=repo_name, revision=commit_id, details="full");
+        diff = result.get("raw_diff") or result.get("diff") if result else None;
+        if not isinstance(diff, str):
+            raise ValueError("No diff returned for commit {}".format(commit_id));
+        empty = (len(result.get("parents") or []) > 1 or
+                 all(key in result and not result[key] for key in ("added", "changed", "removed")));
+        return diff, empty;
+
     def fetch_diffs(self, _url):
-        ret = self.req.make_request(_url, 'get', allow_redirects=True);
-        if ret.status_code == 200:
-            return ret.text;
+        # _url is either a raw diff url scraped from the pull request page or a
+        # (repository, commit id) pair from the API
+        for attempt in range(1, DIFF_FETCH_RETRIES + 1):
+            content_type = None;
+            allow_empty = False;
+            try:
+                if isinstance(_url, tuple):
+                    text, allow_empty = self.fetch_changeset_diff(*_url);
+                else:
+                    # Do not revalidate against a cached copy of a diff that was invalid
+                    ret = self.req.make_request(_url, 'get', allow_redirects=True, cache=attempt == 1);
+                    text = ret.text;
+                    content_type = ret.headers.get('Content-Type');
+            except (requests.exceptions.RequestException, ValueError) as error:
+                # Connection errors and 5xx responses have already been retried by the http session
+                self.log('Failed to fetch diff {}: {}'.format(_url, error));
+                return False;
+            try:
+                patch.validate_diff(text, content_type, allow_empty);
+                return text;
+            except ValueError as error:
+                self.log('Invalid diff received from {} (attempt {}/{}): {}'.format(_url, attempt, DIFF_FETCH_RETRIES, error));
+            if attempt < DIFF_FETCH_RETRIES:
+                time.sleep(attempt);
         return False;
 
-    def download_file(self, file_contents, filename):
-        _file = os.path.join('/', 'tmp', filename);
-        with open(_file, 'w') as f:
-            f.write(file_contents);
-        return _file;
+    def patch_file_path(self, filename):
+        return os.path.join('/', 'tmp', filename);
 
     def get_pull_request_data(self, pull_request_id):
+        if self.API_TOKEN:
+            try:
+                pr_data = self.get_pull_request_data_from_api(pull_request_id);
+                if pr_data:
+                    return pr_data;
+            except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as error:
+                self.log('RhodeCode API request failed ({}). Falling back to the pull request page'.format(error));
+        return self.get_pull_request_data_from_page(pull_request_id);
+
+    def get_pull_request_data_from_api(self, pull_request_id):
+        result = self.api_call("get_pull_request", pullrequestid=int(pull_request_id));
+        if not result:
+            return False;
+        pr_data = {};
+        pr_data['title'] = ' - "{}"'.format(result['title'].strip()) if result.get('title') else "";
+        pr_data['repo_url'] = "/" + result['source']['repository'];
+        author = result.get('author') or {};
+        name = " ".join(part for part in (author.get('firstname'), author.get('lastname')) if part) or author.get('username', '');
+        pr_data['user'] = "{} <{}>".format(name, author['email']) if author.get('email') else name;
+        if not pr_data['user']:
+            self.log('ERROR: Pull request has no author');
+            return False;
+        pr_data['description'] = (result.get('description') or "").strip();
+        commit_ids = result.get('commit_ids') or result.get('revisions') or [];
+        if not commit_ids:
+            self.log('ERROR: Pull request has no commits');
+            return False;
+        # RhodeCode lists pull request commits newest first
+        pr_data['raw_diffs'] = [(result['source']['repository'], commit_id) for commit_id in reversed(commit_ids)];
+        return pr_data;
+
+    def get_pull_request_data_from_page(self, pull_request_id):
         pr_data = {};
         _url = self.BASE_URL + "/_admin/pull-request/" + str(pull_request_id);
         ret = self.req.make_request(_url, 'get', allow_redirects=True);
@@ -189,25 +216,67 @@ class Rhodecode(object):
 
         return pr_data;
 
-    def get_diffs_and_combine(self, pr_data):
-        combined_diff_string = PATCH_HEADER.format(pr_data['user'],pr_data['description']);
-        for link in pr_data['raw_diffs']:
-            res = self.fetch_diffs(link);
-            if res:
-                combined_diff_string += res
-        return combined_diff_string;
-
-    def generate_patch_from_pull_request(self, pull_request_id):
+    def get_diffs_and_combine(self, pr_data, patch_file, fold=False):
+        """Fetch the raw diffs concurrently and stream them into patch_file in commit order.
+        With fold set the diffs are combined into one net diff per file before writing.
+        Return the list of diff urls that could not be fetched and the per-file stats."""
+        failed = [];
+        stats = collections.OrderedDict();
+        folder = patch.DiffFolder();
+        pending = collections.deque();
+        links = iter(pr_data['raw_diffs']);
+        with open(patch_file, 'w') as f, ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            f.write(PATCH_HEADER.format(pr_data['user'],pr_data['description']));
+            # Keep a bounded window of requests in flight and write each result as soon as
+            # every diff before it has been written.
+            for link in links:
+                pending.append((link, pool.submit(self.fetch_diffs, link)));
+                if len(pending) >= self.concurrency * 2:
+                    break;
+            while pending:
+                link, future = pending.popleft();
+                res = future.result();
+                if res is False:
+                    # An empty string is the valid diff of an empty commit
+                    failed.append(link);
+                elif fold:
+                    for file_patch in patch.iter_file_patches(res.splitlines(True)):
+                        folder.add(file_patch);
+                else:
+                    f.write(res);
+                    for file_patch in patch.iter_file_patches(res.splitlines(True), keep_hunks=False):
+                        total = stats.setdefault(file_patch.path, [0, 0, False]);
+                        total[0] += file_patch.added;
+                        total[1] += file_patch.removed;
+                        total[2] = total[2] or file_patch.binary;
+                for link in links:
+                    pending.append((link, pool.submit(self.fetch_diffs, link)));
+                    break;
+            if fold:
+                f.writelines(folder.lines());
+                stats = collections.OrderedDict(
+                    (fp.path, [fp.added, fp.removed, fp.binary]) for fp in folder.entries);
+        return failed, [(path, added, removed, binary) for path, (added, removed, binary) in stats.items()];
+
+    def generate_patch_from_pull_request(self, pull_request_id, fold=False):
         print("");
         print("Importing patch from RhodeCode pull request...");
         print("");
         pr_data = self.get_pull_request_data(pull_request_id);
         if pr_data:
             print('Fetching pull request #{} {}'.format(str(pull_request_id),pr_data['title']));
-            file_contents = self.get_diffs_and_combine(pr_data);
-            res_file = self.download_file(file_contents, "PULLREQUEST_{}.patch".format(pull_request_id));
-            if res_file:
+            res_file = self.patch_file_path("PULLREQUEST_{}.patch".format(pull_request_id));
+            failed, stats = self.get_diffs_and_combine(pr_data, res_file, fold);
+            if failed:
+                print("");
+                print("Failed to fetch {} of {} diffs:".format(len(failed), len(pr_data['raw_diffs'])));
+                for link in failed:
+                    print("      {}".format(link));
+                os.remove(res_file);
+            else:
                 print("");
+                for line in patch.format_diffstat(stats):
+                    print("      {}".format(line));
                 print("");
                 cmd = ['mq', 'import', res_file];
                 try:
@@ -226,6 +295,8 @@ def get_params():
     parser = argparse.ArgumentParser();
     parser.add_argument('--debug', dest='debugging',
                         action='store_true', help='Enable debugging', default=False);
+    parser.add_argument('--fold', dest='fold', action='store_true', default=False,
+                        help='Fold the per-commit diffs into one net diff per file');
     parser.add_argument('command', nargs='?', default='help',
                         help='What command should be run.');
     parser.add_argument('argument', nargs='?', default='help',
@@ -238,8 +309,6 @@ if __name__ == '__main__':
     args = get_params()
     rhodecode = Rhodecode(debug=args.debugging)
     if args.command == "help":
-        print("        rhodecode        Fetch pull requests from RhodeCode and import it as a patch.");
-        print("                         Usage:");
-        print("                                 mq rhodecode primport [PULLREQUEST NUMBER]");
+        print(MQ_HELP, end="");
     if args.command == "primport":
-        rhodecode.generate_patch_from_pull_request(args.argument);
+        rhodecode.generate_patch_from_pull_request(args.argument, args.fold);
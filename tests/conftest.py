@@ -0,0 +1,12 @@
+#!/usr/bin/python3
+#
+# The extensions and their mqlib helpers are run with extensions/ on PYTHONPATH (see
+# python_helper in mq). Do the same for the tests.
+#
+
+
+import os
+import sys
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'extensions'))
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+#
+# Version history of the patch cache pool ('mq history' and 'mq restore').
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+from unittest import mock
+
+from mqlib import history
+from mqlib.history import PatchHistory, apply_delta, make_delta
+
+
+def version_text(number, lines=200):
+    """A patch that changes a little from one version to the next."""
+    text = ''.join('+line {}\n'.format(line) for line in range(lines))
+    return (text + '+version {}\n'.format(number)).encode('utf-8')
+
+
+class DeltaTest(unittest.TestCase):
+
+    def round_trip(self, base, data):
+        self.assertEqual(apply_delta(base, make_delta(base, data)), data)
+
+    def test_round_trips(self):
+        base = b'one\ntwo\nthree\nfour\n'
+        self.round_trip(base, base)
+        self.round_trip(base, b'one\nthree\nfour\nfive\n')
+        self.round_trip(base, b'zero\n' + base)
+        self.round_trip(base, b'')
+        self.round_trip(b'', base)
+
+    def test_missing_newline_at_end(self):
+        self.round_trip(b'one\ntwo', b'one\ntwo\n')
+        self.round_trip(b'one\ntwo\n', b'one\ntwo')
+
+    def test_binary_content(self):
+        self.round_trip(b'\x00\xff\n\x80abc\n', b'\x00\xff\n\xfe\xfd\n\x80abc\n')
+        self.round_trip('café\n'.encode('utf-8'), 'cafés\n'.encode('latin-1'))
+
+    def test_copies_unchanged_lines(self):
+        base = b''.join(b'line %d\n' % number for number in range(100))
+        ops = make_delta(base, base.replace(b'line 50\n', b'changed\n'))
+        self.assertEqual(ops, [[0, 50], 'changed\n', [51, 100]])
+
+
+class PatchHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mq-test-')
+        self.history = PatchHistory(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def pool_file(self, name):
+        with open(os.path.join(self.dir, name), 'rb') as f:
+            return f.read()
+
+    def write_src(self, data):
+        path = os.path.join(self.dir, 'src.patch')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def object_kind(self, sha):
+        with open(self.history.object_path(sha), 'rb') as f:
+            return zlib.decompress(f.read()).partition(b'\n')[0].split()
+
+    def test_snapshot(self):
+        self.assertEqual(self.history.snapshot('a.patch', b'one\n', 'pop'), 1)
+        self.assertIsNone(self.history.snapshot('a.patch', b'one\n', 'refresh'))
+        self.assertEqual(self.history.snapshot('a.patch', b'one\ntwo\n', 'refresh'), 2)
+        self.assertEqual([entry['action'] for entry in self.history.versions('a.patch')], ['pop', 'refresh'])
+        self.assertEqual(PatchHistory(self.dir).read('a.patch', 1), b'one\n')
+        self.assertEqual(PatchHistory(self.dir).read('a.patch', 2), b'one\ntwo\n')
+
+    def test_identical_content_is_stored_once(self):
+        self.history.snapshot('a.patch', version_text(1), 'pop')
+        self.history.snapshot('b.patch', version_text(1), 'import')
+        objects = [name for dirpath, dirnames, names in os.walk(os.path.join(self.dir, '.history', 'objects'))
+                   for name in names]
+        self.assertEqual(len(objects), 1)
+
+    def test_deltas_and_chain_cutting(self):
+        count = history.MAX_CHAIN * 2 + 3
+        for number in range(1, count + 1):
+            self.history.snapshot('a.patch', version_text(number), 'refresh')
+        versions = self.history.versions('a.patch')
+        kinds = [self.object_kind(entry['object'])[0] for entry in versions]
+        self.assertEqual([number for number, kind in enumerate(kinds) if kind == b'full'],
+                         [0, history.MAX_CHAIN, history.MAX_CHAIN * 2])
+        for entry in versions:
+            kind = self.object_kind(entry['object'])
+            # Every delta is made against a full object, never another delta
+            if kind[0] == b'delta':
+                self.assertEqual(kind[1].decode('ascii'), entry['base'])
+                self.assertEqual(self.object_kind(entry['base'])[0], b'full')
+        fresh = PatchHistory(self.dir)
+        for number in range(1, count + 1):
+            self.assertEqual(fresh.read('a.patch', number), version_text(number))
+
+    def test_delta_larger_than_the_text(self):
+        self.history.snapshot('a.patch', version_text(1), 'pop')
+        self.history.snapshot('a.patch', b'completely different\n', 'pop')
+        entry = self.history.versions('a.patch')[-1]
+        self.assertEqual(self.object_kind(entry['object']), [b'full'])
+        self.assertEqual((entry['base'], entry['depth']), (entry['object'], 0))
+
+    def test_log_without_bases(self):
+        # Versions logged before bases were recorded start a new full object
+        self.history.snapshot('a.patch', version_text(1), 'pop')
+        sha = self.history.versions('a.patch')[0]['object']
+        with open(self.history.log_path('a.patch'), 'w') as f:
+            f.write('{"version": 1, "object": "%s", "action": "pop", "date": 0, "size": 1}\n' % sha)
+        self.history.snapshot('a.patch', version_text(2), 'pop')
+        self.assertEqual(self.object_kind(self.history.versions('a.patch')[-1]['object']), [b'full'])
+
+    def test_store(self):
+        self.assertEqual(self.history.store(self.write_src(b'one\n'), 'a.patch', 'import'), 1)
+        self.assertEqual(self.pool_file('a.patch'), b'one\n')
+        # Changed in the pool behind our back: that content is kept before it is replaced
+        with open(os.path.join(self.dir, 'a.patch'), 'wb') as f:
+            f.write(b'edited\n')
+        self.assertEqual(self.history.store(self.write_src(b'two\n'), 'a.patch', 'pop'), 3)
+        self.assertEqual([(entry['version'], entry['action']) for entry in self.history.versions('a.patch')],
+                         [(1, 'import'), (2, 'replaced'), (3, 'pop')])
+        self.assertEqual(self.history.read('a.patch', 2), b'edited\n')
+
+    def test_store_unchanged_does_not_write(self):
+        self.history.store(self.write_src(b'one\n'), 'a.patch', 'import')
+        with mock.patch.object(history, 'write_atomic') as write_atomic:
+            self.assertIsNone(self.history.store(self.write_src(b'one\n'), 'a.patch', 'pop'))
+        self.assertFalse(write_atomic.called)
+
+    def test_restore(self):
+        for number in range(1, 4):
+            self.history.store(self.write_src(version_text(number)), 'a.patch', 'pop')
+        self.assertEqual(self.history.restore('a.patch', 1), 4)
+        self.assertEqual(self.pool_file('a.patch'), version_text(1))
+        self.assertEqual(self.history.versions('a.patch')[-1]['action'], 'restore 1')
+        # The restore can itself be undone
+        self.history.restore('a.patch', 3)
+        self.assertEqual(self.pool_file('a.patch'), version_text(3))
+
+    def test_restore_unknown_version(self):
+        self.history.store(self.write_src(b'one\n'), 'a.patch', 'import')
+        with self.assertRaises(KeyError):
+            self.history.restore('a.patch', 5)
+        with self.assertRaises(KeyError):
+            self.history.restore('b.patch', 1)
+        self.assertEqual(self.pool_file('a.patch'), b'one\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+#
+# The local Mantis search index ('mq mantis sync' and 'mq mantis search') against a
+# temporary SQLite file.
+#
+
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import mantis
+from mqlib.mantisindex import MantisIndex, parse_issue_range
+
+
+ISSUE_PAGE = """<html><body>
+<table>
+<tr><td class="bug-summary">{summary}</td><td class="bug-last-modified">{updated}</td></tr>
+<tr><td class="bug-description"><p>Crash on start</p></td></tr>
+</table>
+<div class="bugnote-note"><a href="file_download.php?file_id=1&amp;type=bug">issue_1001.patch</a></div>
+</body></html>
+"""
+
+ATTACHMENT = """diff --git a/src/app/main.c b/src/app/main.c
+--- a/src/app/main.c
++++ b/src/app/main.c
+@@ -1,1 +1,1 @@
+-int x;
++int y;
+"""
+
+
+class FakeResponse():
+
+    def __init__(self, text, from_cache=False):
+        self.text = text
+        self.content = text.encode('utf-8')
+        self.status_code = 200
+        self.url = 'http://mantis.example.com/view.php?id=1001'
+        self.history = []
+        if from_cache:
+            self.from_cache = True
+
+
+class ParseIssueRangeTest(unittest.TestCase):
+
+    def test_ids_and_ranges(self):
+        self.assertEqual(parse_issue_range(['12', '3-5', '4']), [3, 4, 5, 12])
+
+    def test_reversed_range(self):
+        self.assertEqual(parse_issue_range(['7-5']), [5, 6, 7])
+
+    def test_invalid(self):
+        for value in ('abc', '1-', '-3', '1-2-3'):
+            with self.assertRaises(ValueError):
+                parse_issue_range([value])
+
+
+class MantisIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mq-test-')
+        self.index = MantisIndex('http://mantis.example.com', os.path.join(self.dir, 'index.sqlite'))
+        self.index.store(1001, 'Crash on start', 'The app crashes', '2024-01-01', 'hash1',
+                         [('url1', 'issue_1001.patch', ['src/app/main.c', 'src/app/util.c'])])
+        self.index.store(1002, 'Wrong colour', 'Buttons are red', '2024-01-02', 'hash2',
+                         [('url2', 'issue_1002.patch', ['src/ui/theme_dark.css', 'docs/100%.txt'])])
+        self.index.store(1003, 'Translations', 'Update the French text', '2024-01-03', 'hash3',
+                         [('url3', 'issue_1003.patch', ['po/français.po'])])
+
+    def tearDown(self):
+        self.index.db.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def issues(self, *args, **kwargs):
+        return [result['issue'] for result in self.index.search(*args, **kwargs)]
+
+    def test_words(self):
+        self.assertEqual(self.issues('crashes'), [1001])
+        self.assertEqual(self.issues('buttons red'), [1002])
+        self.assertEqual(self.issues(), [1003, 1002, 1001])
+
+    def test_file(self):
+        results = self.index.search(touched='src/app/')
+        self.assertEqual([result['issue'] for result in results], [1001])
+        self.assertEqual(results[0]['attachments'], [{'name': 'issue_1001.patch',
+                                                      'files': ['src/app/main.c', 'src/app/util.c']}])
+        self.assertEqual(self.issues(touched='util.c'), [1001])
+        self.assertEqual(self.issues('crash', touched='theme'), [])
+
+    def test_file_wildcards_are_literal(self):
+        self.assertEqual(self.issues(touched='theme_dark'), [1002])
+        self.assertEqual(self.issues(touched='theme_'), [1002])
+        self.assertEqual(self.issues(touched='theme%dark'), [])
+        self.assertEqual(self.issues(touched='src_app'), [])
+        self.assertEqual(self.issues(touched='100%'), [1002])
+
+    def test_file_with_non_ascii_name(self):
+        self.assertEqual(self.issues(touched='français'), [1003])
+        self.assertEqual(self.issues(touched='"'), [])
+
+    def test_store_replaces_the_issue(self):
+        self.index.store(1001, 'Crash on exit', 'The app crashes', '2024-02-01', 'hash4',
+                         [('url4', 'issue_1001_v2.patch', ['src/app/exit.c'])])
+        self.assertEqual(self.issues(touched='main.c'), [])
+        self.assertEqual(self.issues(touched='exit.c'), [1001])
+        self.assertEqual(self.issues('start'), [])
+        self.assertEqual(self.index.issue(1001)['page_hash'], 'hash4')
+        self.assertEqual(self.index.attachment_urls(), {'url2', 'url3', 'url4'})
+
+
+class FetchIssueForIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix='mq-test-')
+        with open(os.path.join(self.home, '.hgrc'), 'w') as f:
+            f.write('[mq]\nmantis_url = http://mantis.example.com\nmantis_cookie = session=1\n')
+        with mock.patch.dict(os.environ, {'HOME': self.home}):
+            self.mantis = mantis.Mantis(debug=False)
+        self.page = ISSUE_PAGE.format(summary='Crash on start', updated='2024-01-01 10:00')
+        self.stored = {'summary': 'Crash on start', 'description': '', 'updated': '2024-01-01 10:00',
+                       'page_hash': hashlib.sha1(self.page.encode('utf-8')).hexdigest()}
+
+    def tearDown(self):
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def fetch(self, page, known, from_cache=False):
+        with mock.patch.object(self.mantis, 'fetch_issue_page', return_value=FakeResponse(page, from_cache)), \
+                mock.patch.object(self.mantis.req, 'make_request', return_value=FakeResponse(ATTACHMENT)) as request:
+            return self.mantis.fetch_issue_for_index(1001, known), request
+
+    def test_new_issue(self):
+        result, request = self.fetch(self.page, {'issues': {}, 'attachments': set()})
+        self.assertEqual(result['status'], 'updated')
+        self.assertEqual(result['summary'], 'Crash on start')
+        url = 'http://mantis.example.com/file_download.php?file_id=1&type=bug'
+        self.assertEqual(result['attachments'], [(url, 'issue_1001.patch', ['src/app/main.c'])])
+        # Attachment bodies are only read for their file list and are not cached
+        self.assertEqual(request.call_args[1]['cache'], False)
+
+    def test_unchanged_page(self):
+        result, request = self.fetch(self.page, {'issues': {1001: self.stored}, 'attachments': set()})
+        self.assertEqual(result['status'], 'unchanged')
+        self.assertFalse(request.called)
+
+    def test_page_served_from_cache(self):
+        stored = dict(self.stored, page_hash='other', updated='')
+        result, request = self.fetch(self.page, {'issues': {1001: stored}, 'attachments': set()}, from_cache=True)
+        self.assertEqual(result['status'], 'unchanged')
+
+    def test_same_last_modified(self):
+        # The page changed (eg. a new view counter) but the issue itself was not modified
+        result, request = self.fetch(self.page + '<!-- 2 -->', {'issues': {1001: self.stored}, 'attachments': set()})
+        self.assertEqual(result['status'], 'unchanged')
+
+    def test_modified_issue(self):
+        page = ISSUE_PAGE.format(summary='Crash on start and exit', updated='2024-01-02 09:00')
+        url = 'http://mantis.example.com/file_download.php?file_id=1&type=bug'
+        result, request = self.fetch(page, {'issues': {1001: self.stored}, 'attachments': {url}})
+        self.assertEqual(result['status'], 'updated')
+        self.assertEqual(result['summary'], 'Crash on start and exit')
+        # Attachments already in the index are not fetched again
+        self.assertEqual(result['attachments'], [(url, 'issue_1001.patch', None)])
+        self.assertFalse(request.called)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+#
+
+
+import unittest
+
+from mqlib import patch
+
+
+HTML_FILE_DIFF = """diff --git a/templates/index.html b/templates/index.html
+--- a/templates/index.html
++++ b/templates/index.html
+@@ -1,2 +1,3 @@
+ <html>
++<body class="main">
+ </html>
+"""
+
+HEADER_ONLY_DIFF = """# HG changeset patch
+# User Someone <someone@example.com>
+# Date 1540000000 0
+# Node ID 0123456789abcdef0123456789abcdef01234567
+# Parent  89abcdef0123456789abcdef0123456789abcdef
+# Parent  fedcba9876543210fedcba9876543210fedcba98
+Merge with default
+
+"""
+
+
+class ValidateDiffTest(unittest.TestCase):
+
+    def test_diff_of_an_html_file(self):
+        self.assertEqual(patch.validate_diff(HTML_FILE_DIFF, 'text/plain; charset=utf-8'), 1)
+
+    def test_header_only_diff(self):
+        self.assertEqual(patch.validate_diff(HEADER_ONLY_DIFF), 0)
+
+    def test_empty_diff(self):
+        with self.assertRaises(ValueError):
+            patch.validate_diff('')
+        with self.assertRaises(ValueError):
+            patch.validate_diff('# HG changeset patch\n# Parent  89abcdef0123456789abcdef0123456789abcdef\nEmpty\n')
+        self.assertEqual(patch.validate_diff('', allow_empty=True), 0)
+
+    def test_html_page(self):
+        with self.assertRaises(ValueError):
+            patch.validate_diff('<!DOCTYPE html>\n<html><body>Sign in</body></html>\n')
+        with self.assertRaises(ValueError):
+            patch.validate_diff('<title>Sign in</title>\n', 'text/html; charset=utf-8')
+
+    def test_truncated_hunk(self):
+        with self.assertRaises(ValueError):
+            patch.validate_diff(HTML_FILE_DIFF.rsplit('\n', 2)[0] + '\n')
+
+
+def numbered(count, prefix='line'):
+    return ['{} {}\n'.format(prefix, number) for number in range(1, count + 1)]
+
+
+def apply_hunks(lines, hunks):
+    """Apply hunks exactly where their headers say, failing on any mismatch."""
+    result = []
+    position = 0
+    for header, body in hunks:
+        old_start, old_len, new_start, new_len = patch.hunk_ranges(header)
+        result.extend(lines[position:old_start - 1])
+        old = patch.side(body, ' -')
+        if lines[old_start - 1:old_start - 1 + old_len] != old:
+            raise AssertionError('hunk {} does not apply'.format(header.strip()))
+        result.extend(patch.side(body, ' +'))
+        position = old_start - 1 + old_len
+    return result + lines[position:]
+
+
+def file_diff(path, old_lines, new_lines, header=''):
+    hunks = patch.make_hunks(old_lines, new_lines)
+    old_path = 'a/' + path if old_lines else '/dev/null'
+    new_path = 'b/' + path if new_lines else '/dev/null'
+    lines = ['diff --git a/{0} b/{0}\n'.format(path)] + ([header] if header else [])
+    lines += ['--- {}\n'.format(old_path), '+++ {}\n'.format(new_path)]
+    for hunk_header, body in hunks:
+        lines.append(hunk_header)
+        lines.extend(body)
+    return lines
+
+
+class ComposeHunksTest(unittest.TestCase):
+
+    def compose(self, base, mid, final, context=3):
+        first = patch.make_hunks(base, mid, context)
+        second = patch.make_hunks(mid, final, context)
+        self.assertEqual(apply_hunks(mid, second), final)
+        hunks = patch.compose_hunks(first, second)
+        self.assertEqual(apply_hunks(base, hunks), final)
+        return hunks
+
+    def test_disjoint_hunks(self):
+        base = numbered(40)
+        mid = base[:1] + ['changed 2\n'] + base[2:]
+        final = mid[:37] + ['changed 38\n'] + mid[38:]
+        self.assertEqual(len(self.compose(base, mid, final)), 2)
+
+    def test_overlapping_hunks(self):
+        base = numbered(20)
+        mid = base[:4] + ['changed 5\n', 'changed 6\n'] + base[6:]
+        final = mid[:5] + ['again 6\n', 'again 7\n'] + mid[7:]
+        hunks = self.compose(base, mid, final)
+        self.assertEqual(len(hunks), 1)
+        self.assertNotIn('-changed 6\n', hunks[0][1])
+
+    def test_adjacent_hunks(self):
+        base = numbered(20)
+        mid = base[:4] + ['changed 5\n'] + base[5:]
+        final = mid[:5] + ['changed 6\n'] + mid[6:]
+        self.compose(base, mid, final, context=0)
+
+    def test_offsets_from_earlier_hunks(self):
+        base = numbered(30)
+        mid = ['new 1\n', 'new 2\n', 'new 3\n'] + base[:20] + base[25:]
+        final = mid[:-2] + ['changed end\n'] + mid[-1:]
+        self.compose(base, mid, final)
+
+    def test_change_reverted(self):
+        base = numbered(10)
+        mid = base[:4] + ['changed 5\n'] + base[5:]
+        self.assertEqual(self.compose(base, mid, base), [])
+
+    def test_diffs_do_not_chain(self):
+        base = numbered(10)
+        first = patch.make_hunks(base, base[:4] + ['changed 5\n'] + base[5:])
+        second = patch.make_hunks(base, base[:5] + ['changed 6\n'] + base[6:])
+        with self.assertRaises(ValueError):
+            patch.compose_hunks(first, second)
+
+
+class DiffFolderTest(unittest.TestCase):
+
+    def fold(self, *diffs):
+        folder = patch.DiffFolder()
+        for lines in diffs:
+            for file_patch in patch.iter_file_patches(lines):
+                folder.add(file_patch)
+        return folder
+
+    def test_commits_to_the_same_file(self):
+        versions = [numbered(30)]
+        versions.append(versions[-1][:2] + ['first\n'] + versions[-1][3:])
+        versions.append(versions[-1][:25] + ['second\n'] + versions[-1][26:])
+        versions.append(versions[-1][:1] + ['third\n'] + versions[-1][1:])
+        folder = self.fold(*[file_diff('a.txt', old, new) for old, new in zip(versions, versions[1:])])
+        self.assertEqual(len(folder.entries), 1)
+        file_patch = list(patch.iter_file_patches(list(folder.lines())))[0]
+        self.assertEqual(apply_hunks(versions[0], file_patch.hunks), versions[-1])
+        self.assertEqual((file_patch.added, file_patch.removed), (3, 2))
+
+    def test_other_files_are_kept_in_order(self):
+        base = numbered(10)
+        changed = base[:1] + ['changed\n'] + base[2:]
+        folder = self.fold(file_diff('a.txt', base, changed) + file_diff('b.txt', base, changed),
+                           file_diff('a.txt', changed, base))
+        self.assertEqual([file_patch.path for file_patch in folder.entries], ['a.txt', 'b.txt'])
+        self.assertEqual(folder.entries[0].hunks, [])
+
+    def test_added_file_then_changed(self):
+        content = numbered(5)
+        changed = content[:2] + ['changed\n'] + content[3:]
+        folder = self.fold(file_diff('new.txt', [], content, 'new file mode 100644\n'),
+                           file_diff('new.txt', content, changed))
+        self.assertEqual(len(folder.entries), 1)
+        self.assertEqual(apply_hunks([], folder.entries[0].hunks), changed)
+        self.assertIn('--- /dev/null\n', list(folder.lines()))
+
+    def test_deleted_file_is_not_folded(self):
+        content = numbered(5)
+        changed = content[:2] + ['changed\n'] + content[3:]
+        folder = self.fold(file_diff('old.txt', content, changed),
+                           file_diff('old.txt', changed, [], 'deleted file mode 100644\n'))
+        self.assertEqual(len(folder.entries), 2)
+        self.assertEqual(folder.entries[1].new_path, '/dev/null')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,209 @@
+#!/usr/bin/python3
+#
+# In memory rebasing of patch files ('mq rebase' and 'mq --all rebase').
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from mqlib import patch, rebase
+
+
+def numbered(count, prefix='line'):
+    return ['{} {}\n'.format(prefix, number) for number in range(1, count + 1)]
+
+
+def file_patch(path, old_lines, new_lines, extra=()):
+    """Return the FilePatch of a git diff from old_lines to new_lines (None for a missing file)."""
+    lines = ['diff --git a/{0} b/{0}\n'.format(path)] + list(extra)
+    if old_lines is None:
+        lines.append('new file mode 100644\n')
+    if new_lines is None:
+        lines.append('deleted file mode 100644\n')
+    hunks = patch.make_hunks(old_lines or [], new_lines or [])
+    if hunks:
+        lines.append('--- {}\n'.format('/dev/null' if old_lines is None else 'a/' + path))
+        lines.append('+++ {}\n'.format('/dev/null' if new_lines is None else 'b/' + path))
+    for header, body in hunks:
+        lines.append(header)
+        lines.extend(body)
+    return list(patch.iter_file_patches(lines))[0]
+
+
+def apply(lines, hunks):
+    output, conflicts = rebase.apply_hunks(lines, hunks, max_fuzz=0)
+    assert not conflicts
+    return output
+
+
+BASE = numbered(30)
+
+
+class FindSyncRegionsTest(unittest.TestCase):
+
+    def test_unchanged(self):
+        self.assertEqual(rebase.find_sync_regions(BASE, BASE, BASE), [(0, 30, 0, 30, 0, 30), (30, 30, 30, 30, 30, 30)])
+
+    def test_regions_around_changes(self):
+        ours = BASE[:4] + ['ours\n'] + BASE[5:]
+        theirs = ['inserted\n'] + BASE[:20] + BASE[21:]
+        regions = rebase.find_sync_regions(BASE, ours, theirs)
+        self.assertEqual(regions, [(0, 4, 0, 4, 1, 5), (5, 20, 5, 20, 6, 21), (21, 30, 21, 30, 21, 30),
+                                   (30, 30, 30, 30, 30, 30)])
+        for z_start, z_end, a_start, a_end, b_start, b_end in regions:
+            self.assertEqual(BASE[z_start:z_end], ours[a_start:a_end])
+            self.assertEqual(BASE[z_start:z_end], theirs[b_start:b_end])
+
+
+class Merge3Test(unittest.TestCase):
+
+    def test_clean(self):
+        ours = BASE[:4] + ['ours\n'] + BASE[5:]
+        theirs = ['inserted\n'] + BASE[:20] + BASE[21:]
+        merged = ['inserted\n'] + BASE[:4] + ['ours\n'] + BASE[5:20] + BASE[21:]
+        self.assertEqual(rebase.merge3(BASE, ours, theirs), (merged, 0))
+        self.assertEqual(rebase.merge3(BASE, theirs, ours), (merged, 0))
+
+    def test_same_change_on_both_sides(self):
+        changed = BASE[:4] + ['both\n'] + BASE[5:]
+        self.assertEqual(rebase.merge3(BASE, changed, changed), (changed, 0))
+
+    def test_conflict(self):
+        ours = BASE[:4] + ['ours\n'] + BASE[5:]
+        theirs = BASE[:4] + ['theirs\n'] + BASE[5:]
+        merged, conflicts = rebase.merge3(BASE, ours, theirs)
+        self.assertEqual(conflicts, 1)
+
+    def test_adjacent_changes_conflict(self):
+        ours = BASE[:4] + ['ours\n'] + BASE[5:]
+        theirs = BASE[:5] + ['theirs\n'] + BASE[6:]
+        self.assertEqual(rebase.merge3(BASE, ours, theirs)[1], 1)
+
+
+class RebaseFileTest(unittest.TestCase):
+
+    def test_clean_merge(self):
+        patched = BASE[:4] + ['ours\n'] + BASE[5:]
+        tip = ['inserted\n'] + BASE[:20] + ['upstream\n'] + BASE[21:]
+        hunks = rebase.rebase_file(file_patch('a.txt', BASE, patched), BASE, tip)
+        self.assertEqual(apply(tip, hunks), ['inserted\n'] + patched[:20] + ['upstream\n'] + patched[21:])
+
+    def test_already_upstream(self):
+        patched = BASE[:4] + ['ours\n'] + BASE[5:]
+        self.assertEqual(rebase.rebase_file(file_patch('a.txt', BASE, patched), BASE, patched), [])
+
+    def test_conflict(self):
+        patched = BASE[:4] + ['ours\n'] + BASE[5:]
+        tip = BASE[:4] + ['theirs\n'] + BASE[5:]
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(file_patch('a.txt', BASE, patched), BASE, tip)
+
+    def test_does_not_apply_to_parent(self):
+        patched = BASE[:4] + ['ours\n'] + BASE[5:]
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(file_patch('a.txt', BASE, patched), BASE[:4] + ['other\n'] + BASE[5:], BASE)
+
+    def test_added(self):
+        added = file_patch('new.txt', None, ['new\n'])
+        self.assertEqual(rebase.rebase_file(added, None, None), added.hunks)
+
+    def test_add_add(self):
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(file_patch('new.txt', None, ['new\n']), None, ['other\n'])
+
+    def test_added_empty_file(self):
+        added = file_patch('empty.txt', None, [])
+        self.assertEqual(added.hunks, [])
+        self.assertEqual(rebase.rebase_file(added, None, None), [])
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(added, None, [])
+
+    def test_deleted(self):
+        deleted = file_patch('a.txt', BASE, None)
+        self.assertEqual(rebase.rebase_file(deleted, BASE, BASE), deleted.hunks)
+
+    def test_delete_modify(self):
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(file_patch('a.txt', BASE, None), BASE, BASE[:4] + ['theirs\n'] + BASE[5:])
+
+    def test_binary(self):
+        binary = list(patch.iter_file_patches(['diff --git a/logo.png b/logo.png\n',
+                                               'Binary files a/logo.png and b/logo.png differ\n']))[0]
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(binary, [], [])
+
+    def test_rename(self):
+        renamed = list(patch.iter_file_patches(['diff --git a/old.txt b/new.txt\n', 'rename from old.txt\n',
+                                                'rename to new.txt\n']))[0]
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(renamed, BASE, BASE)
+
+    def test_mode_change(self):
+        with self.assertRaises(rebase.RebaseConflict):
+            rebase.rebase_file(file_patch('run.sh', BASE, BASE, ['old mode 100644\n', 'new mode 100755\n']), BASE, BASE)
+
+
+class RebasePatchTest(unittest.TestCase):
+
+    REVISIONS = {'parent': 'p' * 40, 'tip': 'd' * 40}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mq-test-')
+        self.patch_file = os.path.join(self.dir, 'patch')
+        self.files = {self.REVISIONS['parent']: {'a.txt': BASE}, self.REVISIONS['tip']: {'a.txt': ['inserted\n'] + BASE}}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def hg(self, *args, **kwargs):
+        self.assertEqual(args[:2], ('log', '-r'))
+        return self.REVISIONS.get(args[2], '')
+
+    def export_files(self, root, revision, files, base_dir):
+        for path in files:
+            if path in self.files[revision]:
+                os.makedirs(os.path.dirname(os.path.join(base_dir, path)), exist_ok=True)
+                with open(os.path.join(base_dir, path), 'w') as f:
+                    f.writelines(self.files[revision][path])
+
+    def rebase(self, *file_patches):
+        with open(self.patch_file, 'w') as f:
+            f.write('# HG changeset patch\n# Parent  parent\nFix things\n\n')
+            for entry in file_patches:
+                f.writelines(entry.header)
+                for header, body in entry.hunks:
+                    f.write(header)
+                    f.writelines(body)
+        with mock.patch.object(rebase, 'hg', self.hg), mock.patch.object(rebase, 'export_files', self.export_files):
+            result = rebase.rebase_patch(self.dir, self.patch_file)
+        with open(self.patch_file) as f:
+            return result, f.readlines()
+
+    def test_rebased(self):
+        patched = BASE[:4] + ['ours\n'] + BASE[5:]
+        result, lines = self.rebase(file_patch('a.txt', BASE, patched), file_patch('new.txt', None, ['new\n']),
+                                    file_patch('empty.txt', None, []))
+        self.assertTrue(result)
+        self.assertIn('# Parent  {}\n'.format(self.REVISIONS['tip']), lines)
+        entries = list(patch.iter_file_patches(lines))
+        self.assertEqual([entry.path for entry in entries], ['a.txt', 'new.txt', 'empty.txt'])
+        self.assertEqual(apply(['inserted\n'] + BASE, entries[0].hunks), ['inserted\n'] + patched)
+        self.assertIn('new file mode 100644\n', entries[2].header)
+
+    def test_added_upstream_too(self):
+        # The added file is looked up at the destination under its own path, not /dev/null
+        self.files[self.REVISIONS['tip']]['new.txt'] = ['other\n']
+        with self.assertRaises(rebase.RebaseConflict):
+            self.rebase(file_patch('new.txt', None, ['new\n']))
+
+    def test_mode_change_is_not_copied_unchanged(self):
+        with self.assertRaises(rebase.RebaseConflict):
+            self.rebase(file_patch('a.txt', BASE, BASE, ['old mode 100644\n', 'new mode 100755\n']))
+
+
+if __name__ == '__main__':
+    unittest.main()
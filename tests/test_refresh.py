@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+#
+
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from mqlib import refresh
+
+
+PATCH = """# HG changeset patch
+# Parent  0000000000000000000000000000000000000000
+diff --git a/in_patch.txt b/in_patch.txt
+--- a/in_patch.txt
++++ b/in_patch.txt
+@@ -1,1 +1,1 @@
+-old
++new
+"""
+TRACKED = ['in_patch.txt', 'other.txt', 'recent.txt']
+
+
+class StatCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='mq-test-')
+        os.makedirs(os.path.join(self.root, '.hg', 'patches'))
+        self.write('.hg/patches/status', 'abcdef:fix_proj\n')
+        self.write('.hg/patches/fix_proj', PATCH)
+        self.write('.hg/dirstate', 'dirstate')
+        old = time.time() - 3600
+        for path in TRACKED:
+            self.write(path, 'new\n')
+            if path != 'recent.txt':
+                os.utime(os.path.join(self.root, path), (old, old))
+        self.cache = refresh.StatCache(self.root)
+        with mock.patch.object(refresh, 'hg', return_value='\n'.join(TRACKED) + '\n'):
+            self.assertTrue(self.cache.update())
+
+    def tearDown(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def write(self, path, text, mode='w'):
+        with open(os.path.join(self.root, path), mode) as f:
+            f.write(text)
+
+    def test_unchanged(self):
+        # recent.txt was written within the mtime window of the cache, so it is always checked
+        self.assertEqual(self.cache.files(changed_only=True), ['recent.txt'])
+        self.assertEqual(self.cache.files(), ['in_patch.txt', 'recent.txt'])
+
+    def test_unsure_window(self):
+        self.assertEqual(self.cache.load()['unsure'], ['recent.txt'])
+        old = time.time() - 3600
+        os.utime(os.path.join(self.root, 'recent.txt'), (old, old))
+        self.cache.update(['recent.txt'])
+        self.assertEqual(self.cache.load()['unsure'], [])
+        self.assertEqual(self.cache.files(changed_only=True), [])
+
+    def test_modified_file(self):
+        self.write('other.txt', 'more\n', 'a')
+        self.assertEqual(self.cache.files(changed_only=True), ['other.txt', 'recent.txt'])
+
+    def test_dirstate_change(self):
+        # eg. 'hg mv other.txt moved.txt' outside of mq
+        self.write('.hg/dirstate', 'dirstate with moved.txt')
+        with self.assertRaises(refresh.InvalidCache):
+            self.cache.files()
+
+    def test_applied_patch_change(self):
+        self.write('.hg/patches/status', '012345:fix_proj\n')
+        with self.assertRaises(refresh.InvalidCache):
+            self.cache.files()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#!/usr/bin/python3
+#
+# 'mq rhodecode primport' against a local stub of the RhodeCode JSON-RPC API and pull
+# request page.
+#
+
+
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import rhodecode
+from mqlib.remote import ResponseCache
+
+
+FIRST_DIFF = """diff --git a/a.txt b/a.txt
+--- a/a.txt
++++ b/a.txt
+@@ -1,1 +1,1 @@
+-one
++two
+"""
+
+SECOND_DIFF = """diff --git a/b.txt b/b.txt
+--- a/b.txt
++++ b/b.txt
+@@ -1,1 +1,2 @@
+ one
++three
+"""
+
+CHANGESETS = {
+    'c1': {'diff': FIRST_DIFF, 'parents': ['c0'], 'added': [], 'changed': ['a.txt'], 'removed': []},
+    'c2': {'diff': SECOND_DIFF, 'parents': ['c1'], 'added': [], 'changed': ['b.txt'], 'removed': []},
+}
+
+PULL_REQUEST = {
+    'title': 'Fix the thing ',
+    'description': 'Longer description',
+    'source': {'repository': 'group/project'},
+    'author': {'firstname': 'Jane', 'lastname': 'Doe', 'username': 'jdoe', 'email': 'jane@example.com'},
+    # Newest first
+    'commit_ids': ['c2', 'c1'],
+}
+
+PULL_REQUEST_PAGE = """<html><body>
+<span id="pr-title">Fix the thing from the page</span>
+<div class="pr-origininfo"><span class="clone-url"><a href="/group/project">project</a></span></div>
+<a title="Raw diff" href="/group/project/diff/c1?diff=raw">raw</a>
+<a title="Raw diff" href="/group/project/diff/c2?diff=raw">raw</a>
+<div class="rc-user tooltip" title="Jane Doe &lt;jane@example.com&gt;"></div>
+<div id="pr-desc">- Description from the page</div>
+</body></html>
+"""
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, body, content_type='text/plain'):
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self.path != '/_admin/api':
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+        self.server.api_calls.append(request)
+        response = {'id': request['id'], 'result': None, 'error': None}
+        if request['method'] in self.server.api_errors:
+            response['error'] = self.server.api_errors[request['method']]
+        elif request['auth_token'] != 'secret':
+            response['error'] = 'Invalid API KEY'
+        elif request['method'] == 'get_pull_request':
+            response['result'] = PULL_REQUEST
+        elif request['method'] == 'get_repo_changeset':
+            response['result'] = dict(CHANGESETS[request['args']['revision']], raw_id=request['args']['revision'])
+        else:
+            response['error'] = 'No such method: {}'.format(request['method'])
+        self.send(json.dumps(response), 'application/json')
+
+    def do_GET(self):
+        self.server.pages.append(self.path)
+        if self.path == '/_admin/pull-request/7':
+            self.send(PULL_REQUEST_PAGE, 'text/html; charset=utf-8')
+        elif self.path.startswith('/group/project/diff/c1'):
+            self.send(FIRST_DIFF)
+        elif self.path.startswith('/group/project/diff/c2'):
+            self.send(SECOND_DIFF)
+        else:
+            self.send_error(404)
+
+
+class RhodecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.api_calls = []
+        self.server.api_errors = {}
+        self.server.pages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.home = tempfile.mkdtemp(prefix='mq-test-')
+        with open(os.path.join(self.home, '.hgrc'), 'w') as f:
+            f.write('[mq]\nrhodecode_url = http://127.0.0.1:{}\nrhodecode_api_token = secret\n'.format(
+                self.server.server_port))
+        with mock.patch.dict(os.environ, {'HOME': self.home}):
+            self.rhodecode = rhodecode.Rhodecode(debug=False)
+        self.rhodecode.req.cache = ResponseCache(os.path.join(self.home, 'cache'))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def combine(self, pr_data):
+        patch_file = os.path.join(self.home, 'pr.patch')
+        failed, stats = self.rhodecode.get_diffs_and_combine(pr_data, patch_file)
+        with open(patch_file) as f:
+            return failed, f.read()
+
+    def test_pull_request_from_api(self):
+        pr_data = self.rhodecode.get_pull_request_data(7)
+        self.assertEqual(pr_data['title'], ' - "Fix the thing"')
+        self.assertEqual(pr_data['user'], 'Jane Doe <jane@example.com>')
+        self.assertEqual(pr_data['raw_diffs'], [('group/project', 'c1'), ('group/project', 'c2')])
+        failed, text = self.combine(pr_data)
+        self.assertEqual(failed, [])
+        self.assertTrue(text.endswith(FIRST_DIFF + SECOND_DIFF))
+        self.assertEqual(self.server.pages, [])
+        self.assertEqual([call['method'] for call in self.server.api_calls],
+                         ['get_pull_request', 'get_repo_changeset', 'get_repo_changeset'])
+
+    def test_api_error(self):
+        self.server.api_errors['get_pull_request'] = 'pull request `7` does not exist'
+        with self.assertRaises(ValueError):
+            self.rhodecode.api_call('get_pull_request', pullrequestid=7)
+
+    def test_api_error_falls_back_to_page(self):
+        self.server.api_errors['get_pull_request'] = 'Access was denied to this resource.'
+        pr_data = self.rhodecode.get_pull_request_data(7)
+        self.assertEqual(pr_data['title'], ' - "Fix the thing from the page"')
+        self.assertEqual(pr_data['user'], 'Jane Doe <jane@example.com>')
+        self.assertEqual(pr_data['description'], 'Description from the page')
+        failed, text = self.combine(pr_data)
+        self.assertEqual(failed, [])
+        self.assertTrue(text.endswith(FIRST_DIFF + SECOND_DIFF))
+        self.assertEqual(self.server.pages[0], '/_admin/pull-request/7')
+
+    def test_changeset_error_fails_the_diff(self):
+        self.server.api_errors['get_repo_changeset'] = 'commit not found'
+        pr_data = self.rhodecode.get_pull_request_data(7)
+        with mock.patch.object(rhodecode, 'DIFF_FETCH_RETRIES', 1):
+            failed, text = self.combine(pr_data)
+        self.assertEqual(failed, [('group/project', 'c1'), ('group/project', 'c2')])
+
+    def test_empty_diff(self):
+        pr_data = self.rhodecode.get_pull_request_data(7)
+        empty = {'diff': '', 'parents': ['c1'], 'added': [], 'changed': ['b.txt'], 'removed': []}
+        with mock.patch.dict(CHANGESETS, {'c2': empty}), mock.patch.object(rhodecode, 'DIFF_FETCH_RETRIES', 1):
+            failed, text = self.combine(pr_data)
+        self.assertEqual(failed, [('group/project', 'c2')])
+        # Unless the commit itself is empty
+        with mock.patch.dict(CHANGESETS, {'c2': dict(empty, changed=[])}):
+            failed, text = self.combine(pr_data)
+        self.assertEqual(failed, [])
+        self.assertTrue(text.endswith(FIRST_DIFF))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#
+# The built in fuzzy hunk applier used by 'mq wiggle --batch' when wiggle is not installed.
+#
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from mqlib import patch, wiggle
+
+
+def numbered(count, prefix='line'):
+    return ['{} {}\n'.format(prefix, number) for number in range(1, count + 1)]
+
+
+BASE = numbered(30)
+# Change line 10 and line 25
+CHANGED = BASE[:9] + ['changed 10\n'] + BASE[10:24] + ['changed 25\n'] + BASE[25:]
+HUNKS = patch.make_hunks(BASE, CHANGED)
+
+
+class ApplyHunksTest(unittest.TestCase):
+
+    def test_exact(self):
+        self.assertEqual(wiggle.apply_hunks(BASE, HUNKS), (CHANGED, 0))
+
+    def test_offset(self):
+        lines = ['inserted 1\n', 'inserted 2\n'] + BASE[:20] + BASE[22:]
+        expected = ['inserted 1\n', 'inserted 2\n'] + CHANGED[:20] + CHANGED[22:]
+        self.assertEqual(wiggle.apply_hunks(lines, HUNKS), (expected, 0))
+
+    def test_offset_carried_to_later_hunks(self):
+        base = numbered(20)
+        for index in (4, 12, 14):
+            base[index] = 'same\n'
+        changed = list(base)
+        changed[4] = 'first\n'
+        changed[14] = 'second\n'
+        hunks = patch.make_hunks(base, changed, context=0)
+        # Without the offset of the first hunk the second would land on the 'same' line
+        # nearest to its original position, which is the wrong one
+        lines = ['inserted\n'] * 3 + base
+        self.assertEqual(wiggle.apply_hunks(lines, hunks), (['inserted\n'] * 3 + changed, 0))
+
+    def test_fuzz(self):
+        # The outermost context lines of both hunks no longer match
+        lines = list(BASE)
+        lines[6] = 'edited 7\n'
+        lines[27] = 'edited 28\n'
+        expected = list(CHANGED)
+        expected[6] = 'edited 7\n'
+        expected[27] = 'edited 28\n'
+        self.assertEqual(wiggle.apply_hunks(lines, HUNKS), (expected, 0))
+
+    def test_too_much_fuzz(self):
+        lines = list(BASE)
+        lines[7] = 'edited 8\n'
+        lines[11] = 'edited 12\n'
+        output, conflicts = wiggle.apply_hunks(lines, HUNKS, max_fuzz=1)
+        self.assertEqual(conflicts, 1)
+        self.assertIn('changed 25\n', output)
+        self.assertEqual(wiggle.apply_hunks(lines, HUNKS, max_fuzz=3)[1], 0)
+
+    def test_failure(self):
+        lines = list(BASE)
+        lines[9] = 'edited 10\n'
+        output, conflicts = wiggle.apply_hunks(lines, HUNKS)
+        self.assertEqual(conflicts, 1)
+        start = output.index('<<<<<<< found\n')
+        self.assertEqual(output[:start], BASE[:6])
+        markers = [output.index(marker) for marker in ('||||||| expected\n', '=======\n', '>>>>>>> replacement\n')]
+        self.assertIn('edited 10\n', output[start:markers[0]])
+        self.assertIn('line 10\n', output[markers[0]:markers[1]])
+        self.assertIn('changed 10\n', output[markers[1]:markers[2]])
+        # The hunk after the conflict is still applied
+        self.assertIn('changed 25\n', output[markers[2]:])
+        self.assertNotIn('line 25\n', output)
+
+
+class ResolveTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='mq-test-')
+        self.path = os.path.join(self.dir, 'file.txt')
+        with open(self.path + '.rej', 'w') as f:
+            f.write('--- file.txt\n+++ file.txt\n')
+            for header, body in HUNKS:
+                f.write(header)
+                f.writelines(body)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def write(self, lines):
+        with open(self.path, 'w') as f:
+            f.writelines(lines)
+
+    def read(self, path):
+        with open(path) as f:
+            return f.readlines()
+
+    def test_clean(self):
+        self.write(['inserted\n'] + BASE)
+        result = wiggle.resolve(self.path + '.rej', use_wiggle=False)
+        self.assertEqual((result['status'], result['hunks'], result['conflicts']), ('clean', 2, 0))
+        self.assertEqual(self.read(self.path), ['inserted\n'] + CHANGED)
+        self.assertEqual(wiggle.find_rejects(self.dir), [])
+
+    def test_conflict(self):
+        lines = list(BASE)
+        lines[9] = 'edited 10\n'
+        self.write(lines)
+        result = wiggle.resolve(self.path + '.rej', use_wiggle=False)
+        self.assertEqual((result['status'], result['conflicts']), ('conflict', 1))
+        # The original is left alone for the merge tool
+        self.assertEqual(self.read(self.path), lines)
+        self.assertIn('<<<<<<< found\n', self.read(self.path + '.wiggle'))
+
+    def test_missing_file(self):
+        result = wiggle.resolve(self.path + '.rej', use_wiggle=False)
+        self.assertEqual(result['status'], 'error')
+
+
+if __name__ == '__main__':
+    unittest.main()